@@ -37,30 +37,33 @@ import json
 
 from datetime import datetime, timedelta
 
-import pystache
+import gevent
 import twilio.twiml
 
 import urllib2
 import requests
 
 from flask import (abort, after_this_request, Flask, request, render_template,
-                   url_for)
+                   Response, url_for)
 from flask_cache import Cache
 from flask_jsonpify import jsonify
 from raven.contrib.flask import Sentry
 from twilio import TwilioRestException
 
-from models import db, aggregate_stats, log_call, call_count, call_list
+from models import (db, aggregate_stats, call_count, call_cursor, call_list,
+                    new_call, call_log_engine, CallLog)
 from political_data import PoliticalData
 from cache_handler import CacheHandler
+from template_cache import TemplateCache
+from twiml_cache import TwimlCache
 from fftf_leaderboard import FFTFLeaderboard
+from live_feed import LiveFeed
 from access_control_decorator import crossdomain, requires_auth
 
 try:
-    from throttle import Throttle
-    throttle = Throttle()
+    from throttle import Throttle, WindowThrottle
 except ImportError:
-    throttle = None
+    Throttle = None
 
 app = Flask(__name__)
 
@@ -69,18 +72,67 @@ app.config.from_object('config.ConfigProduction')
 cache = Cache(app, config={'CACHE_TYPE': 'simple'})
 sentry = Sentry(app)
 
-# db.init_app(app) # JL HACK ~ disable mysql
+# Optional call logging to the calls table, off unless CALL_LOGGING is set
+if app.config['CALL_LOGGING']:
+    db.init_app(app)
+    call_log = CallLog(
+        call_log_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                        app.config['CALL_LOG_CONNECT_TIMEOUT'],
+                        app.config['CALL_LOG_STATEMENT_TIMEOUT']),
+        app.config['CALL_LOG_SPOOL'])
+else:
+    call_log = None
 
 # Optional Redis cache, for caching Google spreadsheet campaign overrides
-cache_handler = CacheHandler(app.config['REDIS_URL'])
+cache_handler = CacheHandler(
+    app.config['REDIS_URL'],
+    local_size=app.config['CACHE_LOCAL_SIZE'],
+    local_ttl=app.config['CACHE_LOCAL_TTL'],
+    max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+    pool_timeout=app.config['REDIS_POOL_TIMEOUT'],
+    socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+    invalidation_channel=app.config['CACHE_INVALIDATION_CHANNEL'])
+
+# Pushes each call to the /live dashboards, through Redis when there is one
+live_feed = LiveFeed(app.config['REDIS_URL'],
+                     max_clients=app.config['LIVE_FEED_MAX_CLIENTS'])
+
+# Optional call throttle, needs psycopg2 and the _ms_call_* tables
+if Throttle is None:
+    throttle = None
+elif app.config['THROTTLE_BACKEND'] == 'window':
+    throttle = WindowThrottle(
+        cache_handler.redis_conn,
+        blacklist_refresh=app.config['THROTTLE_BLACKLIST_REFRESH'])
+else:
+    throttle = Throttle(app.config['THROTTLE_POOL_SIZE'],
+                        app.config['THROTTLE_WRITE_BEHIND'])
 
 # FFTF Leaderboard handler. Only used if FFTF Leadboard params are passed in
+leaderboard_batch_urls = {}
+
+if app.config['FFTF_LB_BATCH_URL']:
+    leaderboard_batch_urls[FFTFLeaderboard.LEADERBOARD_URL] = \
+        app.config['FFTF_LB_BATCH_URL']
+if app.config['FFTF_CALL_LOG_BATCH_URL']:
+    leaderboard_batch_urls[FFTFLeaderboard.QUEUE_URL] = \
+        app.config['FFTF_CALL_LOG_BATCH_URL']
+
 leaderboard = FFTFLeaderboard(app.debug, app.config['FFTF_LB_ASYNC_POOL_SIZE'],
-    app.config['FFTF_CALL_LOG_API_KEY'])
+    app.config['FFTF_CALL_LOG_API_KEY'], app.config['FFTF_LB_QUEUE_SIZE'],
+    leaderboard_batch_urls, app.config['FFTF_SPOOL_PATH'])
 
 call_methods = ['GET', 'POST']
 
-data = PoliticalData(cache_handler, app.debug)
+data = PoliticalData(cache_handler, app.debug,
+                     districts_backend=app.config['DISTRICTS_BACKEND'])
+
+# Parsed mustache templates for the campaign messages
+templates = TemplateCache()
+templates.warm(data.campaigns)
+
+# Pre-serialized TwiML for the responses that only depend on the campaign
+twiml_cache = TwimlCache()
 
 print "Call Congress is starting up!"
 
@@ -94,7 +146,7 @@ def make_cache_key(*args, **kwargs):
 def play_or_say(resp_or_gather, msg_template, **kwds):
     # take twilio response and play or say a mesage
     # can use mustache templates to render keyword arguments
-    msg = pystache.render(msg_template, kwds)
+    msg = templates.render(msg_template, kwds)
 
     if msg.startswith('http'):
         resp_or_gather.play(msg)
@@ -118,6 +170,9 @@ def parse_params(r):
         # only used for campaigns of infinite_loop
         'saved_zipcode': r.values.get('saved_zipcode', None),
 
+        # the caller's zipcode, passed along for call logging
+        'user_zipcode': r.values.get('user_zipcode', None),
+
         'ip_address': r.values.get('ip_address', None),
 
         # optional values for Fight for the Future org tracking
@@ -141,7 +196,8 @@ def parse_params(r):
         if isinstance(campaign['repIds'], basestring):
             params['repIds'] = [campaign['repIds']]
         else:
-            params['repIds'] = campaign['repIds']
+            # copy, the campaign is shared and gets shuffled below
+            params['repIds'] = list(campaign['repIds'])
 
         if campaign.get('randomize_order', False):
             random.shuffle(params['repIds'])
@@ -160,6 +216,9 @@ def parse_params(r):
 
         # delete the zipcode, since the repIds are in a particular order and
         # will be passed around from endpoint to endpoint hereafter anyway.
+        # call logging still counts calls by it, so it's kept under a name
+        # that doesn't look the members up again.
+        params['user_zipcode'] = params['zipcode']
         del params['zipcode']
 
     if params['ip_address'] == None:
@@ -180,19 +239,49 @@ def parse_params(r):
 
 
 def intro_zip_gather(params, campaign):
+    return twiml_cache.render('intro_zip_gather', campaign,
+                              build_intro_zip_gather,
+                              url_for("zip_parse", **params))
+
+
+def invalid_zip_gather(params, campaign):
+    return twiml_cache.render('invalid_zip_gather', campaign,
+                              build_invalid_zip_gather,
+                              url_for("zip_parse", **params))
+
+
+def message_twiml(campaign, msg_field):
+    # TwiML that only plays or says a single campaign message
+    def build(campaign, action):
+        resp = twilio.twiml.Response()
+        play_or_say(resp, campaign[msg_field])
+        return resp
+
+    return twiml_cache.render(msg_field, campaign, build)
+
+
+def build_intro_zip_gather(campaign, action):
     resp = twilio.twiml.Response()
 
     play_or_say(resp, campaign['msg_intro'])
 
-    return zip_gather(resp, params, campaign)
+    return zip_gather(resp, campaign, action)
+
+
+def build_invalid_zip_gather(campaign, action):
+    resp = twilio.twiml.Response()
+
+    play_or_say(resp, campaign['msg_invalid_zip'])
 
+    return zip_gather(resp, campaign, action)
 
-def zip_gather(resp, params, campaign):
+
+def zip_gather(resp, campaign, action):
     with resp.gather(numDigits=5, method="POST", timeout=30,
-                     action=url_for("zip_parse", **params)) as g:
+                     action=action) as g:
         play_or_say(g, campaign['msg_ask_zip'])
 
-    return str(resp)
+    return resp
 
 
 def make_calls(params, campaign):
@@ -220,15 +309,13 @@ def make_calls(params, campaign):
 
     if selection == "9" and campaign.get('press_9_optout'):
 
-        url = pystache.render(campaign.get('press_9_optout'),
-            phone=params['userPhone'])
+        url = templates.render(campaign.get('press_9_optout'),
+            {'phone': params['userPhone']})
 
         callback_response = get_external_url(url)
         print "--- OPT OUT RESPONSE: %s" % callback_response
 
-        play_or_say(resp, campaign['msg_opt_out'])
-
-        return str(resp)
+        return message_twiml(campaign, 'msg_opt_out')
 
     n_reps = len(params['repIds'])
 
@@ -396,10 +483,7 @@ def zip_parse():
         print 'DEBUG: zipcode = {}'.format(zipcode)
 
     if not rep_ids:
-        resp = twilio.twiml.Response()
-        play_or_say(resp, campaign['msg_invalid_zip'])
-
-        return zip_gather(resp, params, campaign)
+        return invalid_zip_gather(params, campaign)
 
     params['zipcode'] = zipcode
     params['repIds'] = rep_ids
@@ -438,14 +522,17 @@ def make_single_call():
 
     else:
 
-        member = [l for l in data.legislators
-                  if l['bioguide_id'] == params['repIds'][i]][0]
-        to_phone = member['phone']
-        title = "Representative" if member['title'] == 'Rep' else 'Senator'
+        member = data.get_legislator_by_id(params['repIds'][i])
+
+        if not member:
+            abort(404)
+
+        to_phone = member.phone
+        title = "Representative" if member.title == 'Rep' else 'Senator'
         full_name = unicode("{} {} {}".format(
-            title, member['first_name'], member['last_name']), 'utf8')
-        title = member['title']
-        state = member['state']
+            title, member.first_name, member.last_name), 'utf8')
+        title = member.title
+        state = member.state
 
         if 'voted_with_list' in campaign and \
                 params['repIds'][i] in campaign['voted_with_list']:
@@ -479,7 +566,18 @@ def call_complete():
     if not params or not campaign:
         abort(404)
 
-    # log_call(params, campaign, request)
+    call = None
+
+    if call_log:
+        call = call_log.log_call(params, campaign, request)
+
+    if live_feed.watched(campaign['id']):
+        if not call:
+            call = new_call(params, campaign, request)
+
+        # publishing may wait on Redis, don't make Twilio wait with it
+        gevent.spawn(live_feed.publish, campaign['id'],
+                     serialize_call(call, {}))
 
     # If FFTF Leaderboard params are present, log this call
     if params['fftfCampaign'] and params['fftfReferer']:
@@ -496,12 +594,12 @@ def call_complete():
         resp.redirect(url_for('make_single_call', **params))
 
     elif i == len(params['repIds']) - 1:
-        # thank you for calling message
-        play_or_say(resp, campaign['msg_final_thanks'])
-
         # If FFTF Leaderboard params are present, log the call completion status
         if params['fftfCampaign'] and params['fftfReferer']:
             leaderboard.log_complete(params, campaign, request)
+
+        # thank you for calling message
+        return message_twiml(campaign, 'msg_final_thanks')
     else:
         # call the next representative
         params['call_index'] = i + 1  # increment the call counter
@@ -556,8 +654,10 @@ def count():
 
     campaign = request.values.get('campaign', 'default')
 
-    # return jsonify(campaign=campaign, count=call_count(campaign))
-    return jsonify('DISABLED') # JL HACK ~ disable mysql
+    if not call_log:
+        return jsonify('DISABLED') # JL HACK ~ disable mysql
+
+    return jsonify(campaign=campaign, count=call_count(campaign))
 
 
 @cache.cached(timeout=60, key_prefix=make_cache_key)
@@ -575,26 +675,53 @@ def recent_calls():
 
     campaign = request.values.get('campaign', 'default')
     since = request.values.get('since', datetime.utcnow() - timedelta(days=1))
-    limit = request.values.get('limit', 50)
-
-    # calls = call_list(campaign, since, limit)
-    # serialized_calls = []
-    # if not calls:
-    #     return jsonify(campaign=campaign, calls=[], count=0)
-    # for c in calls:
-    #     s = dict(timestamp = c.timestamp.isoformat(),
-    #              number = '%s-%s-XXXX' % (c.areacode, c.exchange))
-    #     member = data.get_legislator_by_id(c.member_id)
-    #     if member:
-    #         s['member'] = dict(
-    #                         title=member['title'],
-    #                         first_name=member['first_name'],
-    #                         last_name=member['last_name']
-    #                     )
-    #     serialized_calls.append(s)
-
-    # return jsonify(campaign=campaign, calls=serialized_calls, count=len(serialized_calls))
-    return jsonify('DISABLED') # JL NOTE ~ disable db
+    limit = min(request.values.get('limit', 50, type=int), 500)
+    cursor = request.values.get('cursor', None)
+
+    if not call_log:
+        return jsonify('DISABLED') # JL NOTE ~ disable db
+
+    try:
+        calls = call_list(campaign, since, limit, cursor)
+    except ValueError:
+        abort(400)     # not a cursor from a previous page
+
+    if not calls:
+        return jsonify(campaign=campaign, calls=[], count=0)
+
+    members = {}
+    serialized_calls = [serialize_call(c, members) for c in calls]
+
+    # a full page may have more after it
+    next_cursor = call_cursor(calls[-1]) if len(calls) == limit else None
+
+    return jsonify(campaign=campaign, calls=serialized_calls,
+                   count=len(serialized_calls), cursor=next_cursor)
+
+
+def serialize_call(c, members):
+    """a Call as /recent_calls and /live_feed send it, members memoizes"""
+    s = dict(timestamp = c.timestamp.isoformat(),
+             number = '%s-%s-XXXX' % (c.areacode, c.exchange))
+
+    if c.member_id not in members:
+        members[c.member_id] = serialize_member(c.member_id)
+
+    if members[c.member_id]:
+        s['member'] = members[c.member_id]
+
+    return s
+
+
+def serialize_member(member_id):
+    member = data.get_legislator_by_id(member_id)
+
+    if not member:
+        return None
+
+    return dict(title=member.title, first_name=member.first_name,
+                last_name=member.last_name)
+
 
 @app.route('/live')
 @requires_auth
@@ -603,18 +730,64 @@ def live():
     return render_template('live.html')
 
 
+@app.route('/live_feed')
+@requires_auth
+def live_feed_stream():
+    campaign = request.values.get('campaign', 'default')
+    queue = live_feed.subscribe(campaign)
+
+    if queue is None:
+        abort(503)     # every stream holds a gevent core, keep some for calls
+
+    return Response(live_feed.stream(campaign, queue),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route('/refresh_spreadsheets', methods=['POST'])
+@requires_auth
+def refresh_spreadsheets():
+    campaign = data.get_campaign(request.values.get('campaignId', 'default'))
+
+    if not campaign:
+        abort(404)
+
+    data.refresh_spreadsheets(campaign)
+
+    return jsonify(refreshed=campaign['id'])
+
+
+@app.route('/cache_stats')
+@requires_auth
+def cache_stats():
+    return jsonify(stats=cache_handler.stats,
+                   hit_ratios=cache_handler.hit_ratios())
+
+
+@app.route('/leaderboard_stats')
+@requires_auth
+def leaderboard_stats():
+    return jsonify(leaderboard.metrics())
+
+
 @cache.cached(timeout=60, key_prefix=make_cache_key)
 @app.route('/stats')
 def stats():
     password = request.values.get('password', None)
     campaign = request.values.get('campaign', 'default')
 
-    # if password == app.config['SECRET_KEY']:
-    #     return jsonify(aggregate_stats(campaign))
-    # else:
-    #     return jsonify(error="access denied")
+    # calls in the last ?hours=N only, to the hour
+    hours = request.values.get('hours', None, type=int)
 
-    return jsonify(error="access denied")   # JL HACK ~ disable mysql
+    if not call_log:
+        return jsonify(error="access denied")   # JL HACK ~ disable mysql
+
+    if password and password == app.config['SECRET_KEY']:
+        since = datetime.now() - timedelta(hours=hours) if hours else None
+        return jsonify(aggregate_stats(campaign, since))
+    else:
+        return jsonify(error="access denied")
 
 
 if __name__ == '__main__':
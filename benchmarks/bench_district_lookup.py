@@ -0,0 +1,65 @@
+"""
+Micro-benchmark for zipcode -> district lookups in PoliticalData.
+
+Compares the old linear scan over every districts.csv row with the
+zipcode-keyed index. Run from anywhere:
+
+    python benchmarks/bench_district_lookup.py [scan_sample_size]
+
+The indexed lookup is timed over the full zipcode set; the linear scan is
+far too slow for that, so it is timed over an evenly spaced sample.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from political_data import PoliticalData
+from cache_handler import CacheHandler
+
+
+def scan_lookup(data, zipcode):
+    return [d for d in data.district_index if d['zipcode'] == str(zipcode)]
+
+
+def indexed_lookup(data, zipcode):
+    return data.get_districts(zipcode)
+
+
+def run(lookup, data, zipcodes):
+    start = time.time()
+    for zipcode in zipcodes:
+        lookup(data, zipcode)
+    return time.time() - start
+
+
+def main():
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    data = PoliticalData(CacheHandler(None), False)
+    zipcodes = sorted(set(d['zipcode'] for d in data.district_index))
+    step = max(1, len(zipcodes) / sample_size)
+    sample = zipcodes[::step]
+
+    for zipcode in sample:
+        assert scan_lookup(data, zipcode) == indexed_lookup(data, zipcode)
+
+    print "%d district rows, %d distinct zipcodes" % (
+        len(data.district_index), len(zipcodes))
+
+    scan = run(scan_lookup, data, sample)
+    print "linear scan:  %8d lookups in %.3fs = %12.1f lookups/s" % (
+        len(sample), scan, len(sample) / scan)
+
+    indexed = run(indexed_lookup, data, zipcodes)
+    print "zipcode index: %7d lookups in %.3fs = %12.1f lookups/s" % (
+        len(zipcodes), indexed, len(zipcodes) / indexed)
+
+    print "speedup: %.0fx" % ((len(zipcodes) / indexed) / (len(sample) / scan))
+
+
+if __name__ == '__main__':
+    main()
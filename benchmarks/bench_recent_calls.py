@@ -0,0 +1,135 @@
+"""
+/recent_calls queries on a synthetic SQLite calls table, with and without
+the (campaign_id, timestamp) index:
+
+    python benchmarks/bench_recent_calls.py [--calls 3000000] [--db FILE]
+
+The table (calls spread evenly over --days days and --campaigns campaigns,
+in the order they would have been logged) is built once and reused while
+--db keeps the same size. 'before' is the old call_list: oldest first from
+a day ago, on the unindexed table. 'first page' is the newest first keyset
+page, and 'next pages' the average of the next 100 pages reached through
+their cursors.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlalchemy import create_engine
+
+from models import db, Call, call_cursor, call_list, migrate
+
+INDEX = 'ix_calls_campaign_id_timestamp'
+
+
+def build(path, calls, campaigns, days):
+    if os.path.exists(path):
+        os.remove(path)
+
+    engine = create_engine('sqlite:///' + path)
+    Call.__table__.create(engine)
+    engine.execute('DROP INDEX %s' % INDEX)
+
+    conn = sqlite3.connect(path)
+    end = datetime.now()
+    step = timedelta(days=days).total_seconds() / calls
+    start = end - timedelta(days=days)
+
+    def rows():
+        for i in xrange(calls):
+            timestamp = start + timedelta(seconds=i * step)
+            yield (timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                   'campaign-%d' % random.randrange(campaigns),
+                   'P%06d' % random.randrange(535),
+                   '%05d' % (10000 + i % 89999),
+                   '415', '555', 'completed', 30)
+
+    conn.executemany("INSERT INTO calls (timestamp, campaign_id, member_id, "
+                     "zipcode, areacode, exchange, status, duration) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+
+def old_call_list(campaign_id, since, limit=50):
+    return (db.session.query(Call)
+            .order_by(Call.timestamp)
+            .filter(Call.campaign_id == campaign_id)
+            .filter(Call.timestamp >= since)
+            .limit(limit).all())
+
+
+def timed(fn, repeat):
+    times = []
+
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+
+    times.sort()
+    return times[len(times) / 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=3000000)
+    parser.add_argument('--campaigns', type=int, default=20)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default=os.path.join(
+        tempfile.gettempdir(), 'bench_recent_calls.db'))
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite:///' + args.db)
+
+    if not os.path.exists(args.db) or engine.execute(
+            'SELECT max(id) FROM calls').scalar() != args.calls:
+        start = time.time()
+        build(args.db, args.calls, args.campaigns, args.days)
+        print 'built %d calls in %.0fs' % (args.calls, time.time() - start)
+
+    engine.execute('DROP INDEX IF EXISTS %s' % INDEX)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.db
+    db.init_app(app)
+
+    since = datetime.now() - timedelta(days=1)
+
+    def next_pages():
+        cursor = None
+
+        for i in range(100):
+            calls = call_list('campaign-0', since, 50, cursor)
+            cursor = call_cursor(calls[-1])
+
+    with app.app_context():
+        before = timed(lambda: old_call_list('campaign-0', since), args.repeat)
+
+        start = time.time()
+        migrate(engine)
+        print 'indexed in %.0fs' % (time.time() - start)
+
+        first_page = timed(lambda: call_list('campaign-0', since),
+                           args.repeat)
+        next_page = timed(next_pages, args.repeat) / 100
+
+    print "%-12s %10s" % ('', 'ms/page')
+    print "%-12s %10.2f" % ('before', before)
+    print "%-12s %10.2f" % ('first page', first_page)
+    print "%-12s %10.2f" % ('next pages', next_page)
+
+
+if __name__ == '__main__':
+    main()
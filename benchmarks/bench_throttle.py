@@ -0,0 +1,131 @@
+"""
+Latency of the throttle check in /create with many concurrent callers, on
+a fake database connection where every round trip takes --rtt ms:
+
+    python benchmarks/bench_throttle.py [--callers 100] [--rtt 2]
+
+'before' is the old setup: one shared connection that blocks the whole
+worker while it waits, and three counting queries instead of one (a
+SELECT costs three round trips). 'pooled' is the green connection pool,
+and 'buffered' adds the write-behind throttle log on top.
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import gevent
+
+from gevent.monkey import get_original
+
+from pg_pool import ConnectionPool
+from throttle import Throttle, ThrottleLog
+
+blocking_sleep = get_original('time', 'sleep')
+
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, qry, args=()):
+        trips = 3 if self.conn.serial and qry.startswith('SELECT') else 1
+        self.args = args
+        self.conn.wait(trips)
+
+    def fetchone(self):
+        return (0, 0, 0)
+
+    def fetchall(self):
+        # ids for a batch of the throttle log
+        return [(i,) for i in range(self.args[0])]
+
+    def mogrify(self, qry, args):
+        return repr(args)
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+    closed = 0
+
+    def __init__(self, rtt, serial):
+        self.rtt = rtt
+        self.serial = serial
+
+    def wait(self, trips):
+        if self.serial:
+            blocking_sleep(self.rtt * trips)
+        else:
+            gevent.sleep(self.rtt * trips)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        # the old connection committed, pooled ones are in autocommit
+        if self.serial:
+            self.wait(1)
+
+    def rollback(self):
+        pass
+
+
+def run(throttle, callers):
+    latencies = []
+
+    # every caller arrives at once, so latency includes time spent waiting
+    # for the worker while other callers block it
+    def call(i):
+        throttle.throttle('default', '415%07d' % i, '10.0.%d.%d' % (
+            i / 256, i % 256), None)
+        latencies.append(time.time() - start)
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(call, i) for i in range(callers)])
+    elapsed = time.time() - start
+
+    latencies.sort()
+
+    return (latencies[len(latencies) / 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            callers / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--callers', type=int, default=100)
+    parser.add_argument('--rtt', type=float, default=2, help='ms')
+    parser.add_argument('--pool-size', type=int, default=10)
+    args = parser.parse_args()
+
+    rtt = args.rtt / 1000.0
+    stdout = sys.stdout
+
+    print "%-8s %10s %10s %12s" % ('', 'p50 (ms)', 'p99 (ms)', 'calls/s')
+
+    for name, serial, pool_size, write_behind in (
+            ('before', True, 1, False),
+            ('pooled', False, args.pool_size, False),
+            ('buffered', False, args.pool_size, True)):
+        throttle = Throttle(write_behind=False)
+        throttle.pool = ConnectionPool(
+            lambda: FakeConnection(rtt, serial), pool_size)
+
+        if write_behind:
+            throttle.log = ThrottleLog(throttle.pool)
+
+        sys.stdout = open(os.devnull, 'w')     # throttle trip messages
+        result = run(throttle, args.callers)
+        sys.stdout = stdout
+
+        print "%-8s %10.1f %10.1f %12.0f" % ((name,) + result)
+
+
+if __name__ == '__main__':
+    main()
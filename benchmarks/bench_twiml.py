@@ -0,0 +1,75 @@
+"""
+TwiML generation cost per endpoint, building and serializing a fresh
+twilio.twiml.Response (before) vs. splicing into cached TwiML (after):
+
+    python benchmarks/bench_twiml.py [iterations]
+
+Imports app.py, so Twilio credentials are faked when not set.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+for name in ('TWILIO_ACCOUNT_SID', 'TWILIO_DEV_ACCOUNT_SID'):
+    os.environ.setdefault(name, 'ACbenchmark')
+for name in ('TWILIO_AUTH_TOKEN', 'TWILIO_DEV_AUTH_TOKEN'):
+    os.environ.setdefault(name, 'benchmark')
+
+import app as server
+
+from flask import url_for
+
+PARAMS = {'campaignId': 'default', 'userPhone': '4150001111',
+          'repIds': ['C000127', 'M001111'], 'ip_address': '127.0.0.1'}
+
+
+def message(campaign, msg_field):
+    resp = server.twilio.twiml.Response()
+    server.play_or_say(resp, campaign[msg_field])
+    return str(resp)
+
+
+ENDPOINTS = [
+    ('intro_zip_gather',
+     lambda campaign: str(server.build_intro_zip_gather(
+         campaign, url_for('zip_parse', **PARAMS))),
+     lambda campaign: server.intro_zip_gather(PARAMS, campaign)),
+    ('zip_parse (invalid zip)',
+     lambda campaign: str(server.build_invalid_zip_gather(
+         campaign, url_for('zip_parse', **PARAMS))),
+     lambda campaign: server.invalid_zip_gather(PARAMS, campaign)),
+    ('call_complete (final thanks)',
+     lambda campaign: message(campaign, 'msg_final_thanks'),
+     lambda campaign: server.message_twiml(campaign, 'msg_final_thanks')),
+    ('make_calls (opt out)',
+     lambda campaign: message(campaign, 'msg_opt_out'),
+     lambda campaign: server.message_twiml(campaign, 'msg_opt_out')),
+]
+
+
+def timed(render, campaign, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        render(campaign)
+    return (time.time() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    campaign = server.data.get_campaign('default')
+
+    with server.app.test_request_context('/'):
+        print "%-30s %12s %12s" % ('endpoint', 'before (us)', 'after (us)')
+
+        for name, before, after in ENDPOINTS:
+            print "%-30s %12.1f %12.1f" % (
+                name, timed(before, campaign, iterations),
+                timed(after, campaign, iterations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Cold-start time of PoliticalData, parsing the source files vs. loading the
+prebuilt reference data snapshot. Each run happens in a fresh interpreter:
+
+    python benchmarks/cold_start.py [runs]
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+def measure(use_snapshot):
+    from political_data import PoliticalData
+    from cache_handler import CacheHandler
+
+    start = time.time()
+    PoliticalData(CacheHandler(None), False, use_snapshot=use_snapshot)
+    print time.time() - start
+
+
+def run(mode, runs):
+    timings = []
+
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), mode])
+        timings.append(float(output.strip()))
+
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('sources', 'snapshot'):
+        return measure(sys.argv[1] == 'snapshot')
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    import reference_data
+    reference_data.build_snapshot()
+
+    for mode in ('sources', 'snapshot'):
+        best, mean = run(mode, runs)
+        print "%-8s best %.3fs  mean %.3fs  (%d runs)" % (mode, best, mean,
+                                                           runs)
+
+
+if __name__ == '__main__':
+    main()
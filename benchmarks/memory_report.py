@@ -0,0 +1,71 @@
+"""
+Per-process memory report for the legislator and district reference data.
+
+Loads legislators.csv and districts.csv once as csv.DictReader dicts (the old
+representation) and once as the compact Legislator/District records, each in
+a fresh interpreter, and compares the resident set size growth:
+
+    python benchmarks/memory_report.py
+"""
+import csv
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from reference_data import read_legislators, read_districts
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def load_dicts():
+    with open('data/legislators.csv') as f:
+        legislators = list(csv.DictReader(f))
+
+    with open('data/districts.csv') as f:
+        districts = list(csv.DictReader(
+            f, fieldnames=['zipcode', 'state', 'district_number']))
+
+    return legislators, districts
+
+
+def load_records():
+    return read_legislators(), read_districts()
+
+
+LOADERS = {'dicts': load_dicts, 'records': load_records}
+
+
+def measure(name):
+    before = rss_kb()
+    data = LOADERS[name]()
+    print rss_kb() - before
+
+
+def main():
+    if len(sys.argv) > 1:
+        return measure(sys.argv[1])
+
+    results = {}
+
+    for name in ('dicts', 'records'):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), name])
+        results[name] = int(output.strip())
+        print "%-8s %8d KB RSS per process" % (name, results[name])
+
+    print "saved %d KB per process (%.0f%%)" % (
+        results['dicts'] - results['records'],
+        100.0 * (results['dicts'] - results['records']) / results['dicts'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Private (unshared) memory per worker for the ways of loading reference data:
+
+  per-worker      every worker loads its own copy (uwsgi lazy mode today)
+  prefork-dicts   the master loads District records + dict index, then forks
+  prefork-packed  the master runs reference_data.preload(), then forks
+
+Each worker builds PoliticalData, looks up every zipcode and runs a full
+garbage collection, roughly what a worker does over its life, and then
+reports its Private_Dirty memory. Run with:
+
+    python benchmarks/prefork_memory.py [workers]
+"""
+import gc
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import reference_data
+from cache_handler import CacheHandler
+from district_index import DictDistricts
+from political_data import PoliticalData
+
+
+def private_dirty_kb():
+    total = 0
+
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+
+    return total
+
+
+def worker(write_fd):
+    data = PoliticalData(CacheHandler(None), False)
+
+    for district in data.district_index:
+        data.get_districts(district.zipcode)
+
+    gc.collect()
+
+    os.write(write_fd, '%d\n' % private_dirty_kb())
+    os._exit(0)
+
+
+def run(mode, workers):
+    reference_data.shared = None
+
+    if mode == 'prefork-dicts':
+        legislators, districts, campaigns = \
+            reference_data.load_reference_data()
+        reference_data.shared = (legislators, DictDistricts(districts),
+                                 campaigns)
+    elif mode == 'prefork-packed':
+        reference_data.preload()
+
+    gc.collect()
+    read_fd, write_fd = os.pipe()
+    pids = []
+
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            worker(write_fd)
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        sizes = [int(line) for line in f]
+
+    return sum(sizes) / len(sizes)
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+    for mode in ('per-worker', 'prefork-dicts', 'prefork-packed'):
+        private = run(mode, workers)
+        print "%-15s %6d KB private per worker, %7d KB for %d workers" % (
+            mode, private, private * workers, workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,159 @@
-from redis import Redis
+import time
+import uuid
+
+import gevent
+
+from collections import OrderedDict
+from gevent.event import AsyncResult
+from redis import BlockingConnectionPool, Redis, RedisError
+
+
+def listen(redis_url, channel, handle, name, delay=1):
+    """
+    Call handle with the data of every message published on a Redis
+    channel, resubscribing delay seconds after the connection fails. Runs
+    forever, so spawn it.
+    """
+    # subscriptions sit idle, so they get their own connection without the
+    # socket timeout
+    conn = Redis.from_url(redis_url)
+
+    while True:
+        try:
+            pubsub = conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    handle(message['data'])
+        except RedisError, err:
+            print "%s subscription failed: %r" % (name, err)
+
+        gevent.sleep(delay)
+
+
+class LocalCache():
+    """
+    Bounded in-process LRU cache whose entries also expire after a TTL
+    """
+
+    max_size = 1024
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()    # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return None
+
+        if entry[0] <= time.time():
+            return None
+
+        self.entries[key] = entry   # reinsert as most recently used
+        return entry[1]
+
+    def set(self, key, val, ttl):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + ttl, val)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class CacheHandler():
+    """
+    Two-tier cache: a small in-process LRU in front of the optional Redis.
+    Local entries live for at most local_ttl seconds, so workers can serve
+    slightly stale values but never diverge for long. invalidate() evicts a
+    key everywhere when an invalidation channel is configured.
+    """
+
+    FILL_LOCK_TIMEOUT = 30      # seconds a worker may hold a fill lock
+    FILL_POLL_INTERVAL = 0.1    # seconds between checks while another fills
+    RESUBSCRIBE_DELAY = 1       # seconds before resubscribing after an error
 
     redis_conn = None
+    local = None        # in-process LocalCache tier
+    local_ttl = 5       # seconds
+    invalidation_channel = None
+    invalidation_hooks = None   # callables run with each invalidated key
+    inflight = None     # key -> AsyncResult of a fill running in this process
+    stats = None        # tier hit/miss and single-flight counters
 
-    def __init__(self, redis_url):
+    def __init__(self, redis_url, local_size=1024, local_ttl=5,
+                 max_connections=50, pool_timeout=5, socket_timeout=None,
+                 invalidation_channel=None):
+
+        self.local = LocalCache(local_size)
+        self.local_ttl = local_ttl
+        self.invalidation_hooks = []
 
         if redis_url:
-            self.redis_conn = Redis.from_url(redis_url)
+            pool = BlockingConnectionPool.from_url(
+                redis_url, max_connections=max_connections,
+                timeout=pool_timeout, socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_timeout)
+            self.redis_conn = Redis(connection_pool=pool)
+
+            if invalidation_channel:
+                self.invalidation_channel = invalidation_channel
+                gevent.spawn(listen, redis_url, invalidation_channel,
+                             self.evict, 'Cache invalidation',
+                             self.RESUBSCRIBE_DELAY)
+
+        self.inflight = {}
+        self.stats = {
+            'local_hits': 0,
+            'local_misses': 0,
+            'redis_hits': 0,
+            'redis_misses': 0,
+            'invalidations': 0,
+            'coalesced_waits': 0,   # greenlets that waited on a local fill
+            'lock_waits': 0,        # fills that waited on another worker
+            'lock_timeouts': 0,     # waits that gave up on a stuck lock
+            'fetches': 0,
+            'fetch_errors': 0,
+            'fetch_seconds': 0.0,
+            'fetch_seconds_max': 0.0
+        }
 
     def get(self, key, default):
 
+        val = self.local.get(key)
+
+        if val is not None:
+            self.stats['local_hits'] += 1
+            return val
+
+        self.stats['local_misses'] += 1
+
         if self.redis_conn == None:
             return default
 
-        return self.redis_conn.get(key) or default
+        val = self.redis_conn.get(key)
+
+        if not val:
+            self.stats['redis_misses'] += 1
+            return default
+
+        self.stats['redis_hits'] += 1
+        self.local.set(key, val, self.local_ttl)
+
+        return val
 
     def set(self, key, val, expire=None):
 
+        self.local.set(key, val, min(self.local_ttl, expire or self.local_ttl))
+
         if self.redis_conn == None:
             return
 
@@ -25,3 +161,130 @@ class CacheHandler():
             self.redis_conn.set(key, val)
         else:
             self.redis_conn.setex(key, val, expire)
+
+    def invalidate(self, key):
+        """drop key from Redis and from the local tier of every worker"""
+
+        if self.redis_conn != None:
+            self.redis_conn.delete(key)
+
+            if self.invalidation_channel:
+                # our own subscription evicts it here too
+                self.redis_conn.publish(self.invalidation_channel, key)
+                return
+
+        self.evict(key)
+
+    def evict(self, key):
+
+        self.stats['invalidations'] += 1
+        self.local.delete(key)
+
+        for hook in self.invalidation_hooks:
+            hook(key)
+
+    def hit_ratios(self):
+        """fraction of lookups each tier answered, None before any lookup"""
+
+        def ratio(hits, misses):
+            total = self.stats[hits] + self.stats[misses]
+            return float(self.stats[hits]) / total if total else None
+
+        return {
+            'local': ratio('local_hits', 'local_misses'),
+            'redis': ratio('redis_hits', 'redis_misses')
+        }
+
+    def get_or_fill(self, key, fill, expire=None, lock_timeout=None):
+        """
+        Get key, calling fill() to produce and store it when it is missing.
+        Only one fill runs per key at a time: greenlets in this process wait
+        on the local fill, and other workers wait on a Redis lock and then
+        read what the lock holder stored.
+        """
+        value = self.get(key, None)
+
+        if value is not None:
+            return value
+
+        pending = self.inflight.get(key)
+
+        if pending is not None:
+            self.stats['coalesced_waits'] += 1
+            return pending.get()
+
+        pending = self.inflight[key] = AsyncResult()
+
+        try:
+            value = self.locked_fill(key, fill, expire,
+                                     lock_timeout or self.FILL_LOCK_TIMEOUT)
+        except Exception, err:
+            pending.set_exception(err)
+            raise
+        else:
+            pending.set(value)
+        finally:
+            del self.inflight[key]
+
+        return value
+
+    def locked_fill(self, key, fill, expire, lock_timeout):
+
+        if self.redis_conn == None:
+            return self.timed_fill(key, fill, expire)
+
+        lock_key = '%s-fill-lock' % key
+        token = uuid.uuid4().hex
+        deadline = time.time() + lock_timeout
+
+        if not self.redis_conn.set(lock_key, token, nx=True,
+                                   px=int(lock_timeout * 1000)):
+            self.stats['lock_waits'] += 1
+
+            while True:
+                gevent.sleep(self.FILL_POLL_INTERVAL)
+
+                value = self.get(key, None)
+                if value is not None:
+                    return value
+
+                if self.redis_conn.set(lock_key, token, nx=True,
+                                       px=int(lock_timeout * 1000)):
+                    break
+
+                if time.time() >= deadline:
+                    # the lock holder is stuck or slow, fill it ourselves
+                    self.stats['lock_timeouts'] += 1
+                    return self.timed_fill(key, fill, expire)
+
+        try:
+            # another worker may have stored it before we got the lock
+            value = self.get(key, None)
+            if value is not None:
+                return value
+
+            return self.timed_fill(key, fill, expire)
+        finally:
+            # only release our own lock, it may have expired and moved on
+            if self.redis_conn.get(lock_key) == token:
+                self.redis_conn.delete(lock_key)
+
+    def timed_fill(self, key, fill, expire):
+
+        start = time.time()
+
+        try:
+            value = fill()
+        except Exception:
+            self.stats['fetch_errors'] += 1
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.stats['fetches'] += 1
+            self.stats['fetch_seconds'] += elapsed
+            self.stats['fetch_seconds_max'] = max(
+                self.stats['fetch_seconds_max'], elapsed)
+
+        self.set(key, value, expire)
+
+        return value
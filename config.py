@@ -21,6 +21,51 @@ class Config(object):
 
     REDIS_URL = os.environ.get('REDIS_URL') or None # JL NOTE ~ optional
 
+    # in-process cache tier in front of Redis, entries and seconds
+    CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE', 1024))
+    CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL', 5))
+
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+    REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+    REDIS_SOCKET_TIMEOUT = int(os.environ.get('REDIS_SOCKET_TIMEOUT', 2))
+
+    # pub/sub channel used to evict invalidated keys in every worker
+    CACHE_INVALIDATION_CHANNEL = os.environ.get('CACHE_INVALIDATION_CHANNEL')
+
+    # 'dict' keeps districts in memory, 'mmap' shares data/districts.bin
+    DISTRICTS_BACKEND = os.environ.get('DISTRICTS_BACKEND', 'dict')
+
+    # 'postgres' counts recent calls with queries on every call, 'window'
+    # keeps sliding windows in Redis (or in process without REDIS_URL)
+    THROTTLE_BACKEND = os.environ.get('THROTTLE_BACKEND', 'postgres')
+
+    # seconds between the window throttle's blacklist reloads, a number
+    # newly blacklisted in the table gets through for up to this long
+    THROTTLE_BLACKLIST_REFRESH = int(
+        os.environ.get('THROTTLE_BLACKLIST_REFRESH', 60))
+
+    # connections per worker to the throttle database
+    THROTTLE_POOL_SIZE = int(os.environ.get('THROTTLE_POOL_SIZE', 10))
+
+    # log throttled calls in batches from the background, not per request
+    THROTTLE_WRITE_BEHIND = strtobool(
+        os.environ.get('THROTTLE_WRITE_BEHIND', 'true'))
+
+    # log calls to the calls table, in batches from the background
+    CALL_LOGGING = strtobool(os.environ.get('CALL_LOGGING', 'false'))
+
+    # calls are appended here while the database is down
+    CALL_LOG_SPOOL = os.environ.get('CALL_LOG_SPOOL', 'data/calls.spool')
+
+    # seconds before a call log connect or insert gives up and spools
+    CALL_LOG_CONNECT_TIMEOUT = int(
+        os.environ.get('CALL_LOG_CONNECT_TIMEOUT', 5))
+    CALL_LOG_STATEMENT_TIMEOUT = int(
+        os.environ.get('CALL_LOG_STATEMENT_TIMEOUT', 10))
+
+    # /live_feed viewers per worker, each holds one of uwsgi's gevent cores
+    LIVE_FEED_MAX_CLIENTS = int(os.environ.get('LIVE_FEED_MAX_CLIENTS', 20))
+
     # limit on the length of the call
     TW_TIME_LIMIT = 60 * 20  # 4 minutes
 
@@ -30,6 +75,19 @@ class Config(object):
     # number of threads to limit asynchronous leaderboard requests
     FFTF_LB_ASYNC_POOL_SIZE = 8
 
+    # leaderboard events waiting to be sent before new ones are dropped
+    FFTF_LB_QUEUE_SIZE = int(os.environ.get('FFTF_LB_QUEUE_SIZE', 1000))
+
+    # optional endpoints taking a JSON list of events, batching is off
+    # unless they are set
+    FFTF_LB_BATCH_URL = os.environ.get('FFTF_LB_BATCH_URL')
+    FFTF_CALL_LOG_BATCH_URL = os.environ.get('FFTF_CALL_LOG_BATCH_URL')
+
+    # SQLite file events wait in until delivered, ':memory:' keeps them in
+    # memory, lost on restart
+    FFTF_SPOOL_PATH = os.environ.get('FFTF_SPOOL_PATH',
+                                     'data/fftf_events.sqlite')
+
     # only used for FFTF extra call data logging
     FFTF_CALL_LOG_API_KEY = os.environ.get('FFTF_CALL_LOG_API_KEY')
 
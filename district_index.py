@@ -0,0 +1,215 @@
+"""
+Zipcode -> congressional district lookups. Every index has the same small
+interface: lookup(zipcode) returns the District records for a zipcode in
+districts.csv order, and iterating the index yields every District.
+"""
+import mmap
+import os
+import struct
+import tempfile
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from records import District
+
+
+def is_zipcode(zipcode):
+    return len(zipcode) == 5 and zipcode.isdigit()
+
+
+def pack_record(district):
+    """
+    (zipcode, state, district number) of a District as the packed indexes
+    store them, or ValueError if it wouldn't read back the same
+    """
+    zipcode = district.zipcode
+    state = district.state
+    district_number = district.district_number
+
+    if not is_zipcode(zipcode) or len(state) != 2 or \
+            not district_number.isdigit() or \
+            str(int(district_number)) != district_number:
+        raise ValueError('Cannot pack %r' % district)
+
+    return zipcode, state, int(district_number)
+
+
+class DictDistricts(object):
+    """
+    Districts held as records in a zipcode-keyed dict. Fastest lookups, but
+    one Python object per row in every process.
+    """
+
+    def __init__(self, districts):
+        self.districts = districts
+        self.by_zipcode = {}
+
+        for district in districts:
+            # a zipcode can span several districts, so index them all
+            self.by_zipcode.setdefault(district.zipcode, []).append(district)
+
+    def lookup(self, zipcode):
+        return self.by_zipcode.get(str(zipcode), [])
+
+    def __iter__(self):
+        return iter(self.districts)
+
+    def __len__(self):
+        return len(self.districts)
+
+
+class PackedDistricts(object):
+    """
+    Districts packed into three flat arrays sorted by zipcode, searched with
+    bisect. The arrays are a handful of large objects holding no pointers,
+    so when they are built in the uWSGI master before forking, reference
+    counting and garbage collection in the workers never write to their
+    pages and they stay shared copy-on-write.
+    """
+
+    def __init__(self, districts):
+        # stable sort, so districts sharing a zipcode keep their file order
+        records = [pack_record(district) for district in
+                   sorted(districts, key=lambda d: d.zipcode)]
+
+        self.zipcodes = array('i', (int(r[0]) for r in records))
+        self.states = ''.join(r[1] for r in records)
+        self.district_numbers = array('h', (r[2] for r in records))
+
+    def record(self, i):
+        return District('%05d' % self.zipcodes[i],
+                        self.states[2 * i:2 * i + 2],
+                        str(self.district_numbers[i]))
+
+    def lookup(self, zipcode):
+        zipcode = str(zipcode)
+
+        if not is_zipcode(zipcode):
+            return []
+
+        key = int(zipcode)
+        start = bisect_left(self.zipcodes, key)
+        end = bisect_right(self.zipcodes, key, start)
+
+        return [self.record(i) for i in xrange(start, end)]
+
+    def __iter__(self):
+        return (self.record(i) for i in xrange(len(self.zipcodes)))
+
+    def __len__(self):
+        return len(self.zipcodes)
+
+
+class MmapDistricts(object):
+    """
+    Districts in a sorted, fixed-width binary file read through mmap. A
+    lookup binary searches the zipcode column and decodes only the matching
+    records, so every worker shares the file through the page cache with
+    next to nothing on its own heap.
+
+    The file is a header (magic, format version, sha1 of the source CSV,
+    record count) followed by records of a 5 byte ASCII zipcode, a 2 byte
+    state and an unsigned short district number.
+    """
+
+    MAGIC = 'CCZD'
+    VERSION = 1
+    HEADER = struct.Struct('<4sH40sI')
+    RECORD = struct.Struct('<5s2sH')
+
+    def __init__(self, f):
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.checksum, self.count = self.read_header(self.mm)
+
+    @classmethod
+    def read_header(cls, buf):
+        magic, version, checksum, count = cls.HEADER.unpack_from(buf, 0)
+
+        if magic != cls.MAGIC or version != cls.VERSION or \
+                len(buf) != cls.HEADER.size + count * cls.RECORD.size:
+            raise ValueError('Not a district index file')
+
+        return checksum.rstrip('\0'), count
+
+    @classmethod
+    def build(cls, districts, checksum, path):
+        """write districts to path, checksum identifies their source"""
+        # stable sort, so districts sharing a zipcode keep their file order
+        districts = sorted(districts, key=lambda d: d.zipcode)
+
+        # a temp file of our own, other workers may be building it too
+        f = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False)
+
+        try:
+            with f:
+                f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, checksum,
+                                        len(districts)))
+
+                for district in districts:
+                    f.write(cls.RECORD.pack(*pack_record(district)))
+
+            # NamedTemporaryFile is only readable by us
+            os.chmod(f.name, 0644)
+
+            # rename into place, workers may be opening it concurrently
+            os.rename(f.name, path)
+        except Exception:
+            os.remove(f.name)
+            raise
+
+    @classmethod
+    def open(cls, path, checksum):
+        """
+        open the index at path, or return None if it is missing, corrupt or
+        was built from a different source than checksum
+        """
+        try:
+            with open(path, 'rb') as f:
+                index = cls(f)
+        except (IOError, ValueError, struct.error, mmap.error):
+            return None
+
+        if index.checksum != checksum:
+            return None
+
+        return index
+
+    def zipcode_at(self, i):
+        offset = self.HEADER.size + i * self.RECORD.size
+        return self.mm[offset:offset + 5]
+
+    def record(self, i):
+        zipcode, state, district_number = self.RECORD.unpack_from(
+            self.mm, self.HEADER.size + i * self.RECORD.size)
+        return District(zipcode, state, str(district_number))
+
+    def lookup(self, zipcode):
+        zipcode = str(zipcode)
+
+        if not is_zipcode(zipcode):
+            return []
+
+        # binary search for the first record with this zipcode
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.zipcode_at(middle) < zipcode:
+                low = middle + 1
+            else:
+                high = middle
+
+        districts = []
+        while low < self.count and self.zipcode_at(low) == zipcode:
+            districts.append(self.record(low))
+            low += 1
+
+        return districts
+
+    def __iter__(self):
+        return (self.record(i) for i in xrange(self.count))
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,130 @@
+"""
+SQLite spool of outbound events, so they survive a slow or down endpoint
+and a restart. Every worker can share one spool file: take() leases rows
+in an immediate transaction, so two drainers never send the same event.
+"""
+import json
+import random
+import sqlite3
+import time
+
+import gevent
+
+
+class EventSpool():
+    """
+    Events wait in the spool until done() removes them. take() leases due
+    events for LEASE seconds, retry() pushes one back with exponential
+    backoff. An idempotency key, when given, is stored once however many
+    times the event is appended.
+    """
+
+    LEASE = 30              # seconds a taken event stays hidden
+    BASE_BACKOFF = 1        # seconds before the first retry
+    MAX_BACKOFF = 300       # seconds
+    LOCKED_ATTEMPTS = 5     # tries at a write another worker has locked
+    LOCKED_WAIT = 0.01      # seconds, doubled after every try
+
+    path = ':memory:'
+
+    def __init__(self, path):
+        self.path = path
+        # no busy timeout, SQLite would block the whole gevent worker while
+        # it waits out a lock, execute() waits in a greenlet instead
+        self.conn = sqlite3.connect(path, timeout=0, isolation_level=None)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+        self.execute("CREATE TABLE IF NOT EXISTS events ("
+                     "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                     "  endpoint TEXT NOT NULL,"
+                     "  idempotency_key TEXT UNIQUE,"
+                     "  payload TEXT NOT NULL,"
+                     "  created REAL NOT NULL,"
+                     "  attempts INTEGER NOT NULL DEFAULT 0,"
+                     "  next_attempt REAL NOT NULL)")
+        self.execute("CREATE INDEX IF NOT EXISTS events_due "
+                     "ON events (endpoint, next_attempt)")
+
+    def execute(self, sql, args=()):
+        """conn.execute, retried while another worker holds the write lock"""
+        for attempt in range(self.LOCKED_ATTEMPTS):
+            try:
+                return self.conn.execute(sql, args)
+            except sqlite3.OperationalError, err:
+                if 'locked' not in str(err) or \
+                        attempt == self.LOCKED_ATTEMPTS - 1:
+                    raise
+
+                gevent.sleep(self.LOCKED_WAIT * 2 ** attempt)
+
+    def append(self, endpoint, data, idempotency_key=None):
+        """spool an event, returns False if its key was spooled already"""
+        now = time.time()
+        cur = self.execute(
+            "INSERT OR IGNORE INTO events "
+            "(endpoint, idempotency_key, payload, created, next_attempt) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (endpoint, idempotency_key, json.dumps(data), now, now))
+
+        return cur.rowcount == 1
+
+    def take(self, endpoint, limit):
+        """lease up to limit due events: (id, key, data, attempts, created)"""
+        now = time.time()
+
+        self.execute("BEGIN IMMEDIATE")
+
+        try:
+            rows = self.conn.execute(
+                "SELECT id, idempotency_key, payload, attempts, created "
+                "FROM events WHERE endpoint = ? AND next_attempt <= ? "
+                "ORDER BY id LIMIT ?", (endpoint, now, limit)).fetchall()
+
+            self.conn.executemany(
+                "UPDATE events SET next_attempt = ? WHERE id = ?",
+                [(now + self.LEASE, row[0]) for row in rows])
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        self.conn.execute("COMMIT")
+
+        return [(row_id, key, json.loads(payload), attempts, created)
+                for row_id, key, payload, attempts, created in rows]
+
+    def done(self, event_id):
+        self.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def retry(self, event_id, attempts):
+        """try again after a backoff that doubles with every attempt"""
+        backoff = min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** attempts)
+        backoff *= random.uniform(0.5, 1)    # don't retry in lockstep
+
+        self.execute(
+            "UPDATE events SET attempts = ?, next_attempt = ? WHERE id = ?",
+            (attempts + 1, time.time() + backoff, event_id))
+
+    def expire(self, endpoint, max_age):
+        """drop events older than max_age seconds, returns how many"""
+        cur = self.execute(
+            "DELETE FROM events WHERE endpoint = ? AND created < ?",
+            (endpoint, time.time() - max_age))
+
+        return cur.rowcount
+
+    def endpoints(self):
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT endpoint FROM events")]
+
+    def depth(self, endpoint):
+        return self.conn.execute(
+            "SELECT count(*) FROM events WHERE endpoint = ?",
+            (endpoint,)).fetchone()[0]
+
+    def lag(self, endpoint):
+        """age in seconds of the oldest waiting event, 0 when empty"""
+        oldest = self.conn.execute(
+            "SELECT min(created) FROM events WHERE endpoint = ?",
+            (endpoint,)).fetchone()[0]
+
+        return time.time() - oldest if oldest else 0
@@ -1,19 +1,232 @@
 import hashlib
 import json
-import grequests
+import os
+import sqlite3
 import string
 
+import gevent
+import requests
+
+from gevent.event import Event
+from gevent.pool import Pool
+from requests.adapters import HTTPAdapter
+
+from event_spool import EventSpool
+
 class FFTFLeaderboard():
+    """
+    Posts call events to the FFTF leaderboard and call log queue. Events
+    go to an EventSpool first, so a webhook only ever waits on a local
+    SQLite insert, and a drainer greenlet per endpoint sends them through
+    that endpoint's own pool of pool_size greenlets and a keep-alive
+    requests.Session. Failed posts are retried with exponential backoff
+    until they are MAX_AGE old; 4xx answers other than 408 and 429 are not
+    retried. Once queue_size events wait for an endpoint new ones are
+    dropped.
+
+    Events carry an idempotency key derived from the CallSid, sent as the
+    Idempotency-Key header, so retries and repeated Twilio webhooks are
+    only spooled and counted once.
+
+    batch_urls optionally maps an endpoint to a batch endpoint. Events for
+    it are then sent BATCH_SIZE at a time, as a JSON list, to that URL.
+    """
+
+    LEADERBOARD_URL = 'https://leaderboard.fightforthefuture.org/log'
+    QUEUE_URL = 'https://queue.fightforthefuture.org/log_phone_call'
+
+    BATCH_SIZE = 50
+    BATCH_WAIT = 0.5        # seconds to wait for a batch to fill
+    REQUEST_TIMEOUT = 10    # seconds
+    POLL_INTERVAL = 1       # seconds between looks for events due a retry
+    MAX_AGE = 60 * 60 * 24  # seconds before an undelivered event is dropped
 
     debug_mode = False
     pool_size = 1
     api_key = None
 
-    def __init__(self, debug_mode, pool_size, api_key):
+    def __init__(self, debug_mode, pool_size, api_key, queue_size=1000,
+                 batch_urls=None, spool_path=None):
 
         self.debug_mode = debug_mode
         self.pool_size = pool_size
         self.api_key = api_key
+        self.queue_size = queue_size
+        self.batch_urls = batch_urls or {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # without a path (config.py sets one) events are lost on restart,
+        # but still retried
+        self.spool_path = spool_path or ':memory:'
+        self.spool = None       # opened by the first event, see open_spool
+        self.pools = {}         # endpoint -> Pool limiting its posts
+        self.wakeups = {}       # endpoint -> Event set when one is spooled
+        self.stats = {
+            'sent': 0,
+            'batches': 0,
+            'failed': 0,        # attempts, each is retried
+            'rejected': 0,      # 4xx answers, not retried
+            'duplicates': 0,
+            'dropped': 0,
+            'expired': 0
+        }
+
+        # pick up what the last run left behind
+        if os.path.exists(self.spool_path):
+            for url in self.open_spool().endpoints():
+                self.start_drainer(url)
+
+    def open_spool(self):
+        """the EventSpool, only created once there is something to send"""
+        if self.spool is None:
+            self.spool = EventSpool(self.spool_path)
+
+        return self.spool
+
+    def start_drainer(self, url):
+
+        if url not in self.pools:
+            self.pools[url] = Pool(self.pool_size)
+            self.wakeups[url] = Event()
+            gevent.spawn(self.drain, url)
+
+    def enqueue(self, url, data, idempotency_key=None):
+
+        try:
+            self.open_spool()
+            self.start_drainer(url)
+
+            if self.spool.depth(url) >= self.queue_size:
+                self.stats['dropped'] += 1
+                print "FFTF event dropped, %s is falling behind" % url
+                return
+
+            spooled = self.spool.append(url, data, idempotency_key)
+        except sqlite3.Error, err:
+            # never fail the webhook over the leaderboard
+            self.stats['dropped'] += 1
+            print "FFTF event dropped, spooling it failed: %r" % err
+            return
+
+        if spooled:
+            self.wakeups[url].set()
+        else:
+            self.stats['duplicates'] += 1
+
+    def drain(self, url):
+
+        pool = self.pools[url]
+        wakeup = self.wakeups[url]
+        batch_url = self.batch_urls.get(url)
+
+        while True:
+            # never take events there is no room to send right away
+            pool.wait_available()
+
+            try:
+                if batch_url:
+                    events = self.spool.take(url, self.BATCH_SIZE)
+                else:
+                    events = self.spool.take(url, pool.free_count())
+
+                expired = 0 if events else \
+                    self.spool.expire(url, self.MAX_AGE)
+            except sqlite3.Error, err:
+                print "FFTF spool read for %s failed: %r" % (url, err)
+                gevent.sleep(self.POLL_INTERVAL)
+                continue
+
+            if not events:
+
+                if expired:
+                    self.stats['expired'] += expired
+                    print "FFTF dropped %d events older than a day for %s" % (
+                        expired, url)
+
+                wakeup.clear()
+                wakeup.wait(self.POLL_INTERVAL)
+
+                if batch_url and wakeup.is_set():
+                    gevent.sleep(self.BATCH_WAIT)   # let the batch fill
+                continue
+
+            if batch_url:
+                pool.spawn(self.send, batch_url, events, True)
+            else:
+                for event in events:
+                    pool.spawn(self.send, url, [event], False)
+
+    def send(self, url, events, batch):
+
+        keys = [key for event_id, key, data, attempts, created in events
+                if key]
+        headers = {'Idempotency-Key': ','.join(keys)} if keys else {}
+
+        try:
+            if batch:
+                headers['Content-Type'] = 'application/json'
+                res = self.session.post(
+                    url, data=json.dumps([event[2] for event in events]),
+                    timeout=self.REQUEST_TIMEOUT, headers=headers)
+            else:
+                res = self.session.post(url, data=events[0][2],
+                                        timeout=self.REQUEST_TIMEOUT,
+                                        headers=headers)
+
+            res.raise_for_status()
+        except requests.RequestException, err:
+            status = getattr(err.response, 'status_code', None)
+
+            if status and 400 <= status < 500 and status not in (408, 429):
+                self.stats['rejected'] += len(events)
+                print "FFTF post to %s rejected: %r" % (url, err)
+
+                for event in events:
+                    self.spool.done(event[0])
+                return
+
+            self.stats['failed'] += len(events)
+            print "FFTF post to %s failed, will retry: %r" % (url, err)
+
+            for event_id, key, data, attempts, created in events:
+                self.spool.retry(event_id, attempts)
+            return
+
+        for event in events:
+            self.spool.done(event[0])
+
+        self.stats['sent'] += len(events)
+
+        if batch:
+            self.stats['batches'] += 1
+
+        if self.debug_mode:
+            print "FFTF post to %s complete: %s" % (url, res)
+
+    def metrics(self):
+        """stats, plus how many events wait and for how long per endpoint"""
+        return {
+            'stats': self.stats,
+            'endpoints': dict((url, {
+                'depth': self.spool.depth(url),
+                'lag': self.spool.lag(url),
+                'sending': len(pool)
+            }) for url, pool in self.pools.iteritems())
+        }
+
+    def idempotency_key(self, request, *parts):
+        """same CallSid and parts, same key, None without a CallSid"""
+        call_sid = request.values.get('CallSid')
+
+        if not call_sid:
+            return None
+
+        return hashlib.sha1(':'.join(
+            [call_sid] + [str(part) for part in parts])).hexdigest()
 
     def log_call(self, params, campaign, request):
 
@@ -38,7 +251,8 @@ class FFTFLeaderboard():
             'call',
             data,
             params['fftfReferer'],
-            params['fftfSession'])
+            params['fftfSession'],
+            self.idempotency_key(request, 'call', i))
 
     def log_complete(self, params, campaign, request):
 
@@ -50,15 +264,11 @@ class FFTFLeaderboard():
             'calls_complete',
             'yay',
             params['fftfReferer'],
-            params['fftfSession'])
-
-    def post_to_leaderboard(self, fftf_campaign, stat, data, host, session):
+            params['fftfSession'],
+            self.idempotency_key(request, 'calls_complete'))
 
-        debug_mode = self.debug_mode
-
-        def finished(res, **kwargs):
-            if debug_mode:
-                print "FFTF Leaderboard call complete: %s" % res
+    def post_to_leaderboard(self, fftf_campaign, stat, data, host, session,
+                            idempotency_key=None):
 
         data = {
             'campaign': fftf_campaign,
@@ -71,20 +281,10 @@ class FFTFLeaderboard():
         if self.debug_mode:
             print "FFTF Leaderboard sending: %s" % data
 
-        url = 'https://leaderboard.fightforthefuture.org/log'
-        req = grequests.post(url, data=data, hooks=dict(response=finished))
-        job = grequests.send(req, grequests.Pool(self.pool_size))
-
-        return
+        self.enqueue(self.LEADERBOARD_URL, data, idempotency_key)
 
     def log_extra_data(self, params, campaign, request, to_phone, call_index):
 
-        debug_mode = self.debug_mode
-
-        def finished(res, **kwargs):
-            if debug_mode:
-                print "FFTF Extra Data log call complete: %s" % res
-
         ip = hashlib.sha256(request.values.get("ip_address", "")).hexdigest()
 
         user_phone = params.get('userPhone', None)
@@ -106,8 +306,5 @@ class FFTFLeaderboard():
         if self.debug_mode:
             print "FFTF Log Extra Data sending: %s" % data
 
-        url = 'https://queue.fightforthefuture.org/log_phone_call'
-        req = grequests.post(url, data=data, hooks=dict(response=finished))
-        job = grequests.send(req, grequests.Pool(self.pool_size))
-
-        return
\ No newline at end of file
+        self.enqueue(self.QUEUE_URL, data,
+                     self.idempotency_key(request, 'extra', call_index))
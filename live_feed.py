@@ -0,0 +1,206 @@
+"""
+Fans call events out to the /live dashboards over server-sent events. With
+a Redis URL events go through a pub/sub channel, so every worker's viewers
+see calls made through any worker; without one only calls made through
+this worker are seen.
+"""
+import json
+import time
+
+import gevent
+
+from collections import deque
+from gevent.queue import Empty, Full, Queue
+from redis import Redis, RedisError
+
+from cache_handler import listen
+
+
+class LiveFeed():
+    """
+    Each viewer gets a queue of QUEUE_SIZE events. A viewer that falls that
+    far behind is dropped, its stream ends and EventSource reconnects it,
+    so a slow connection can't hold events in memory. New viewers are sent
+    the campaign's last RECENT calls first.
+
+    Calls are only published for campaigns that are watched(), so nobody
+    builds events no viewer will see. A campaign stays watched for
+    WATCHED_TTL seconds after its last viewer leaves, so the recent calls
+    are there when they come back. With Redis, workers mark the campaigns
+    their viewers watch in a key, which the others check every
+    WATCHED_CHECK seconds.
+    """
+
+    QUEUE_SIZE = 100
+    RECENT = 10
+    KEEPALIVE = 15          # seconds between comments on an idle stream
+    RESUBSCRIBE_DELAY = 1   # seconds
+    WATCHED_TTL = 300       # seconds
+    WATCHED_CHECK = 5       # seconds between looks at the Redis key
+
+    redis_conn = None
+    channel = 'live-calls'
+    max_clients = 20
+
+    def __init__(self, redis_url=None, channel='live-calls', max_clients=20):
+        self.channel = channel
+        self.max_clients = max_clients
+        self.clients = {}   # campaign id -> set of viewer queues
+        self.recent = {}    # campaign id -> deque of its last events
+        self.watched_until = {}     # campaign id -> time it stops being
+        self.checked = {}   # campaign id -> (time, watched) from Redis
+        self.stats = {
+            'published': 0,
+            'delivered': 0,
+            'dropped_clients': 0,
+            'refused_clients': 0
+        }
+
+        if redis_url:
+            self.redis_conn = Redis.from_url(redis_url, socket_timeout=2)
+            gevent.spawn(listen, redis_url, channel, self.receive,
+                         'Live feed', self.RESUBSCRIBE_DELAY)
+
+    def watched_key(self, campaign_id):
+        return '%s:watched:%s' % (self.channel, campaign_id)
+
+    def watch(self, campaign_id):
+        """mark a campaign as watched for the next WATCHED_TTL seconds"""
+
+        self.watched_until[campaign_id] = time.time() + self.WATCHED_TTL
+
+        if self.redis_conn:
+            try:
+                self.redis_conn.set(self.watched_key(campaign_id), '1',
+                                    ex=self.WATCHED_TTL)
+            except RedisError, err:
+                print "Live feed watch failed: %r" % err
+
+    def watched(self, campaign_id):
+        """whether a viewer, on any worker, may want the campaign's calls"""
+
+        now = time.time()
+
+        if campaign_id in self.clients or \
+                self.watched_until.get(campaign_id, 0) > now:
+            return True
+
+        if not self.redis_conn:
+            return False
+
+        checked, watched = self.checked.get(campaign_id, (0, False))
+
+        if now - checked < self.WATCHED_CHECK:
+            return watched
+
+        try:
+            watched = bool(self.redis_conn.exists(
+                self.watched_key(campaign_id)))
+        except RedisError, err:
+            print "Live feed watch check failed: %r" % err
+            watched = False
+
+        self.checked[campaign_id] = (now, watched)
+
+        return watched
+
+    def publish(self, campaign_id, event):
+
+        self.stats['published'] += 1
+
+        if not self.redis_conn:
+            self.deliver(campaign_id, event)
+            return
+
+        try:
+            self.redis_conn.publish(self.channel,
+                                    json.dumps([campaign_id, event]))
+        except RedisError, err:
+            print "Live feed publish failed: %r" % err
+
+    def receive(self, data):
+        """deliver an event published by any worker"""
+
+        self.deliver(*json.loads(data))
+
+    def deliver(self, campaign_id, event):
+
+        recent = self.recent.get(campaign_id)
+
+        if recent is None:
+            recent = self.recent[campaign_id] = deque(maxlen=self.RECENT)
+
+        recent.append(event)
+
+        for queue in list(self.clients.get(campaign_id, ())):
+            try:
+                queue.put_nowait(event)
+                self.stats['delivered'] += 1
+            except Full:
+                self.drop(campaign_id, queue)
+
+    def drop(self, campaign_id, queue):
+        """disconnect a viewer that stopped keeping up"""
+
+        self.unsubscribe(campaign_id, queue)
+        self.stats['dropped_clients'] += 1
+
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                break
+
+        queue.put_nowait(None)      # ends its stream
+
+    def subscribe(self, campaign_id):
+        """a queue of the campaign's events, None if there's no room"""
+
+        if sum(len(queues) for queues in self.clients.itervalues()) >= \
+                self.max_clients:
+            self.stats['refused_clients'] += 1
+            return None
+
+        queue = Queue(self.QUEUE_SIZE)
+
+        for event in self.recent.get(campaign_id, ()):
+            queue.put_nowait(event)
+
+        self.clients.setdefault(campaign_id, set()).add(queue)
+        self.watch(campaign_id)
+
+        return queue
+
+    def unsubscribe(self, campaign_id, queue):
+
+        queues = self.clients.get(campaign_id, set())
+        queues.discard(queue)
+
+        if not queues:
+            self.clients.pop(campaign_id, None)
+
+    def stream(self, campaign_id, queue):
+        """text/event-stream body for a subscribed queue"""
+
+        try:
+            yield 'retry: 5000\n\n'
+
+            while True:
+                # keep the campaign marked while it's being watched
+                if self.watched_until.get(campaign_id, 0) < \
+                        time.time() + self.WATCHED_TTL / 2:
+                    self.watch(campaign_id)
+
+                try:
+                    event = queue.get(timeout=self.KEEPALIVE)
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event is None:
+                    return
+
+                yield 'event: call\ndata: %s\n\n' % json.dumps(event)
+        finally:
+            # the viewer went away, or was dropped
+            self.unsubscribe(campaign_id, queue)
@@ -1,16 +1,32 @@
 import hashlib
+import json
 import logging
+import os
+import random
+
+import gevent
 
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, Column, Integer, String, DateTime
-from sqlalchemy.exc import SQLAlchemyError
+from collections import Counter
+from sqlalchemy import (create_engine, func, inspect, select, text, Column,
+                        DateTime, Index, Integer, String)
+from sqlalchemy.exc import (DataError, IntegrityError, OperationalError,
+                            SQLAlchemyError)
+
+from write_behind import WriteBehind
 
 db = SQLAlchemy()
 
 
 class Call(db.Model):
     __tablename__ = 'calls'
+    __table_args__ = (
+        # call_list's campaign filter and newest first order, id breaks ties
+        # in timestamp for its cursors
+        Index('ix_calls_campaign_id_timestamp', 'campaign_id', 'timestamp',
+              'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime)
@@ -57,43 +73,417 @@ class Call(db.Model):
             self.areacode, self.exchange, self.member_id)
 
 
+class CallCount(db.Model):
+    """
+    Calls with a zipcode per campaign, kept up to date as calls are
+    inserted so /count doesn't count the calls table
+    """
+    __tablename__ = 'call_counts'
+
+    campaign_id = Column(String(32), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+
+
+class ZipcodeHour(db.Model):
+    """calls per campaign and zipcode in each hour, for /stats"""
+    __tablename__ = 'call_zipcode_hours'
+
+    campaign_id = Column(String(32), primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    zipcode = Column(String(5), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+
+
+class MemberHour(db.Model):
+    """calls per campaign and member in each hour, for /stats"""
+    __tablename__ = 'call_member_hours'
+
+    campaign_id = Column(String(32), primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    member_id = Column(String(10), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+
+
+def new_call(params, campaign, request):
+    i = int(request.values.get('call_index', 0))
+    rep_ids = params['repIds']
+
+    kwds = {
+        'campaign_id': campaign['id'],
+        'member_id': rep_ids[i] if i < len(rep_ids) else None,
+        'zipcode': params['user_zipcode'],
+        'phone_number': params['userPhone'],
+        'call_id': request.values.get('CallSid', None),
+        'status': request.values.get('DialCallStatus', 'unknown'),
+        'duration': request.values.get('DialCallDuration', 0)
+    }
+
+    return Call(**kwds)
+
+
+def call_row(call):
+    """
+    a Call as the column dict insert_calls takes, with strings cut to fit
+    their columns so Postgres doesn't refuse the batch they're in
+    """
+    row = {}
+
+    for column in Call.__table__.columns:
+        if column.name == 'id':
+            continue
+
+        value = getattr(call, column.name)
+        length = getattr(column.type, 'length', None)
+
+        if isinstance(value, basestring) and length and len(value) > length:
+            if column.name == 'member_id':
+                # special calls' ids are S_ and their JSON, keep them apart
+                value = value[:2] + hashlib.sha1(value).hexdigest()[
+                    :length - 2]
+            else:
+                value = value[:length]
+
+        row[column.name] = value
+
+    return row
+
+
+def hour_of(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def rollups(rows):
+    """
+    (table, key columns, calls) of every counter rows add to: call_counts,
+    and the hourly rollups by zipcode and by member
+    """
+    counts = Counter()
+
+    for row in rows:
+        campaign_id, hour = row['campaign_id'], hour_of(row['timestamp'])
+
+        # like call_count always did, calls without a zipcode don't count
+        if row['zipcode']:
+            counts[CallCount.__table__, (('campaign_id', campaign_id),)] += 1
+            counts[ZipcodeHour.__table__, (('campaign_id', campaign_id),
+                                           ('hour', hour),
+                                           ('zipcode', row['zipcode']))] += 1
+
+        if row['member_id']:
+            counts[MemberHour.__table__, (('campaign_id', campaign_id),
+                                          ('hour', hour),
+                                          ('member_id',
+                                           row['member_id']))] += 1
+
+    # every batch locks the counter rows it touches in the same order, so
+    # two of them can't deadlock
+    return [(table, dict(key), n) for (table, key), n in sorted(
+        counts.iteritems(), key=lambda count: (count[0][0].name, count[0][1]))]
+
+
+def increment(conn, table, key, n):
+    """add n to the calls column of table's row for key, creating it"""
+    if conn.dialect.name == 'postgresql':
+        # one statement, so two batches can't both find no row and insert it
+        quote = conn.dialect.identifier_preparer.quote
+        columns = sorted(key)
+
+        conn.execute(text(
+            'INSERT INTO {table} ({columns}, calls) VALUES ({values}, :calls) '
+            'ON CONFLICT ({columns}) DO UPDATE '
+            'SET calls = {table}.calls + EXCLUDED.calls'.format(
+                table=quote(table.name),
+                columns=', '.join(quote(column) for column in columns),
+                values=', '.join(':' + column for column in columns))),
+            calls=n, **key)
+        return
+
+    # SQLite takes one writer at a time, the UPDATE holds the others off
+    where = [table.c[column] == value for column, value in key.iteritems()]
+    updated = conn.execute(table.update().where(db.and_(*where))
+                           .values(calls=table.c.calls + n))
+
+    if not updated.rowcount:
+        conn.execute(table.insert(), calls=n, **key)
+
+
+def insert_calls(conn, rows):
+    """
+    Insert call rows and count them, inside the caller's transaction so
+    the counters and rollups never drift from the table
+    """
+    conn.execute(Call.__table__.insert(), rows)
+
+    for table, key, n in rollups(rows):
+        increment(conn, table, key, n)
+
+
+# Postgres' serialization failure and deadlock codes, the transaction can
+# just be run again
+RETRIED_PGCODES = ('40001', '40P01')
+INSERT_ATTEMPTS = 3
+
+
+def insert_with_retries(engine, rows):
+    """
+    insert_calls in a transaction of its own, run again when Postgres
+    aborts it for conflicting with another
+    """
+    for attempt in range(INSERT_ATTEMPTS):
+        try:
+            with engine.begin() as conn:
+                insert_calls(conn, rows)
+            return
+        except OperationalError, err:
+            if attempt == INSERT_ATTEMPTS - 1 or getattr(
+                    err.orig, 'pgcode', None) not in RETRIED_PGCODES:
+                raise
+
+            logging.warning('Retrying calls insert: %r' % err.orig)
+            gevent.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
 def log_call(params, campaign, request):
     try:
-        i = int(request.values.get('call_index'))
-
-        kwds = {
-            'campaign_id': campaign['id'],
-            'member_id': params['repIds'][i],
-            'zipcode': params['zipcode'],
-            'phone_number': params['userPhone'],
-            'call_id': request.values.get('CallSid', None),
-            'status': request.values.get('DialCallStatus', 'unknown'),
-            'duration': request.values.get('DialCallDuration', 0)
-        }
-
-        db.session.add(Call(**kwds))
-        db.session.commit()
+        insert_with_retries(
+            db.engine, [call_row(new_call(params, campaign, request))])
     except SQLAlchemyError:
         logging.error('Failed to log call:', exc_info=True)
 
 
+def call_log_engine(url, connect_timeout=5, statement_timeout=10):
+    """
+    An engine for CallLog's background inserts. On Postgres psycopg2 is
+    made green first, so a slow insert yields to requests instead of
+    blocking the worker, and connects and statements time out (seconds)
+    so a hung database fails the batch into the spool.
+    """
+    if not url.startswith('postgres'):
+        return create_engine(url)
+
+    import pg_pool
+    pg_pool.make_green()
+
+    return create_engine(url, connect_args={
+        'connect_timeout': connect_timeout,
+        'options': '-c statement_timeout=%d' % (statement_timeout * 1000)
+    })
+
+
+class CallLog(WriteBehind):
+    """
+    Write-behind buffer for calls rows, so logging a call doesn't hold up
+    /call_complete. Batches are inserted with one executemany. When the
+    database refuses one, it and every row waiting are appended to the
+    spool file, a line of JSON per row, and inserted once it takes a batch
+    again, as are rows past MAX_PENDING. Rows it refuses as bad data are
+    inserted one by one instead, and the ones still refused go to the
+    rejected file, so they can't hold up the others.
+    """
+
+    SPOOL_FAILED = True
+    TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    # errors for what's in the rows, not for the database being down
+    REJECTED_ERRORS = (DataError, IntegrityError)
+
+    engine = None
+    spool_path = 'data/calls.spool'
+    rejected_path = 'data/calls.spool.rejected'
+
+    def __init__(self, engine, spool_path):
+        self.engine = engine
+        self.spool_path = spool_path
+        self.rejected_path = spool_path + '.rejected'
+
+        WriteBehind.__init__(self)
+        self.stats.update({
+            'spooled': 0,
+            'replayed': 0,
+            'rejected': 0
+        })
+
+    def log_call(self, params, campaign, request):
+
+        call = new_call(params, campaign, request)
+        self.append(call_row(call))
+
+        return call
+
+    def write(self, rows):
+        """
+        insert rows, returns how many went in and the ones left unsent
+        because the database is down
+        """
+        try:
+            self.insert(rows)
+            return len(rows), []
+        except self.REJECTED_ERRORS:
+            logging.warning('%d calls refused, inserting them one by one:' %
+                            len(rows), exc_info=True)
+        except SQLAlchemyError:
+            logging.error('Failed to log %d calls:' % len(rows),
+                          exc_info=True)
+            return 0, rows
+
+        inserted = 0
+
+        for i, row in enumerate(rows):
+            try:
+                self.insert([row])
+                inserted += 1
+            except self.REJECTED_ERRORS:
+                logging.error('Call refused, moving it to %s:' %
+                              self.rejected_path, exc_info=True)
+                self.reject(row)
+            except SQLAlchemyError:
+                logging.error('Failed to log %d calls:' % (len(rows) - i),
+                              exc_info=True)
+                return inserted, rows[i:]
+
+        return inserted, []
+
+    def insert(self, rows):
+        insert_with_retries(self.engine, rows)
+
+    def write_lines(self, path, rows):
+
+        with open(path, 'a') as f:
+            for row in rows:
+                row = dict(row, timestamp=row['timestamp'].strftime(
+                    self.TIMESTAMP_FORMAT))
+                f.write(json.dumps(row) + '\n')
+
+    def written(self):
+        # the database is back, so it can take what was spooled while down
+        self.replay()
+
+    def spool(self, rows):
+        self.write_lines(self.spool_path, rows)
+        self.stats['spooled'] += len(rows)
+
+    def reject(self, row):
+        """keep a row the database refuses out of the spool, for a look"""
+        self.write_lines(self.rejected_path, [row])
+        self.stats['rejected'] += 1
+
+    def replay(self):
+        """insert spooled rows, returns how many"""
+
+        if not os.path.exists(self.spool_path):
+            return 0
+
+        # other workers may share the spool, so claim it under our own name
+        claimed = '%s.%d' % (self.spool_path, os.getpid())
+
+        try:
+            os.rename(self.spool_path, claimed)
+        except OSError:
+            return 0
+
+        with open(claimed) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+        for row in rows:
+            row['timestamp'] = datetime.strptime(row['timestamp'],
+                                                 self.TIMESTAMP_FORMAT)
+
+        replayed = 0
+
+        for i in range(0, len(rows), self.FLUSH_ROWS):
+            inserted, unsent = self.write(rows[i:i + self.FLUSH_ROWS])
+            replayed += inserted
+
+            if unsent:
+                self.spool(unsent + rows[i + self.FLUSH_ROWS:])
+                break
+
+        os.remove(claimed)
+        self.stats['replayed'] += replayed
+        return replayed
+
+
 def call_count(campaign_id):
     try:
-        return (db.session.query(func.Count(Call.zipcode))
-                .filter(Call.campaign_id == campaign_id).all())[0][0]
+        count = db.session.query(CallCount).get(campaign_id)
     except SQLAlchemyError:
         logging.error('Failed to get call_count:', exc_info=True)
 
         return 0
 
-def call_list(campaign_id, since, limit=50):
+    return count.calls if count else 0
+
+
+def counted_calls(conn):
+    """campaign -> calls with a zipcode, counted from the calls table"""
+    return dict(conn.execute(
+        select([Call.campaign_id, func.Count(Call.zipcode)])
+        .group_by(Call.campaign_id)).fetchall())
+
+
+def backfill_call_counts(engine):
+    """
+    Rebuild call_counts from the calls table. Calls logged while this runs
+    can be missed on Postgres, so run it before turning CALL_LOGGING on,
+    or follow it with reconcile_call_counts.
+    """
+    with engine.begin() as conn:
+        counts = counted_calls(conn)
+        conn.execute(CallCount.__table__.delete())
+
+        if counts:
+            conn.execute(CallCount.__table__.insert(), [
+                {'campaign_id': campaign_id, 'calls': calls}
+                for campaign_id, calls in counts.iteritems()])
+
+    return counts
+
+
+def reconcile_call_counts(engine, fix=False):
+    """
+    Check call_counts against the calls table, returns campaign ->
+    (counter, counted) for the ones that differ and with fix resets them
+    """
+    table = CallCount.__table__
+
+    with engine.begin() as conn:
+        counted = counted_calls(conn)
+        counters = dict(conn.execute(
+            select([table.c.campaign_id, table.c.calls])).fetchall())
+
+        wrong = dict((campaign_id, (counters.get(campaign_id, 0),
+                                    counted.get(campaign_id, 0)))
+                     for campaign_id in set(counted) | set(counters)
+                     if counters.get(campaign_id, 0) !=
+                     counted.get(campaign_id, 0))
+
+        if fix:
+            for campaign_id, (counter, calls) in wrong.iteritems():
+                conn.execute(table.delete()
+                             .where(table.c.campaign_id == campaign_id))
+                conn.execute(table.insert(), campaign_id=campaign_id,
+                             calls=calls)
+
+    return wrong
+
+def call_list(campaign_id, since, limit=50, cursor=None):
+    """
+    A campaign's calls from since on, newest first. Pass the cursor of the
+    last call of a page to get the next one.
+    """
     try:
         calls = (db.session.query(Call)
-                .order_by(Call.timestamp)
-                .filter(Call.campaign_id == campaign_id)
-                .filter(Call.timestamp >= since)
-                .limit(limit).all())
-        return calls
+                 .order_by(Call.timestamp.desc(), Call.id.desc())
+                 .filter(Call.campaign_id == campaign_id)
+                 .filter(Call.timestamp >= since))
+
+        if cursor:
+            timestamp, call_id = parse_cursor(cursor)
+            calls = calls.filter(db.or_(
+                Call.timestamp < timestamp,
+                db.and_(Call.timestamp == timestamp, Call.id < call_id)))
+
+        return calls.limit(limit).all()
 
     except SQLAlchemyError:
         logging.error('Failed to get call_list:', exc_info=True)
@@ -101,19 +491,148 @@ def call_list(campaign_id, since, limit=50):
         return 0
 
 
-def aggregate_stats(campaign_id):
-    zipcodes = (db.session.query(Call.zipcode, func.Count(Call.zipcode))
-                .filter(Call.campaign_id == campaign_id)
-                .group_by(Call.zipcode).all())
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
-    reps = (db.session.query(Call.member_id, func.Count(Call.member_id))
-            .filter(Call.campaign_id == campaign_id)
-            .group_by(Call.member_id).all())
+
+def call_cursor(call):
+    """where call_list's next page starts, after call"""
+    return '%s_%d' % (call.timestamp.strftime(CURSOR_FORMAT), call.id)
+
+
+def parse_cursor(cursor):
+    """(timestamp, id) of a call_cursor, ValueError if it isn't one"""
+    timestamp, call_id = cursor.rsplit('_', 1)
+
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(call_id)
+
+
+def migrate(engine):
+    """
+    Create missing tables, and the indexes of existing ones, returns the
+    names of the indexes created. On Postgres they are built CONCURRENTLY,
+    so logging calls isn't blocked meanwhile.
+    """
+    db.Model.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    created = []
+
+    for table in db.Model.metadata.sorted_tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+
+            if engine.dialect.name == 'postgresql':
+                # CONCURRENTLY can't run inside a transaction
+                with engine.connect() as conn:
+                    conn.execution_options(isolation_level='AUTOCOMMIT') \
+                        .execute('CREATE INDEX CONCURRENTLY %s ON %s (%s)' % (
+                            index.name, table.name, ', '.join(
+                                column.name for column in index.columns)))
+            else:
+                index.create(engine)
+
+            created.append(index.name)
+
+    return created
+
+
+def backfill_rollups(engine):
+    """
+    Rebuild the hourly rollups from the calls table. Like
+    backfill_call_counts, run it before turning CALL_LOGGING on.
+    """
+    columns = [Call.campaign_id, Call.timestamp, Call.zipcode, Call.member_id]
+    counted = Counter()
+
+    with engine.begin() as conn:
+        for table in (ZipcodeHour.__table__, MemberHour.__table__):
+            conn.execute(table.delete())
+
+        # one pass over calls, only the rollups are held in memory
+        for row in conn.execute(select(columns)):
+            for table, key, n in rollups([dict(row.items())]):
+                if table is not CallCount.__table__:
+                    counted[table, tuple(sorted(key.items()))] += n
+
+        for table in (ZipcodeHour.__table__, MemberHour.__table__):
+            values = [dict(key, calls=n)
+                      for (rollup, key), n in counted.iteritems()
+                      if rollup is table]
+
+            if values:
+                conn.execute(table.insert(), values)
+
+    return len(counted)
+
+
+def aggregate_stats(campaign_id, since=None):
+    """
+    Calls by zipcode and by member from the hourly rollups, all of them or
+    those in the hours from since on (the hour since falls in included)
+    """
+    zipcodes = (db.session.query(ZipcodeHour.zipcode,
+                                 func.Sum(ZipcodeHour.calls))
+                .filter(ZipcodeHour.campaign_id == campaign_id))
+
+    reps = (db.session.query(MemberHour.member_id, func.Sum(MemberHour.calls))
+            .filter(MemberHour.campaign_id == campaign_id))
+
+    if since:
+        zipcodes = zipcodes.filter(ZipcodeHour.hour >= hour_of(since))
+        reps = reps.filter(MemberHour.hour >= hour_of(since))
+
+    zipcodes = zipcodes.group_by(ZipcodeHour.zipcode).all()
+    reps = reps.group_by(MemberHour.member_id).all()
 
     return {
         'campaign': campaign_id,
         'calls': {
-            'zipcodes': dict(tuple(z) for z in zipcodes),
-            'reps': dict(tuple(r) for r in reps)
+            'zipcodes': dict((z, int(n)) for z, n in zipcodes),
+            'reps': dict((r, int(n)) for r, n in reps)
         }
     }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import ConfigProduction
+
+    parser = argparse.ArgumentParser(description='Call log maintenance')
+    parser.add_argument('command', nargs='?', default='create_tables',
+                        choices=['create_tables', 'migrate', 'replay_spool',
+                                 'backfill_counts', 'reconcile_counts',
+                                 'backfill_rollups'])
+    parser.add_argument('--spool', default=ConfigProduction.CALL_LOG_SPOOL,
+                        help='spool file to replay')
+    parser.add_argument('--fix', action='store_true',
+                        help='reset the counters reconcile_counts finds wrong')
+    args = parser.parse_args()
+
+    engine = create_engine(ConfigProduction.SQLALCHEMY_DATABASE_URI)
+
+    if args.command == 'create_tables':
+        db.Model.metadata.create_all(engine)
+    elif args.command == 'migrate':
+        print 'Created indexes: %s' % (', '.join(migrate(engine)) or 'none')
+    elif args.command == 'replay_spool':
+        call_log = CallLog(engine, args.spool)
+        print 'Inserted %d spooled calls' % call_log.replay()
+    elif args.command == 'backfill_counts':
+        counts = backfill_call_counts(engine)
+        print 'Counted %d calls in %d campaigns' % (sum(counts.values()),
+                                                   len(counts))
+    elif args.command == 'backfill_rollups':
+        print 'Rebuilt %d hourly rollup rows' % backfill_rollups(engine)
+    elif args.command == 'reconcile_counts':
+        wrong = reconcile_call_counts(engine, args.fix)
+
+        for campaign_id, (counter, calls) in sorted(wrong.iteritems()):
+            print '%s: counter %d, calls table %d%s' % (
+                campaign_id, counter, calls, ' (fixed)' if args.fix else '')
+
+        print '%d campaigns off' % len(wrong)
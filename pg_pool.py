@@ -0,0 +1,132 @@
+"""
+Bounded pool of psycopg2 connections for gevent workers. make_green()
+installs a wait callback so queries yield to other greenlets instead of
+blocking the whole worker on the socket.
+"""
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from contextlib import contextmanager
+from gevent.lock import BoundedSemaphore
+from gevent.queue import LifoQueue
+from gevent.socket import wait_read, wait_write
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """psycopg2 wait callback that waits on the socket through the hub"""
+    while True:
+        state = conn.poll()
+
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+
+def make_green():
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+
+class ConnectionPool():
+    """
+    At most maxsize connections, opened lazily. Idle connections are pinged
+    before reuse once they have sat for CHECK_AFTER seconds, and closed or
+    broken ones are replaced, so a dropped database connection heals on the
+    next checkout.
+    """
+
+    CHECK_AFTER = 30    # seconds idle before a connection is pinged
+
+    maxsize = 10
+
+    def __init__(self, connect, maxsize):
+        self.connect = connect
+        self.maxsize = maxsize
+        self.idle = LifoQueue()     # (connection, last used), newest first
+        self.slots = BoundedSemaphore(maxsize)
+        self.stats = {
+            'connects': 0,
+            'discarded': 0,     # closed, broken or failed health checks
+            'waits': 0          # checkouts that waited for a free slot
+        }
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection, committing when the block finishes and
+        rolling back if it raises
+        """
+        if self.slots.locked():
+            self.stats['waits'] += 1
+
+        with self.slots:
+            conn = self.checkout()
+
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.discard(conn)
+                raise
+            except Exception:
+                self.release(conn, rollback=True)
+                raise
+            else:
+                self.release(conn)
+
+    def checkout(self):
+
+        while not self.idle.empty():
+            conn, last_used = self.idle.get_nowait()
+
+            if self.healthy(conn, last_used):
+                return conn
+
+            self.discard(conn)
+
+        self.stats['connects'] += 1
+        return self.connect()
+
+    def release(self, conn, rollback=False):
+
+        if rollback:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.discard(conn)
+                return
+
+        self.idle.put((conn, time.time()))
+
+    def healthy(self, conn, last_used):
+
+        if conn.closed:
+            return False
+
+        if time.time() - last_used < self.CHECK_AFTER:
+            return True
+
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def discard(self, conn):
+
+        self.stats['discarded'] += 1
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
@@ -0,0 +1,67 @@
+"""
+Expected call volume per congressional office for a list of supporter
+zipcodes, one zipcode per line (only the first csv column is read):
+
+    python plan_targets.py stop-fast-track supporters.csv
+    cut -d, -f3 signups.csv | python plan_targets.py default -
+"""
+import argparse
+import json
+import sys
+
+from cache_handler import CacheHandler
+from political_data import PoliticalData
+
+
+def read_zipcodes(f):
+    for line in f:
+        zipcode = line.split(',', 1)[0].strip()
+
+        if zipcode:
+            yield zipcode
+
+
+def describe(data, member_id):
+    if member_id.startswith('S_'):
+        return '%s (special call)' % json.loads(member_id[2:])['p']
+
+    legislator = data.get_legislator_by_id(member_id)
+
+    if legislator is None:
+        return member_id
+
+    return '%s. %s %s (%s) %s' % (legislator.title, legislator.first_name,
+                                  legislator.last_name, legislator.state,
+                                  member_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Expected calls per member for a list of zipcodes')
+    parser.add_argument('campaign', help='campaign id from campaigns.yaml')
+    parser.add_argument('zipcodes', type=argparse.FileType('r'),
+                        help='file with a zipcode per line, - for stdin')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='runs to average when targets are picked at '
+                             'random (default 20)')
+    args = parser.parse_args()
+
+    data = PoliticalData(CacheHandler(None), False)
+    campaign = data.get_campaign(args.campaign)
+
+    if campaign is None:
+        parser.error('unknown campaign %s' % args.campaign)
+
+    zipcodes = list(read_zipcodes(args.zipcodes))
+    volume = data.locate_member_ids_bulk(zipcodes, campaign, args.samples)
+
+    for member_id, calls in sorted(volume.iteritems(),
+                                   key=lambda (member_id, calls): -calls):
+        print '%10.1f  %s' % (calls, describe(data, member_id))
+
+    print >> sys.stderr, '%d supporters, %.1f calls to %d offices' % (
+        len(zipcodes), sum(volume.itervalues()), len(volume))
+
+
+if __name__ == '__main__':
+    main()
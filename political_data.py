@@ -1,76 +1,165 @@
-import csv
-import yaml
+import logging
 import random
-import time
 import urllib2
 import json
 
+from collections import Counter
+
+import gevent
+import reference_data
+from district_index import DictDistricts
+from records import TargetPlan
+from reference_data import (load_districts_index, load_reference_data,
+                            read_campaigns)
+from spreadsheet_refresher import SpreadsheetRefresher
+
 class PoliticalData():
 
     SPREADSHEET_CACHE_TIMEOUT = 60 # seconds
+    SPREADSHEET_FETCH_TIMEOUT = 10 # seconds
 
-    overrides_data = {}     # the google spreadsheet overrides for each campaign
-    scrape_times = {}       # the last google scrape timestamps for campaigns
+    SPREADSHEET_URL = ('https://spreadsheets.google.com/feeds/list/'
+                       '%s/default/public/values?alt=json')
 
-    exclusions = {}         # the google spreadsheet exclusions per campaign
-    exclusion_scrapes = {}  # the last google scrape timestamps for exclusions
+    spreadsheets = None     # last good overrides and exclusions, refreshed
+                            # in the background
 
     cache_handler = None
     campaigns = None
+    merged_campaigns = None # campaigns merged over the default, by id
     legislators = None
-    districts = None
+    district_index = None   # zipcode -> districts, see district_index.py
+    senators_by_state = None        # state -> positions in self.legislators
+    house_members_by_district = None  # (state, district) -> positions
+    legislators_by_id = None        # bioguide_id -> legislator
+    legislators_by_name = None      # (last_name, state) -> legislators
+    target_plans = None             # campaign id -> TargetPlans memo
     debug_mode = False
 
-    def __init__(self, cache_handler, debug_mode):
+    def __init__(self, cache_handler, debug_mode, use_snapshot=True,
+                 districts_backend='dict'):
         """
-        Load data in database
+        Load data in database. districts_backend picks how districts are
+        looked up: 'dict' keeps them in memory, 'mmap' reads the binary index
+        built by reference_data.py.
         """
-        legislators = []
+        if districts_backend not in ('dict', 'mmap'):
+            raise ValueError('Unknown districts backend: %s' % districts_backend)
 
         self.cache_handler = cache_handler
         self.debug_mode = debug_mode
 
-        with open('data/legislators.csv') as f:
-            reader = csv.DictReader(f)
+        self.spreadsheets = SpreadsheetRefresher(
+            self.SPREADSHEET_CACHE_TIMEOUT, self.SPREADSHEET_FETCH_TIMEOUT,
+            debug_mode)
+        self.cache_handler.invalidation_hooks.append(
+            self.spreadsheet_invalidated)
 
-            for legislator in reader:
-                if legislator['type'] == 'sen':
-                    legislator['chamber'] = 'senate'
-                else:
-                    legislator['chamber'] = 'house'
+        if reference_data.shared:
+            # pre-fork mode, attach to the copy the uWSGI master loaded
+            legislators, district_index, campaigns = reference_data.shared
+        else:
+            legislators, districts, campaigns = load_reference_data(
+                use_snapshot, with_districts=districts_backend == 'dict')
+            district_index = DictDistricts(districts) if districts else None
 
-                # Turn 'rep' into 'Rep' and 'sen' into 'Sen'
-                legislator['title'] = legislator['type'].capitalize()
+        if districts_backend == 'mmap':
+            district_index = load_districts_index()
 
-                legislators.append(legislator)
+        self.load_campaigns(campaigns)
+
+        self.legislators = legislators
+        self.district_index = district_index
 
-        districts = []
+        self.index_legislators()
 
-        with open('data/districts.csv') as f:
-            reader = csv.DictReader(
-                f, fieldnames=['zipcode', 'state', 'district_number'])
+    def index_legislators(self):
+        """
+        Index legislators by state and district, bioguide id and name. The
+        state and district indexes hold positions in self.legislators so
+        lookups can return members in file order.
+        """
+        senators_by_state = {}
+        house_members_by_district = {}
+        legislators_by_id = {}
+        legislators_by_name = {}
+
+        for i, legislator in enumerate(self.legislators):
+            legislators_by_id.setdefault(legislator.bioguide_id, legislator)
+            legislators_by_name.setdefault(
+                (legislator.last_name, legislator.state), []).append(legislator)
+
+            if legislator.chamber == 'senate':
+                senators_by_state.setdefault(legislator.state, []).append(i)
+            else:
+                house_members_by_district.setdefault(
+                    (legislator.state, legislator.district), []).append(i)
 
-            for district in reader:
-                districts.append(district)
+        self.senators_by_state = senators_by_state
+        self.house_members_by_district = house_members_by_district
+        self.legislators_by_id = legislators_by_id
+        self.legislators_by_name = legislators_by_name
 
-        with open('data/campaigns.yaml', 'r') as f:
-            campaigns = {c['id']: c for c in yaml.load(f.read())}
+    def load_campaigns(self, campaigns=None):
+        """
+        (Re)load campaigns, from campaigns.yaml unless they are given, and
+        drop any merged campaigns built from the previous copy
+        """
+        if campaigns is None:
+            campaigns = read_campaigns()
 
         self.campaigns = campaigns
-        self.legislators = legislators
-        self.districts = districts
+        self.merged_campaigns = {}
+        self.target_plans = {}
+
+        for campaign_id, campaign in campaigns.iteritems():
+            if campaign.get('precompute_targets'):
+                gevent.spawn(self.precompute_targets,
+                             self.get_campaign(campaign_id))
 
     def get_campaign(self, campaign_id):
-        if campaign_id in self.campaigns:
-            return dict(self.campaigns['default'],
-                        **self.campaigns[campaign_id])
+        """
+        Get a campaign merged over the default campaign. The merged dict is
+        cached and shared by every request, so treat it as read-only and
+        copy any value (like repIds) before mutating it.
+        """
+        campaign = self.merged_campaigns.get(campaign_id)
 
-    def get_senators(self, districts, get_one=False):
-        states = [d['state'] for d in districts]
+        if campaign is None and campaign_id in self.campaigns:
+            campaign = dict(self.campaigns['default'],
+                            **self.campaigns[campaign_id])
+            self.merged_campaigns[campaign_id] = campaign
+
+        return campaign
+
+    def get_districts(self, zipcode):
+        """get the congressional districts a zipcode falls in"""
+        return self.district_index.lookup(zipcode)
+
+    def senators_in(self, districts):
+        """senators of the states districts are in, in file order"""
+        states = set(d.state for d in districts)
+
+        positions = sorted(i for state in states
+                           for i in self.senators_by_state.get(state, []))
 
-        senators = [l for l in self.legislators
-                if l['chamber'] == 'senate'
-                and l['state'] in states]
+        return [self.legislators[i] for i in positions]
+
+    def house_members_in(self, districts):
+        """house members of districts, in file order"""
+        states = set(d.state for d in districts)
+        district_numbers = set(d.district_number for d in districts)
+
+        # any state/district pairing matches, same as the old linear filter
+        positions = sorted(i for state in states
+                           for number in district_numbers
+                           for i in self.house_members_by_district.get(
+                               (state, number), []))
+
+        return [self.legislators[i] for i in positions]
+
+    def get_senators(self, districts, get_one=False):
+        senators = self.senators_in(districts)
 
         random.shuffle(senators)    # mix it up! always do this :)
 
@@ -80,13 +169,7 @@ class PoliticalData():
             return senators
 
     def get_house_members(self, districts, get_one=False):
-        states = [d['state'] for d in districts]
-        district_numbers = [d['district_number'] for d in districts]
-
-        reps = [l for l in self.legislators
-                if l['chamber'] == 'house'
-                and l['state'] in states
-                and l['district'] in district_numbers]
+        reps = self.house_members_in(districts)
 
         if reps and get_one:
             return [random.choice(reps)]
@@ -94,10 +177,10 @@ class PoliticalData():
             return reps
 
     def get_legislator_by_id(self, member_id):
-        for l in self.legislators:
-            if l['bioguide_id'] == member_id:
-                return l
-        return None
+        return self.legislators_by_id.get(member_id)
+
+    def get_legislators_by_name(self, last_name, state):
+        return self.legislators_by_name.get((last_name, state), [])
 
     def format_special_call(self, name, number, office='', intro = None):
         return "S_%s" % json.dumps({
@@ -105,7 +188,7 @@ class PoliticalData():
             'o': office})
 
     def pick_lucky_recipients(self, list_so_far, campaign, which='first',num=1):
-        lucky = campaign.get('extra_%s_calls' % which)
+        lucky = list(campaign.get('extra_%s_calls' % which))
         random.shuffle(lucky)
         lucky = lucky[0:num]
 
@@ -114,12 +197,12 @@ class PoliticalData():
             if isinstance(person, basestring):
                 p = self.get_legislator_by_id(person)
 
-                if not p or not p.get('phone'):
+                if not p or not p.phone:
                     continue
 
                 person = {
-                    "name": "%s %s"%(p.get('first_name'), p.get('last_name')),
-                    "number": p.get('phone')
+                    "name": "%s %s"%(p.first_name, p.last_name),
+                    "number": p.phone
                 }
 
             special_call = self.format_special_call(
@@ -137,16 +220,103 @@ class PoliticalData():
 
     def locate_member_ids(self, zipcode, campaign):
         """get congressional member ids from zip codes to districts data"""
-        local_districts = [d for d in self.districts
-                           if d['zipcode'] == str(zipcode)]
-        member_ids = []
-
         individual_target = campaign.get('target_member_id', None)
 
         if individual_target:
             member_ids = [individual_target]
             return member_ids
 
+        plans = self.get_target_plans(campaign)
+        plan = plans.by_zipcode.get(zipcode)
+
+        if plan is None:
+            plan = self.plan_targets(zipcode, campaign, plans)
+
+        member_ids = self.apply_target_plan(plan, campaign, plans)
+
+        print member_ids
+
+        return member_ids
+
+    def locate_member_ids_bulk(self, zipcodes, campaign, samples=20):
+        """
+        Expected calls per member id (and special call) if one supporter
+        from each of zipcodes calls. Zipcodes are grouped by their
+        TargetPlan, so the rules are those of locate_member_ids and each
+        distinct plan is resolved once. When the campaign picks who to call
+        at random, the randomized steps are averaged over samples runs.
+        """
+        counts = Counter(str(zipcode) for zipcode in zipcodes)
+
+        individual_target = campaign.get('target_member_id', None)
+
+        if individual_target:
+            return {individual_target: float(sum(counts.itervalues()))}
+
+        plans = self.get_target_plans(campaign)
+        supporters = {}
+
+        for zipcode, n in counts.iteritems():
+            plan = plans.by_zipcode.get(zipcode)
+
+            if plan is None:
+                plan = self.plan_targets(zipcode, campaign, plans)
+
+            supporters[plan] = supporters.get(plan, 0) + n
+
+        runs = samples if self.picks_targets_at_random(campaign) else 1
+        volume = {}
+
+        for plan, n in supporters.iteritems():
+            weight = float(n) / runs
+
+            for i in xrange(runs):
+                for member_id in self.apply_target_plan(plan, campaign, plans):
+                    volume[member_id] = volume.get(member_id, 0) + weight
+
+        return volume
+
+    def picks_targets_at_random(self, campaign):
+        """whether who gets called, not just the call order, is random"""
+        return bool(campaign.get('only_call_1_sen') or
+                    campaign.get('only_call_1_rep') or
+                    campaign.get('max_calls_to_congress') or
+                    campaign.get('extra_first_calls') or
+                    campaign.get('extra_last_calls'))
+
+    def get_target_plans(self, campaign):
+        """
+        The zipcode -> TargetPlan memo of campaign. It is rebuilt when the
+        campaign is reloaded or its override or exclusion spreadsheets change.
+        """
+        versions = []
+
+        if campaign.get('overrides_google_spreadsheet_id', None) != None:
+            self.get_overrides(campaign)
+            versions.append(self.spreadsheets.version(
+                '%s-spreadsheet-data' % campaign.get('id')))
+
+        if campaign.get('exclusions_google_spreadsheet_id'):
+            self.get_exclusions(campaign)
+            versions.append(self.spreadsheets.version(
+                '%s-exclusions-list' % campaign.get('id')))
+
+        plans = self.target_plans.get(campaign.get('id'))
+
+        if plans is None or plans.campaign is not campaign or \
+                plans.versions != versions:
+            plans = TargetPlans(self, campaign, versions)
+            self.target_plans[campaign.get('id')] = plans
+
+            if campaign.get('precompute_targets'):
+                gevent.spawn(self.precompute_targets, campaign)
+
+        return plans
+
+    def plan_targets(self, zipcode, campaign, plans):
+        """work out the TargetPlan for zipcode and remember it in plans"""
+        local_districts = self.get_districts(zipcode)
+
         target_senate = campaign.get('target_senate')
         target_house_first = campaign.get('target_house_first')
         target_house = campaign.get('target_house')
@@ -170,101 +340,149 @@ class PoliticalData():
             first_call_number = overrides['first_call_number']
             state = overrides['_STATE_ABBREV']
 
-        # filter list by campaign target_house, target_senate
-        if target_senate and not target_house_first:
-            sens = [s['bioguide_id'] for s
-                        in self.get_senators(local_districts, campaign.get('only_call_1_sen', False))]
-            if self.debug_mode:
-                print "got %s sens" % sens
-            random.shuffle(sens)
-            member_ids.extend(sens)
+        senators = ()
+        reps = ()
+        individuals = ()
+        first_call = None
+
+        if target_senate:
+            senators = tuple(s.bioguide_id
+                             for s in self.senators_in(local_districts))
 
         if target_house:
-            reps = [h['bioguide_id'] for h
-                       in self.get_house_members(local_districts, campaign.get('only_call_1_rep', False))]
+            reps = tuple(h.bioguide_id
+                         for h in self.house_members_in(local_districts))
+
+        # JL NOTE ~ Tony C=>A<=rdenas (C001097) has bad data, unicode warning
+        if target_individual != None and target_individual != "":
+            individuals = tuple(l.bioguide_id for l in
+                self.get_legislators_by_name(target_individual, state))
+
+        if first_call_number and first_call_name:
+            first_call = self.format_special_call(first_call_name,
+                            first_call_number)
+
+        plan = TargetPlan(bool(target_senate and not target_house_first),
+                          senators, reps, individuals, first_call)
+
+        # don't let made up zipcodes grow the memo
+        if local_districts:
+            plan = plans.add(str(zipcode), plan)
+
+        return plan
+
+    def apply_target_plan(self, plan, campaign, plans):
+        """
+        Run the randomized steps of locating member ids on plan, making the
+        same random calls in the same order as resolving from scratch
+        """
+        member_ids = []
+
+        # filter list by campaign target_house, target_senate
+        if plan.senate_first:
+            member_ids.extend(self.pick_senators(plan.senators, campaign))
+
+        if plan.reps:
+            reps = list(plan.reps)
+
+            if campaign.get('only_call_1_rep', False):
+                reps = [random.choice(reps)]
+
             if self.debug_mode:
                 print "got %s reps" % reps
             member_ids.extend(reps)
 
-        if target_senate and target_house_first:
-            sens = [s['bioguide_id'] for s
-                       in self.get_senators(local_districts, campaign.get('only_call_1_sen', False))]
-            if self.debug_mode:
-                print "got %s sens" % sens
-            random.shuffle(sens)
-            member_ids.extend(sens)
-
+        if not plan.senate_first:
+            member_ids.extend(self.pick_senators(plan.senators, campaign))
 
         if campaign.get('randomize_order', False):
             random.shuffle(member_ids)
 
         # if targeting an individual by name, pop them to the front of the list
-        # JL NOTE ~ Tony C=>A<=rdenas (C001097) has bad data, unicode warning
-        if target_individual != None and target_individual != "":
-            for l in self.legislators:
-                if l['last_name'] == target_individual and l['state'] == state:
-                    if l['bioguide_id'] in member_ids:
-                            member_ids.remove(l['bioguide_id'])     # janky
-                            member_ids.insert(0, l['bioguide_id'])  # lol
+        for bioguide_id in plan.individuals:
+            if bioguide_id in member_ids:
+                member_ids.remove(bioguide_id)     # janky
+                member_ids.insert(0, bioguide_id)  # lol
 
         if campaign.get('max_calls_to_congress', False):
             member_ids = member_ids[0:campaign.get('max_calls_to_congress')]
 
         # Now handle any exclusions lol
-        if campaign.get('exclusions_google_spreadsheet_id'):
-            exclusions = self.get_exclusions(campaign)
-            for exclusion in exclusions:
-                exclusion = exclusion.encode('ascii', errors='backslashreplace')
-                if exclusion in member_ids:
-                    print "Politician %s is on exclusion list!" % exclusion
-                member_ids = filter(lambda a: a != exclusion, member_ids)
+        if plans.exclusions:
+            for exclusion in plans.exclusions.intersection(member_ids):
+                # runs for every sample of random targeting, so not printed
+                logging.debug('Politician %s is on exclusion list!' % exclusion)
+            member_ids = [m for m in member_ids if m not in plans.exclusions]
 
         if campaign.get('extra_first_calls'):
             member_ids = self.pick_lucky_recipients(member_ids, campaign,
                            'first', campaign.get('number_of_extra_first_calls'))
 
-        if campaign.get('extra_first_call_name') and \
-                campaign.get('extra_first_call_num'):
-            first_call = self.format_special_call(
-                campaign.get('extra_first_call_name'),
-                "%d" % campaign.get('extra_first_call_num'))
-            member_ids.insert(0, first_call)
+        if plans.first_call:
+            member_ids.insert(0, plans.first_call)
 
-        if first_call_number and first_call_name:
-            first_call = self.format_special_call(first_call_name,
-                            first_call_number)
-            member_ids.insert(0, first_call)
+        if plan.first_call:
+            member_ids.insert(0, plan.first_call)
 
         if campaign.get('extra_last_calls'):
             member_ids = self.pick_lucky_recipients(member_ids, campaign,
                              'last', campaign.get('number_of_extra_last_calls'))
 
-        if campaign.get('extra_last_call_name') and \
-                campaign.get('extra_last_call_num'):
-            last_call = self.format_special_call(
-                campaign.get('extra_last_call_name'),
-                "%d" % campaign.get('extra_last_call_num'),
-                '',
-                campaign.get('extra_last_call_intro'))
-            member_ids.extend([last_call])
-
-        print member_ids
+        if plans.last_call:
+            member_ids.append(plans.last_call)
 
         return member_ids
 
+    def pick_senators(self, senators, campaign):
+
+        if not senators:
+            return []
+
+        sens = list(senators)
+        random.shuffle(sens)    # mix it up! always do this :)
+
+        if campaign.get('only_call_1_sen', False):
+            sens = [random.choice(sens)]
+
+        if self.debug_mode:
+            print "got %s sens" % sens
+        random.shuffle(sens)
+
+        return sens
+
+    def precompute_targets(self, campaign):
+        """plan every zipcode of a hot campaign up front"""
+        plans = self.get_target_plans(campaign)
+        zipcode = None
+
+        for i, district in enumerate(self.district_index):
+            if district.zipcode != zipcode:
+                zipcode = district.zipcode
+
+                if zipcode not in plans.by_zipcode:
+                    self.plan_targets(zipcode, campaign, plans)
+
+            if i % 1000 == 0:
+                gevent.sleep(0)     # let requests through
+
+                # give up if the spreadsheets changed under us
+                if self.target_plans.get(campaign.get('id')) is not plans:
+                    return
+
     def get_override_values(self, local_districts, campaign):
 
         overrides = self.get_overrides(campaign)
 
-        states = [d['state'] for d in local_districts]
+        states = [d.state for d in local_districts]
 
         for state in states:
             override = overrides.get(state)
             if override:
-                override['_STATE_ABBREV'] = state
+                # a copy, the cached spreadsheet values must stay as fetched
+                override = dict(override, _STATE_ABBREV=state)
                 if self.debug_mode:
                     print "Found overrides: %s / %s" % (state, str(override))
-                return overrides.get(state)
+                return override
 
         return None
 
@@ -277,7 +495,7 @@ class PoliticalData():
 
         overrides = self.get_overrides(campaign)
 
-        states = [d['state'] for d in local_districts]
+        states = [d.state for d in local_districts]
 
         for state in states:
             if overrides.get(state):
@@ -285,24 +503,32 @@ class PoliticalData():
 
         return False
 
-    def get_exclusions(self, campaign):
+    def refresh_spreadsheets(self, campaign):
+        """drop the cached spreadsheets of campaign in every worker"""
+
+        self.cache_handler.invalidate(
+            '%s-spreadsheet-data' % campaign.get('id'))
+        self.cache_handler.invalidate(
+            '%s-exclusions-list' % campaign.get('id'))
+
+    def spreadsheet_invalidated(self, key):
 
-        last_scraped = time.time()-self.exclusion_scrapes.get(campaign['id'], 0)
-        expired = last_scraped > self.SPREADSHEET_CACHE_TIMEOUT
+        # refetch now instead of waiting for the next background refresh
+        if key in self.spreadsheets.fetchers:
+            gevent.spawn(self.spreadsheets.refresh, key)
 
-        if self.exclusions.get(campaign.get('id')) == None or expired:
-            self.populate_exclusions(campaign)
+    def get_exclusions(self, campaign):
 
-        return self.exclusions[campaign.get('id')]
+        return self.spreadsheets.get(
+            '%s-exclusions-list' % campaign.get('id'),
+            lambda: self.populate_exclusions(campaign), [])
 
     def populate_exclusions(self, campaign):
 
         spreadsheet_id = campaign.get('exclusions_google_spreadsheet_id', None)
         spreadsheet_key = '%s-exclusions-list' % campaign.get('id')
 
-        exclusions_data = self.cache_handler.get(spreadsheet_key, None)
-
-        if exclusions_data == None:
+        def grab():
             exclusions = self.grab_exclusions_from_google(
                             spreadsheet_id,
                             campaign.get('exclusions_spreadsheet_match_field'),
@@ -311,25 +537,23 @@ class PoliticalData():
             if self.debug_mode:
                 print "GOT DATA FROM GOOGLE: %s" % str(exclusions)
 
-            self.cache_handler.set(
-                spreadsheet_key,
-                json.dumps(exclusions),
-                self.SPREADSHEET_CACHE_TIMEOUT)
+            return json.dumps(exclusions)
 
-            self.exclusion_scrapes[campaign.get('id')] = time.time()
-        else:
-            exclusions = json.loads(exclusions_data)
-            if self.debug_mode:
-                print "GOT DATA FROM CACHE: %s" % str(exclusions)
+        # one fetch per expiry for every greenlet in every worker
+        exclusions = json.loads(self.cache_handler.get_or_fill(
+            spreadsheet_key, grab, self.SPREADSHEET_CACHE_TIMEOUT))
 
-        self.exclusions[campaign.get('id')] = exclusions
+        if self.debug_mode:
+            print "GOT EXCLUSIONS: %s" % str(exclusions)
+
+        return exclusions
 
     def grab_exclusions_from_google(self, spreadsheet_id, field, val, bioguide):
 
-        url = ('https://spreadsheets.google.com/feeds/list/'
-                '%s/default/public/values?alt=json') % spreadsheet_id
+        url = self.SPREADSHEET_URL % spreadsheet_id
 
-        response = urllib2.urlopen(url).read()
+        response = urllib2.urlopen(
+            url, timeout=self.SPREADSHEET_FETCH_TIMEOUT).read()
         data = json.loads(response)
 
         exclusions = []
@@ -347,46 +571,37 @@ class PoliticalData():
 
     def get_overrides(self, campaign):
 
-        # we expire whatever we're holding in memory after the timeout
-        last_scraped = time.time()-self.scrape_times.get(campaign.get('id'), 0)
-        expired = last_scraped > self.SPREADSHEET_CACHE_TIMEOUT
-
-        if self.overrides_data.get(campaign.get('id')) == None or expired:
-            self.populate_overrides(campaign)
-
-        return self.overrides_data[campaign.get('id')]
+        return self.spreadsheets.get(
+            '%s-spreadsheet-data' % campaign.get('id'),
+            lambda: self.populate_overrides(campaign), {})
 
     def populate_overrides(self, campaign):
 
         spreadsheet_id = campaign.get('overrides_google_spreadsheet_id', None)
         spreadsheet_key = '%s-spreadsheet-data' % campaign.get('id')
 
-        overrides_data = self.cache_handler.get(spreadsheet_key, None)
-
-        if overrides_data == None:
+        def grab():
             overrides = self.grab_overrides_from_google(spreadsheet_id)
             if self.debug_mode:
                 print "GOT DATA FROM GOOGLE: %s" % str(overrides)
 
-            self.cache_handler.set(
-                spreadsheet_key,
-                json.dumps(overrides),
-                self.SPREADSHEET_CACHE_TIMEOUT)
+            return json.dumps(overrides)
 
-            self.scrape_times[campaign.get('id')] = time.time()
-        else:
-            overrides = json.loads(overrides_data)
-            if self.debug_mode:
-                print "GOT DATA FROM CACHE: %s" % str(overrides)
+        # one fetch per expiry for every greenlet in every worker
+        overrides = json.loads(self.cache_handler.get_or_fill(
+            spreadsheet_key, grab, self.SPREADSHEET_CACHE_TIMEOUT))
+
+        if self.debug_mode:
+            print "GOT OVERRIDES: %s" % str(overrides)
 
-        self.overrides_data[campaign.get('id')] = overrides
+        return overrides
 
     def grab_overrides_from_google(self, spreadsheet_id):
 
-        url = ('https://spreadsheets.google.com/feeds/list/'
-                '%s/default/public/values?alt=json') % spreadsheet_id
+        url = self.SPREADSHEET_URL % spreadsheet_id
 
-        response = urllib2.urlopen(url).read()
+        response = urllib2.urlopen(
+            url, timeout=self.SPREADSHEET_FETCH_TIMEOUT).read()
         data = json.loads(response)
 
         def is_true(val):
@@ -415,3 +630,45 @@ class PoliticalData():
 
         return overrides
 
+
+
+class TargetPlans():
+    """
+    Memo of TargetPlans for one campaign and spreadsheet version, plus the
+    campaign-wide parts of the resolution. Equal plans (zipcodes in the same
+    districts) share one TargetPlan.
+    """
+
+    def __init__(self, data, campaign, versions):
+        self.campaign = campaign
+        self.versions = versions
+        self.by_zipcode = {}
+        self.pool = {}
+
+        self.exclusions = frozenset()
+        self.first_call = None
+        self.last_call = None
+
+        if campaign.get('exclusions_google_spreadsheet_id'):
+            self.exclusions = frozenset(
+                exclusion.encode('ascii', errors='backslashreplace')
+                for exclusion in data.get_exclusions(campaign))
+
+        if campaign.get('extra_first_call_name') and \
+                campaign.get('extra_first_call_num'):
+            self.first_call = data.format_special_call(
+                campaign.get('extra_first_call_name'),
+                "%d" % campaign.get('extra_first_call_num'))
+
+        if campaign.get('extra_last_call_name') and \
+                campaign.get('extra_last_call_num'):
+            self.last_call = data.format_special_call(
+                campaign.get('extra_last_call_name'),
+                "%d" % campaign.get('extra_last_call_num'),
+                '',
+                campaign.get('extra_last_call_intro'))
+
+    def add(self, zipcode, plan):
+        plan = self.pool.setdefault(plan, plan)
+        self.by_zipcode[zipcode] = plan
+        return plan
@@ -0,0 +1,12 @@
+"""
+Pre-fork loading of the reference data. uwsgi.ini imports this module in the
+uWSGI master (shared-import) when PRELOAD_REFERENCE_DATA is set, so the data
+is built once and the workers attach to the copy they inherit on fork
+instead of each loading their own.
+
+Since the master is not reloaded in lazy mode, changes to the data files
+need a full restart rather than a worker reload.
+"""
+import reference_data
+
+reference_data.preload()
@@ -0,0 +1,103 @@
+class Record(object):
+    """
+    Compact, read-only row type. Subclasses list their fields in __slots__.
+
+    Rows used to be plain csv.DictReader dicts, so item access (row['phone'])
+    and row.get('phone') keep working alongside attribute access.
+    """
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        # rebuild through __init__, much faster to unpickle than slot state
+        return (self.__class__,
+                tuple(getattr(self, field) for field in self.__slots__))
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and \
+            self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__reduce__())
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            '%s=%r' % (field, getattr(self, field))
+            for field in self.__slots__))
+
+
+class Legislator(Record):
+    __slots__ = ('bioguide_id', 'first_name', 'last_name', 'title', 'chamber',
+                 'state', 'district', 'phone')
+
+    def __init__(self, bioguide_id, first_name, last_name, title, chamber,
+                 state, district, phone):
+        self.bioguide_id = bioguide_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.title = title
+        self.chamber = chamber
+        self.state = state
+        self.district = district
+        self.phone = phone
+
+    @classmethod
+    def from_row(cls, row):
+        """build a Legislator from a legislators.csv row"""
+        return cls(
+            row['bioguide_id'],
+            row['first_name'],
+            row['last_name'],
+            # Turn 'rep' into 'Rep' and 'sen' into 'Sen'
+            intern(row['type'].capitalize()),
+            intern('senate' if row['type'] == 'sen' else 'house'),
+            intern(row['state']),
+            intern(row['district']),
+            row['phone'])
+
+
+class District(Record):
+    __slots__ = ('zipcode', 'state', 'district_number')
+
+    def __init__(self, zipcode, state, district_number):
+        self.zipcode = zipcode
+        self.state = state
+        self.district_number = district_number
+
+    @classmethod
+    def from_row(cls, row):
+        """build a District from a districts.csv (zipcode, state, number) row"""
+        zipcode, state, district_number = row
+        return cls(zipcode, intern(state), intern(district_number))
+
+
+class TargetPlan(Record):
+    """
+    The deterministic part of locating a zipcode's member ids for a
+    campaign: who to call and in which file order, before any shuffling.
+    """
+    __slots__ = ('senate_first', 'senators', 'reps', 'individuals',
+                 'first_call')
+
+    def __init__(self, senate_first, senators, reps, individuals,
+                 first_call):
+        self.senate_first = senate_first
+        self.senators = senators
+        self.reps = reps
+        self.individuals = individuals
+        self.first_call = first_call
@@ -0,0 +1,164 @@
+"""
+Loaders for the reference data (legislators, districts and campaigns), plus a
+prebuilt snapshot of all three so workers can skip the CSV and YAML parsing
+at startup.
+
+Build the snapshot (and the mmap district index, see MmapDistricts) with:
+
+    python reference_data.py
+
+The snapshot records a checksum of its source files and is ignored as soon
+as any of them changes, so a stale snapshot just falls back to the sources.
+
+In pre-fork mode (see preload.py) the uWSGI master loads the data once with
+preload() and every worker's PoliticalData attaches to that shared copy.
+"""
+import cPickle
+import csv
+import hashlib
+import os
+import yaml
+
+from district_index import MmapDistricts, PackedDistricts
+from records import Legislator, District
+
+LEGISLATORS_PATH = 'data/legislators.csv'
+DISTRICTS_PATH = 'data/districts.csv'
+CAMPAIGNS_PATH = 'data/campaigns.yaml'
+
+SOURCE_PATHS = (LEGISLATORS_PATH, DISTRICTS_PATH, CAMPAIGNS_PATH)
+
+SNAPSHOT_PATH = 'data/reference_data.pickle'
+DISTRICTS_INDEX_PATH = 'data/districts.bin'
+SNAPSHOT_VERSION = 1    # bump whenever the snapshot layout or records change
+
+shared = None   # (legislators, district index, campaigns) set by preload()
+
+
+def read_legislators(path=LEGISLATORS_PATH):
+    with open(path) as f:
+        return [Legislator.from_row(row) for row in csv.DictReader(f)]
+
+
+def read_districts(path=DISTRICTS_PATH):
+    with open(path) as f:
+        return [District.from_row(row) for row in csv.reader(f) if row]
+
+
+def read_campaigns(path=CAMPAIGNS_PATH):
+    with open(path, 'r') as f:
+        return {c['id']: c for c in yaml.load(f.read())}
+
+
+def sources_checksum(paths=SOURCE_PATHS):
+    checksum = hashlib.sha1()
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            checksum.update(path)
+            checksum.update(f.read())
+
+    return checksum.hexdigest()
+
+
+def build_snapshot(path=SNAPSHOT_PATH):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'checksum': sources_checksum(),
+        'legislators': read_legislators(),
+        'districts': read_districts(),
+        'campaigns': read_campaigns()
+    }
+
+    # write then rename, so a worker never reads a half-written snapshot
+    with open(path + '.tmp', 'wb') as f:
+        cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+    return snapshot
+
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """
+    Load the snapshot, or return None if it is missing, unreadable or
+    stale compared to the source files
+    """
+    try:
+        with open(path, 'rb') as f:
+            snapshot = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError, AttributeError,
+            ImportError, IndexError, TypeError, ValueError):
+        return None
+
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != SNAPSHOT_VERSION or \
+            snapshot.get('checksum') != sources_checksum():
+        return None
+
+    return snapshot
+
+
+def load_reference_data(use_snapshot=True, with_districts=True):
+    """
+    Get (legislators, districts, campaigns), from the snapshot when it is
+    fresh and from the source files otherwise. Districts are None when not
+    wanted.
+    """
+    snapshot = load_snapshot() if use_snapshot else None
+
+    if snapshot:
+        return (snapshot['legislators'],
+                snapshot['districts'] if with_districts else None,
+                snapshot['campaigns'])
+
+    return (read_legislators(),
+            read_districts() if with_districts else None,
+            read_campaigns())
+
+
+def build_districts_index(path=DISTRICTS_INDEX_PATH):
+    MmapDistricts.build(read_districts(), sources_checksum([DISTRICTS_PATH]),
+                        path)
+
+
+def load_districts_index(path=DISTRICTS_INDEX_PATH):
+    """
+    Open the mmap district index, (re)building it first when it is missing
+    or stale compared to districts.csv. IOError if it still can't be opened.
+    """
+    checksum = sources_checksum([DISTRICTS_PATH])
+    index = MmapDistricts.open(path, checksum)
+
+    if index is None:
+        build_districts_index(path)
+        index = MmapDistricts.open(path, checksum)
+
+    if index is None:
+        raise IOError('Cannot open the district index %s after building it'
+                      % path)
+
+    return index
+
+
+def preload(use_snapshot=True):
+    """
+    Build the shared reference data. Meant to run in the uWSGI master before
+    it forks, so districts are packed into flat arrays whose pages the
+    workers can keep sharing copy-on-write.
+    """
+    global shared
+
+    legislators, districts, campaigns = load_reference_data(use_snapshot)
+    shared = (legislators, PackedDistricts(districts), campaigns)
+
+    return shared
+
+
+if __name__ == '__main__':
+    snapshot = build_snapshot()
+    print "Wrote %s (%d legislators, %d districts, %d campaigns)" % (
+        SNAPSHOT_PATH, len(snapshot['legislators']),
+        len(snapshot['districts']), len(snapshot['campaigns']))
+
+    build_districts_index()
+    print "Wrote %s" % DISTRICTS_INDEX_PATH
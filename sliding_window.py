@@ -0,0 +1,119 @@
+"""
+Sliding window counters for the throttle. hit(key, now) returns how many
+hits key had in the window before now, then records this one, which is
+what the per-call count(id) queries against _ms_call_throttle did.
+"""
+import uuid
+
+from collections import deque
+
+
+class MemoryWindows():
+    """
+    Windows held in this process. Only exact when one process sees every
+    call, otherwise each worker only counts its own.
+    """
+
+    PRUNE_EVERY = 10000     # hits between sweeps for idle keys
+
+    window = 60 * 60 * 24   # seconds
+
+    def __init__(self, window):
+        self.window = window
+        self.hits = {}      # key -> deque of hit timestamps, oldest first
+        self.since_prune = 0
+
+    def hit(self, key, now):
+        hits = self.hits.get(key)
+
+        if hits is None:
+            hits = self.hits[key] = deque()
+
+        cutoff = now - self.window
+
+        while hits and hits[0] < cutoff:
+            hits.popleft()
+
+        count = len(hits)
+        hits.append(now)
+
+        self.since_prune += 1
+
+        if self.since_prune >= self.PRUNE_EVERY:
+            self.prune(now)
+
+        return count
+
+    def needs_seed(self):
+        return True
+
+    def mark_seeded(self):
+        pass
+
+    def seed(self, key, timestamp, member):
+        """record a past hit, seeds must arrive oldest first"""
+        self.hits.setdefault(key, deque()).append(timestamp)
+
+    def prune(self, now):
+        cutoff = now - self.window
+
+        for key in [key for key, hits in self.hits.iteritems()
+                    if not hits or hits[-1] < cutoff]:
+            del self.hits[key]
+
+        self.since_prune = 0
+
+    def __len__(self):
+        return len(self.hits)
+
+
+class RedisWindows():
+    """
+    Windows kept in Redis sorted sets scored by timestamp, shared by every
+    worker. Each hit is counted and recorded in one MULTI/EXEC.
+    """
+
+    SEEDED_KEY = 'throttle-windows-seeded'
+    SEEDING_KEY = 'throttle-windows-seeding'
+    SEED_TIMEOUT = 300      # seconds before another worker may take over
+
+    window = 60 * 60 * 24   # seconds
+
+    def __init__(self, redis_conn, window):
+        self.redis_conn = redis_conn
+        self.window = window
+
+    def hit(self, key, now):
+        pipe = self.redis_conn.pipeline()
+        pipe.zremrangebyscore(key, '-inf', '(%f' % (now - self.window))
+        pipe.zcard(key)
+        pipe.zadd(key, '%f-%s' % (now, uuid.uuid4().hex), now)
+        pipe.expire(key, int(self.window) + 1)
+
+        return pipe.execute()[1]
+
+    def seed(self, key, timestamp, member):
+        # members are the audit row ids, so seeding twice is harmless
+        pipe = self.redis_conn.pipeline()
+        pipe.zadd(key, member, timestamp)
+        pipe.expire(key, int(self.window) + 1)
+        pipe.execute()
+
+    def needs_seed(self):
+        """
+        Only the first worker to start against an empty Redis seeds it,
+        later ones would count calls made since then twice. If it dies
+        before mark_seeded(), the next worker to start takes over once its
+        claim expires.
+        """
+        if self.redis_conn.exists(self.SEEDED_KEY):
+            return False
+
+        return bool(self.redis_conn.set(self.SEEDING_KEY, '1', nx=True,
+                                        ex=self.SEED_TIMEOUT))
+
+    def mark_seeded(self):
+        pipe = self.redis_conn.pipeline()
+        pipe.set(self.SEEDED_KEY, '1')
+        pipe.delete(self.SEEDING_KEY)
+        pipe.execute()
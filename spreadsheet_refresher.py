@@ -0,0 +1,87 @@
+import gevent
+
+from gevent.event import Event
+
+
+class SpreadsheetRefresher():
+    """
+    Stale-while-revalidate holder for the Google spreadsheet data.
+
+    The first get() for a key fetches it inline (concurrent callers wait for
+    that one fetch). After that a single background greenlet per key
+    refetches it every interval seconds while get() keeps returning the
+    last good copy, so webhooks never wait on Google. A failed or timed out
+    fetch keeps the last good copy.
+    """
+
+    interval = 60       # seconds between background refreshes
+    timeout = 10        # hard limit on a single fetch, in seconds
+    debug_mode = False
+
+    def __init__(self, interval, timeout, debug_mode=False):
+        self.interval = interval
+        self.timeout = timeout
+        self.debug_mode = debug_mode
+
+        self.values = {}      # key -> last good data
+        self.versions = {}    # key -> bumped whenever new data is stored
+        self.failures = {}    # key -> failed fetches since the last success
+        self.fetchers = {}    # key -> callable returning fresh data
+        self.loaded = {}      # key -> Event set once the first fetch is done
+        self.greenlets = {}   # key -> background refresh greenlet
+
+    def get(self, key, fetch, default=None):
+        # keep the newest fetcher, it closes over the current campaign
+        self.fetchers[key] = fetch
+
+        loaded = self.loaded.get(key)
+
+        if loaded is None:
+            loaded = self.loaded[key] = Event()
+
+            try:
+                self.refresh(key)
+            finally:
+                loaded.set()
+
+            self.greenlets[key] = gevent.spawn_later(
+                self.interval, self.run, key)
+        else:
+            loaded.wait(self.timeout)
+
+        return self.values.get(key, default)
+
+    def version(self, key):
+        return self.versions.get(key, 0)
+
+    def refresh(self, key):
+        """fetch key now, returns whether the fetch succeeded"""
+        try:
+            with gevent.Timeout(self.timeout):
+                value = self.fetchers[key]()
+        except (Exception, gevent.Timeout), err:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            print "Spreadsheet refresh of %s failed (%d in a row): %r" % (
+                key, self.failures[key], err)
+            return False
+
+        self.failures[key] = 0
+
+        if key not in self.values or self.values[key] != value:
+            self.values[key] = value
+            self.versions[key] = self.version(key) + 1
+
+            if self.debug_mode:
+                print "Spreadsheet %s refreshed: %s" % (key, str(value))
+
+        return True
+
+    def run(self, key):
+        while True:
+            self.refresh(key)
+            gevent.sleep(self.interval)
+
+    def stop(self):
+        """stop the background refreshes, get() keeps the last copies"""
+        gevent.killall(self.greenlets.values())
+        self.greenlets.clear()
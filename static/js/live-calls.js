@@ -9,26 +9,22 @@ function getQueryVariable(variable) {
        return(false);
 }
 
-function getRecentCalls() {
-  $.ajax({
-    url: '/recent_calls',
-    data: { campaign: campaign,
-            since: lastRun,
-            limit: '10'
-    },
-    success: function(data) {
-      console.log('callback @ '+lastRun);
-      var t = callsTemplate({calls: data.calls});
-      $('ul#calls').append(t);
-      $("abbr.timeago").timeago();
-      lastRun = (new Date()).toISOString();
-    }
+// calls are pushed from /live_feed as they happen, EventSource reconnects
+// by itself if the stream drops
+function followCalls() {
+  var feed = new EventSource(
+    '/live_feed?campaign=' + encodeURIComponent(campaign));
+
+  feed.addEventListener('call', function(e) {
+    var t = callsTemplate({calls: [JSON.parse(e.data)]});
+    $('ul#calls').append(t);
+    $("abbr.timeago").timeago();
   });
 }
 
-var lastRun, callsTemplate, campaign, interval;
+var callsTemplate, campaign;
 $(function () {
-  campaign = getQueryVariable('campaign');
+  campaign = getQueryVariable('campaign') || 'default';
   headerTemplate = $('#header').html();
   $('h1#campaign').html(
     _.template(headerTemplate, {campaign: campaign})
@@ -36,10 +32,5 @@ $(function () {
 
   callsTemplate = _.template($('#recent-calls-template').html());
 
-  var since = getQueryVariable('since');
-  if (since) { lastRun = since; }
-  else { lastRun = new Date(((new Date()) - 5*1000)).toISOString(); } // default to last 5 minutes
-
-  getRecentCalls();
-  interval = setInterval(getRecentCalls, 5000);
-});
\ No newline at end of file
+  followCalls();
+});
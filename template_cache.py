@@ -0,0 +1,49 @@
+import pystache
+
+
+class TemplateCache():
+    """
+    Renders campaign message templates, parsing each mustache template only
+    once. Messages without any mustache tags (plain text and recording
+    URLs) are returned as they are, without going through pystache at all.
+    """
+
+    MAX_TEMPLATES = 2048    # templates can arrive in request params, so cap it
+
+    renderer = None
+    templates = None
+
+    def __init__(self):
+        self.renderer = pystache.Renderer()
+        self.templates = {}
+
+    def warm(self, campaigns):
+        """parse the msg_* templates of every campaign up front"""
+        for campaign in campaigns.itervalues():
+            for field, template in campaign.iteritems():
+                if field.startswith('msg_') and \
+                        isinstance(template, basestring) and '{{' in template:
+                    self.parse(template)
+
+    def parse(self, template):
+        parsed = self.templates.get(template)
+
+        if parsed is None:
+            if isinstance(template, str):
+                text = unicode(template, self.renderer.string_encoding,
+                               self.renderer.decode_errors)
+            else:
+                text = template
+
+            parsed = pystache.parse(text)
+
+            if len(self.templates) < self.MAX_TEMPLATES:
+                self.templates[template] = parsed
+
+        return parsed
+
+    def render(self, template, context):
+        if '{{' not in template:
+            return template
+
+        return self.renderer.render(self.parse(template), context)
@@ -1,4 +1,43 @@
+import BaseHTTPServer
+import cPickle
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+import gevent
+import psycopg2
+import pystache
+import twilio.twiml
+
+from flask import Flask
+from gevent.event import Event
+
+import models
+import reference_data
 from political_data import PoliticalData
+from records import District
+from template_cache import TemplateCache
+from twiml_cache import TwimlCache
+from cache_handler import CacheHandler
+from district_index import (DictDistricts, MmapDistricts, PackedDistricts,
+                            pack_record)
+from sliding_window import MemoryWindows, RedisWindows
+from pg_pool import ConnectionPool
+from throttle import Throttle, ThrottleLog
+from fftf_leaderboard import FFTFLeaderboard
+from event_spool import EventSpool
+from live_feed import LiveFeed
+from models import (db, Call, CallCount, CallLog, aggregate_stats,
+                    backfill_call_counts, backfill_rollups, call_cursor,
+                    call_list, call_row, migrate, new_call,
+                    reconcile_call_counts, rollups)
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 
 class TestData():
     def setUp(self):
@@ -17,3 +56,1652 @@ class TestData():
 
         assert len(ids) == 4
         assert ids[0]['bioguide_id'] == 'C000127'
+
+
+class TestDistrictLookup():
+    def setUp(self):
+        self.data = PoliticalData(CacheHandler(None), False)
+
+    def test_get_districts_matches_scan(self):
+        for zipcode in ['98004', '10001', 98004, '00000']:
+            expected = [d for d in self.data.district_index
+                        if d['zipcode'] == str(zipcode)]
+
+            assert self.data.get_districts(zipcode) == expected
+
+
+class TestLegislatorIndexes():
+    def setUp(self):
+        self.data = PoliticalData(CacheHandler(None), False)
+
+    def test_house_members_match_scan(self):
+        for zipcode in ['98004', '10001', '20001', '59001']:
+            districts = self.data.get_districts(zipcode)
+            states = [d['state'] for d in districts]
+            numbers = [d['district_number'] for d in districts]
+            expected = [l for l in self.data.legislators
+                        if l['chamber'] == 'house'
+                        and l['state'] in states
+                        and l['district'] in numbers]
+
+            assert self.data.get_house_members(districts) == expected
+
+    def test_senators_match_scan(self):
+        districts = self.data.get_districts('98004')
+        senators = self.data.get_senators(districts)
+
+        assert len(senators) == 2
+        assert set(s['bioguide_id'] for s in senators) == set(
+            l['bioguide_id'] for l in self.data.legislators
+            if l['chamber'] == 'senate' and l['state'] == 'WA')
+
+    def test_get_legislator_by_id(self):
+        legislator = self.data.get_legislator_by_id('C000127')
+
+        assert legislator['last_name'] == 'Cantwell'
+        assert self.data.get_legislator_by_id('NOPE') is None
+
+    def test_get_legislators_by_name(self):
+        legislators = self.data.get_legislators_by_name('Cantwell', 'WA')
+
+        assert [l['bioguide_id'] for l in legislators] == ['C000127']
+        assert self.data.get_legislators_by_name('Cantwell', 'OR') == []
+
+
+class TestCampaigns():
+    def setUp(self):
+        self.data = PoliticalData(CacheHandler(None), False)
+
+    def test_get_campaign_is_cached(self):
+        campaign = self.data.get_campaign('stop-fast-track')
+
+        assert campaign['msg_opt_out'] == \
+            self.data.campaigns['default']['msg_opt_out']
+        assert self.data.get_campaign('stop-fast-track') is campaign
+        assert self.data.get_campaign('no-such-campaign') is None
+
+    def test_load_campaigns_invalidates(self):
+        campaign = self.data.get_campaign('default')
+        self.data.load_campaigns()
+
+        assert self.data.get_campaign('default') is not campaign
+
+    def test_extra_calls_do_not_mutate_campaign(self):
+        campaign = dict(self.data.get_campaign('default'),
+                        extra_first_calls=[{'name': 'A', 'number': '1'},
+                                           {'name': 'B', 'number': '2'},
+                                           {'name': 'C', 'number': '3'}])
+        before = list(campaign['extra_first_calls'])
+
+        for i in range(10):
+            self.data.pick_lucky_recipients([], campaign, 'first', 1)
+
+        assert campaign['extra_first_calls'] == before
+
+
+def unmemoized_member_ids(data, districts, zipcode, campaign):
+    """
+    locate_member_ids as it was before TargetPlans, scanning legislators
+    for every lookup, for checking the memo against. Makes the same random
+    calls. districts maps zipcodes to their districts in file order.
+    """
+    local_districts = districts.get(str(zipcode), [])
+    states = [d.state for d in local_districts]
+    numbers = [d.district_number for d in local_districts]
+    member_ids = []
+
+    if campaign.get('target_member_id'):
+        return [campaign['target_member_id']]
+
+    target_senate = campaign.get('target_senate')
+    target_house_first = campaign.get('target_house_first')
+    target_house = campaign.get('target_house')
+    target_individual = state = first_call_name = first_call_number = None
+
+    if data.has_special_overrides(local_districts, campaign):
+        overrides = data.get_override_values(local_districts, campaign)
+
+        target_senate = overrides['target_senate']
+        target_house_first = overrides['target_house_first']
+        target_house = overrides['target_house']
+        target_individual = overrides['target_individual']
+        first_call_name = overrides['first_call_name']
+        first_call_number = overrides['first_call_number']
+        state = overrides['_STATE_ABBREV']
+
+    def senators():
+        sens = [l for l in data.legislators
+                if l.chamber == 'senate' and l.state in states]
+        random.shuffle(sens)
+
+        if sens and campaign.get('only_call_1_sen', False):
+            sens = [random.choice(sens)]
+
+        sens = [l.bioguide_id for l in sens]
+        random.shuffle(sens)
+        return sens
+
+    if target_senate and not target_house_first:
+        member_ids.extend(senators())
+
+    if target_house:
+        reps = [l for l in data.legislators
+                if l.chamber == 'house' and l.state in states and
+                l.district in numbers]
+
+        if reps and campaign.get('only_call_1_rep', False):
+            reps = [random.choice(reps)]
+
+        member_ids.extend(l.bioguide_id for l in reps)
+
+    if target_senate and target_house_first:
+        member_ids.extend(senators())
+
+    if campaign.get('randomize_order', False):
+        random.shuffle(member_ids)
+
+    if target_individual:
+        for l in data.legislators:
+            if l.last_name == target_individual and l.state == state and \
+                    l.bioguide_id in member_ids:
+                member_ids.remove(l.bioguide_id)
+                member_ids.insert(0, l.bioguide_id)
+
+    if campaign.get('max_calls_to_congress', False):
+        member_ids = member_ids[0:campaign.get('max_calls_to_congress')]
+
+    if campaign.get('exclusions_google_spreadsheet_id'):
+        for exclusion in data.get_exclusions(campaign):
+            exclusion = exclusion.encode('ascii', errors='backslashreplace')
+            member_ids = [m for m in member_ids if m != exclusion]
+
+    if campaign.get('extra_first_calls'):
+        member_ids = data.pick_lucky_recipients(
+            member_ids, campaign, 'first',
+            campaign.get('number_of_extra_first_calls'))
+
+    if campaign.get('extra_first_call_name') and \
+            campaign.get('extra_first_call_num'):
+        member_ids.insert(0, data.format_special_call(
+            campaign.get('extra_first_call_name'),
+            "%d" % campaign.get('extra_first_call_num')))
+
+    if first_call_number and first_call_name:
+        member_ids.insert(0, data.format_special_call(first_call_name,
+                                                      first_call_number))
+
+    if campaign.get('extra_last_calls'):
+        member_ids = data.pick_lucky_recipients(
+            member_ids, campaign, 'last',
+            campaign.get('number_of_extra_last_calls'))
+
+    if campaign.get('extra_last_call_name') and \
+            campaign.get('extra_last_call_num'):
+        member_ids.append(data.format_special_call(
+            campaign.get('extra_last_call_name'),
+            "%d" % campaign.get('extra_last_call_num'), '',
+            campaign.get('extra_last_call_intro')))
+
+    return member_ids
+
+
+class TestTargetPlans():
+    def setUp(self):
+        self.data = PoliticalData(CacheHandler(None), False)
+
+    def seed_spreadsheet(self, key, value):
+        # stand in for a fetched spreadsheet, without the network
+        spreadsheets = self.data.spreadsheets
+        spreadsheets.fetchers[key] = lambda: value
+        spreadsheets.loaded[key] = Event()
+        spreadsheets.loaded[key].set()
+        spreadsheets.refresh(key)
+
+    def test_memo_replays_random_steps(self):
+        campaign = dict(self.data.get_campaign('default'), id='randomized',
+                        randomize_order=True, only_call_1_sen=True,
+                        extra_first_calls=['C000127', 'M001111'],
+                        number_of_extra_first_calls=1)
+        results = []
+
+        for i in range(2):
+            random.seed(7)
+            results.append([self.data.locate_member_ids(zipcode, campaign)
+                            for zipcode in ['98004', '10001', '59001'] * 3])
+
+        assert results[0] == results[1]
+        assert len(self.data.target_plans['randomized'].by_zipcode) == 3
+
+    def test_memo_matches_unmemoized_lookups(self):
+        districts = {}
+
+        for district in reference_data.read_districts():
+            districts.setdefault(district.zipcode, []).append(district)
+
+        zipcodes = sorted(districts)[::199] + ['00000', '98004', '9800']
+        default = self.data.get_campaign('default')
+        campaigns = [self.data.get_campaign(campaign_id)
+                     for campaign_id in sorted(self.data.campaigns)] + [
+            dict(default, id='random-picks', randomize_order=True,
+                 only_call_1_sen=True, only_call_1_rep=True,
+                 max_calls_to_congress=2),
+            dict(default, id='house-first', target_house_first=True,
+                 extra_first_calls=['C000127', 'M001111', 'P000197'],
+                 number_of_extra_first_calls=2,
+                 extra_last_calls=[{'name': 'A', 'number': '1'},
+                                   {'name': 'B', 'number': '2'}],
+                 number_of_extra_last_calls=1),
+            dict(default, id='spreadsheets', randomize_order=True,
+                 overrides_google_spreadsheet_id='abc',
+                 exclusions_google_spreadsheet_id='def')]
+
+        for campaign in campaigns:
+            # the spreadsheets of every campaign that has them, offline
+            self.seed_spreadsheet('%s-spreadsheet-data' % campaign['id'], {
+                'WA': {'target_senate': True, 'target_house': True,
+                       'target_house_first': True,
+                       'target_individual': 'Murray',
+                       'first_call_name': 'Governor',
+                       'first_call_number': '3605554321'},
+                'NY': {'target_senate': False, 'target_house': True,
+                       'target_house_first': False,
+                       'target_individual': '',
+                       'first_call_name': '', 'first_call_number': ''}})
+            self.seed_spreadsheet('%s-exclusions-list' % campaign['id'],
+                                  [u'C000127'])
+
+        lookups = 0
+
+        # twice, so the second round reads the memo
+        for i in range(2):
+            for campaign in campaigns:
+                for zipcode in zipcodes:
+                    random.seed(zipcode + campaign['id'])
+                    expected = unmemoized_member_ids(
+                        self.data, districts, zipcode, campaign)
+
+                    random.seed(zipcode + campaign['id'])
+                    assert self.data.locate_member_ids(zipcode, campaign) \
+                        == expected, (campaign['id'], zipcode)
+                    lookups += 1
+
+        assert lookups > 1000
+
+    def test_spreadsheet_changes_reset_memo(self):
+        campaign = dict(self.data.get_campaign('default'), id='excluding',
+                        exclusions_google_spreadsheet_id='abc')
+        self.seed_spreadsheet('excluding-exclusions-list', [])
+
+        ids = self.data.locate_member_ids('98004', campaign)
+        assert 'C000127' in ids
+
+        self.seed_spreadsheet('excluding-exclusions-list', [u'C000127'])
+
+        ids = self.data.locate_member_ids('98004', campaign)
+        assert ids and 'C000127' not in ids
+
+    def test_bulk_matches_per_call(self):
+        campaign = self.data.get_campaign('default')
+        zipcodes = ['98004', '10001', '98004', '59001', '00000']
+        expected = {}
+
+        for zipcode in zipcodes:
+            for member_id in self.data.locate_member_ids(zipcode, campaign):
+                expected[member_id] = expected.get(member_id, 0) + 1
+
+        assert self.data.locate_member_ids_bulk(zipcodes, campaign) == \
+            expected
+
+    def test_bulk_averages_random_picks(self):
+        campaign = dict(self.data.get_campaign('default'), id='one-senator',
+                        only_call_1_sen=True)
+        volume = self.data.locate_member_ids_bulk(['98004'] * 10, campaign,
+                                                  samples=50)
+
+        # 98004 has two representatives
+        assert abs(sum(volume.itervalues()) - 10 * 3) < 1e-9
+        assert 0 < volume['C000127'] < 10
+        assert abs(volume['C000127'] + volume['M001111'] - 10) < 1e-9
+
+    def test_precompute_targets(self):
+        campaign = self.data.get_campaign('default')
+        self.data.precompute_targets(campaign)
+
+        plans = self.data.target_plans['default']
+        zipcodes = set(d.zipcode for d in self.data.district_index)
+
+        assert set(plans.by_zipcode) == zipcodes
+        assert len(plans.pool) < len(zipcodes) / 4
+        assert plans.by_zipcode['98004'].senators == ('C000127', 'M001111')
+
+
+class TestRecords():
+    def setUp(self):
+        self.data = PoliticalData(CacheHandler(None), False)
+
+    def test_legislator_item_access(self):
+        legislator = self.data.get_legislator_by_id('C000127')
+
+        assert legislator['phone'] == legislator.phone
+        assert legislator.get('title') == 'Sen'
+        assert legislator.get('twitter', 'missing') == 'missing'
+
+        try:
+            legislator['twitter']
+            assert False, 'expected a KeyError'
+        except KeyError:
+            pass
+
+
+class TestReferenceDataSnapshot():
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.pickle')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_snapshot_round_trip(self):
+        reference_data.build_snapshot(self.path)
+        snapshot = reference_data.load_snapshot(self.path)
+
+        assert len(snapshot['districts']) == \
+            len(reference_data.read_districts())
+        assert snapshot['legislators'][0]['bioguide_id'] == \
+            reference_data.read_legislators()[0]['bioguide_id']
+
+    def test_stale_snapshot_is_ignored(self):
+        snapshot = reference_data.build_snapshot(self.path)
+        snapshot['checksum'] = 'stale'
+
+        with open(self.path, 'wb') as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+
+        assert reference_data.load_snapshot(self.path) is None
+
+    def test_unusable_snapshot_is_ignored(self):
+        assert reference_data.load_snapshot(self.path) is None
+
+        with open(self.path, 'wb') as f:
+            f.write('not a pickle')
+
+        assert reference_data.load_snapshot(self.path) is None
+
+
+class TestPackedDistricts():
+    def setUp(self):
+        districts = reference_data.read_districts()
+        self.dict_districts = DictDistricts(districts)
+        self.packed_districts = PackedDistricts(districts)
+
+    def test_lookups_match_dict_index(self):
+        for district in self.dict_districts:
+            assert self.packed_districts.lookup(district.zipcode) == \
+                self.dict_districts.lookup(district.zipcode)
+
+        assert len(self.packed_districts) == len(self.dict_districts)
+
+    def test_bad_zipcodes(self):
+        for zipcode in ['', '9800', '980041', 'abcde', None, 98004.0]:
+            assert self.packed_districts.lookup(zipcode) == []
+
+    def test_unpackable_districts(self):
+        for bad in [District('9800', 'WA', '9'), District('98004', 'W', '9'),
+                    District('98004', 'WA', '09'),
+                    District('98004', 'WA', '-1')]:
+            try:
+                PackedDistricts([bad])
+                assert False, 'expected a ValueError for %r' % bad
+            except ValueError:
+                pass
+
+        assert pack_record(District('98004', 'WA', '9')) == ('98004', 'WA', 9)
+
+    def test_political_data_attaches_to_preloaded_data(self):
+        shared = reference_data.preload()
+
+        try:
+            data = PoliticalData(CacheHandler(None), False)
+        finally:
+            reference_data.shared = None
+
+        assert data.district_index is shared[1]
+        assert data.get_districts('98004') == \
+            self.dict_districts.lookup('98004')
+
+
+class TestMmapDistricts():
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.bin')
+        self.dict_districts = DictDistricts(reference_data.read_districts())
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_lookups_match_dict_index(self):
+        index = reference_data.load_districts_index(self.path)
+
+        for district in self.dict_districts:
+            assert index.lookup(district.zipcode) == \
+                self.dict_districts.lookup(district.zipcode)
+
+        for zipcode in ['00000', '99999', '9800', 'abcde']:
+            assert index.lookup(zipcode) == []
+
+        assert len(index) == len(self.dict_districts)
+
+    def test_stale_index_is_rebuilt(self):
+        MmapDistricts.build(list(self.dict_districts)[:10], 'stale', self.path)
+
+        assert MmapDistricts.open(self.path, 'stale') is not None
+
+        index = reference_data.load_districts_index(self.path)
+
+        assert len(index) == len(self.dict_districts)
+
+    def test_builds_do_not_share_a_temp_file(self):
+        districts = list(self.dict_districts)[:10]
+        bad = District('9800', 'WA', '9')
+        temp_files = lambda: [name for name in os.listdir(
+            os.path.dirname(self.path)) if name.startswith(
+            os.path.basename(self.path) + '.')]
+
+        MmapDistricts.build(districts, 'first', self.path)
+        assert temp_files() == []
+
+        try:
+            MmapDistricts.build(districts + [bad], 'second', self.path)
+            assert False, 'expected a ValueError'
+        except ValueError:
+            pass
+
+        # a failed build leaves the last index, and nothing else, behind
+        assert temp_files() == []
+        assert MmapDistricts.open(self.path, 'first') is not None
+
+    def test_political_data_mmap_backend(self):
+        data = PoliticalData(CacheHandler(None), False,
+                             districts_backend='mmap')
+
+        assert isinstance(data.district_index, MmapDistricts)
+        assert data.get_districts('98004') == \
+            self.dict_districts.lookup('98004')
+
+
+class TestTemplateCache():
+    def setUp(self):
+        self.campaigns = reference_data.read_campaigns()
+        self.templates = TemplateCache()
+        self.templates.warm(self.campaigns)
+
+    def test_renders_like_pystache(self):
+        context = {'name': 'Senator Maria Cantwell', 'n_reps': 3,
+                   'many_reps': True, 'title': 'Sen', 'state': 'WA',
+                   'office': 'Main <Office>'}
+
+        for campaign in self.campaigns.itervalues():
+            for field, template in campaign.iteritems():
+                if field.startswith('msg_') and template:
+                    assert self.templates.render(template, context) == \
+                        pystache.render(template, context)
+
+    def test_warm_parses_templates_once(self):
+        template = self.campaigns['default']['msg_rep_intro']
+
+        assert template in self.templates.templates
+        assert self.templates.parse(template) is \
+            self.templates.templates[template]
+
+    def test_plain_messages_skip_pystache(self):
+        template = 'http://example.com/intro.mp3'
+
+        assert self.templates.render(template, {}) is template
+        assert template not in self.templates.templates
+
+
+class TestTwimlCache():
+    def setUp(self):
+        self.twiml_cache = TwimlCache()
+        self.campaign = {'id': 'test', 'msg_intro': 'Hi & welcome'}
+
+    def build(self, campaign, action):
+        resp = twilio.twiml.Response()
+        resp.say(campaign['msg_intro'])
+
+        with resp.gather(numDigits=5, action=action) as g:
+            g.play('http://example.com/ask_zip.mp3')
+
+        return resp
+
+    def test_spliced_action_matches_fresh_response(self):
+        action = '/zip_parse?campaignId=test&repIds=A&repIds=B"'
+
+        assert self.twiml_cache.render('gather', self.campaign, self.build,
+                                       action) == \
+            str(self.build(self.campaign, action))
+
+    def test_rebuilds_for_reloaded_campaign(self):
+        self.twiml_cache.render('gather', self.campaign, self.build, '/a')
+        campaign = dict(self.campaign, msg_intro='Reloaded')
+
+        assert 'Reloaded' in self.twiml_cache.render('gather', campaign,
+                                                     self.build, '/a')
+
+
+class SpreadsheetStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serves the published spreadsheet feed JSON held in `feed`"""
+
+    feed = None
+    status = 200
+    requests = 0
+
+    def do_GET(self):
+        SpreadsheetStub.requests += 1
+        self.send_response(self.status)
+        self.end_headers()
+        self.wfile.write(json.dumps(self.feed))
+
+    def log_message(self, *args):
+        pass
+
+
+def override_row(state, target_senate):
+    row = {
+        'gsx$state': state,
+        'gsx$targetsenate': 'TRUE' if target_senate else 'FALSE',
+        'gsx$targethouse': 'TRUE',
+        'gsx$targethousefirst': 'FALSE',
+        'gsx$optionaltargetindividualfirstlastname': '',
+        'gsx$optionalextrafirstcallname': '',
+        'gsx$optionalextrafirstcallnumber': ''
+    }
+    return {k: {'$t': v} for k, v in row.items()}
+
+
+class TestSpreadsheetRefresh():
+    def setUp(self):
+        SpreadsheetStub.feed = {'feed': {'entry': [override_row('WA', True)]}}
+        SpreadsheetStub.status = 200
+        SpreadsheetStub.requests = 0
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                SpreadsheetStub)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # no local tier, every refresh goes back to the spreadsheet
+        self.data = PoliticalData(CacheHandler(None, local_size=0), False)
+        self.data.SPREADSHEET_URL = 'http://127.0.0.1:%d/%%s' % \
+            self.server.server_port
+        self.campaign = dict(self.data.get_campaign('default'),
+                             id='overrides-test',
+                             overrides_google_spreadsheet_id='abc')
+
+    def tearDown(self):
+        # the refreshers would otherwise keep polling a closed stub
+        self.data.spreadsheets.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_serves_last_good_copy(self):
+        key = 'overrides-test-spreadsheet-data'
+        overrides = self.data.get_overrides(self.campaign)
+
+        assert overrides['WA']['target_senate'] is True
+        assert self.data.spreadsheets.version(key) == 1
+
+        # later gets don't go back to the spreadsheet
+        self.data.get_overrides(self.campaign)
+        assert SpreadsheetStub.requests == 1
+
+        SpreadsheetStub.status = 500
+        assert not self.data.spreadsheets.refresh(key)
+        assert self.data.get_overrides(self.campaign) == overrides
+
+        SpreadsheetStub.status = 200
+        SpreadsheetStub.feed = {'feed': {'entry': [override_row('WA', False)]}}
+        assert self.data.spreadsheets.refresh(key)
+        assert self.data.get_overrides(self.campaign)['WA']['target_senate'] \
+            is False
+        assert self.data.spreadsheets.version(key) == 2
+
+    def test_unchanged_sheet_keeps_its_version(self):
+        key = 'overrides-test-spreadsheet-data'
+        districts = self.data.get_districts('98004')
+
+        override = self.data.get_override_values(districts, self.campaign)
+        assert override['_STATE_ABBREV'] == 'WA'
+
+        for i in range(2):
+            assert self.data.spreadsheets.refresh(key)
+            self.data.get_override_values(districts, self.campaign)
+
+        assert self.data.spreadsheets.version(key) == 1
+        assert '_STATE_ABBREV' not in self.data.get_overrides(
+            self.campaign)['WA']
+
+    def test_refreshes_in_background(self):
+        self.data.spreadsheets.interval = 0.05
+        self.data.get_overrides(self.campaign)
+
+        SpreadsheetStub.feed = {'feed': {'entry': [override_row('OR', True)]}}
+        gevent.sleep(0.2)
+
+        assert 'OR' in self.data.get_overrides(self.campaign)
+        assert SpreadsheetStub.requests > 1
+
+    def test_first_fetch_failure_uses_default(self):
+        SpreadsheetStub.status = 500
+
+        assert self.data.get_overrides(self.campaign) == {}
+
+
+class FakeRedis():
+    """the slice of the redis client CacheHandler uses, with expiry"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = []
+
+    def expired(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.delete(key)
+
+    def get(self, key):
+        self.expired(key)
+        return self.data.get(key)
+
+    def set(self, key, val, ex=None, px=None, nx=False):
+        self.expired(key)
+
+        if nx and key in self.data:
+            return None
+
+        self.data[key] = val
+        self.expires.pop(key, None)
+
+        if ex:
+            self.expires[key] = time.time() + ex
+        elif px:
+            self.expires[key] = time.time() + px / 1000.0
+
+        return True
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def setex(self, key, val, expire):
+        return self.set(key, val, px=expire * 1000)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def publish(self, channel, message):
+        # stands in for every worker's invalidation subscription
+        for cache_handler in self.subscribers:
+            cache_handler.evict(message)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    """queues FakeRedis calls until execute()"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwds: self.calls.append((method, args, kwds))
+
+    def execute(self):
+        return [method(*args, **kwds) for method, args, kwds in self.calls]
+
+
+class TestSingleFlight():
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.fills = 0
+
+    def cache_handler(self):
+        cache_handler = CacheHandler(None)
+        cache_handler.redis_conn = self.redis
+        cache_handler.FILL_POLL_INTERVAL = 0.01
+        return cache_handler
+
+    def fill(self):
+        self.fills += 1
+        gevent.sleep(0.05)
+        return 'filled'
+
+    def test_one_fill_across_greenlets_and_workers(self):
+        workers = [self.cache_handler() for i in range(4)]
+        greenlets = [gevent.spawn(w.get_or_fill, 'key', self.fill, 60)
+                     for w in workers for i in range(25)]
+        gevent.joinall(greenlets)
+
+        assert [g.value for g in greenlets] == ['filled'] * 100
+        assert self.fills == 1
+        assert sum(w.stats['coalesced_waits'] for w in workers) == 96
+        assert sum(w.stats['lock_waits'] for w in workers) == 3
+        assert sum(w.stats['fetches'] for w in workers) == 1
+        assert self.redis.get('key-fill-lock') is None
+
+    def test_stuck_lock_times_out(self):
+        self.redis.set('key-fill-lock', 'dead worker', px=60000)
+        cache_handler = self.cache_handler()
+
+        assert cache_handler.get_or_fill('key', self.fill, 60, 0.05) == \
+            'filled'
+        assert cache_handler.stats['lock_timeouts'] == 1
+        assert self.redis.get('key') == 'filled'
+
+    def test_fill_errors_reach_every_waiter(self):
+        def fail():
+            gevent.sleep(0.01)
+            raise IOError('spreadsheet down')
+
+        cache_handler = self.cache_handler()
+        greenlets = [gevent.spawn(cache_handler.get_or_fill, 'key', fail)
+                     for i in range(3)]
+        gevent.joinall(greenlets)
+
+        assert all(isinstance(g.exception, IOError) for g in greenlets)
+        assert cache_handler.stats['fetch_errors'] == 1
+        assert cache_handler.inflight == {}
+
+
+class TestTwoTierCache():
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def cache_handler(self, channel=None, **kwargs):
+        cache_handler = CacheHandler(None, **kwargs)
+        cache_handler.redis_conn = self.redis
+
+        if channel:
+            cache_handler.invalidation_channel = channel
+            self.redis.subscribers.append(cache_handler)
+
+        return cache_handler
+
+    def test_local_tier_answers_repeat_reads(self):
+        cache_handler = self.cache_handler()
+        self.redis.set('key', 'value')
+
+        assert cache_handler.get('key', None) == 'value'
+        self.redis.delete('key')
+        assert cache_handler.get('key', None) == 'value'
+        assert cache_handler.get('missing', 'default') == 'default'
+
+        assert cache_handler.stats['local_hits'] == 1
+        assert cache_handler.stats['redis_hits'] == 1
+        assert cache_handler.stats['redis_misses'] == 1
+        assert cache_handler.hit_ratios() == {'local': 1 / 3.0, 'redis': 0.5}
+
+    def test_local_tier_is_bounded_and_expires(self):
+        cache_handler = self.cache_handler(local_size=2, local_ttl=0.05)
+
+        for key in ('a', 'b', 'c'):
+            cache_handler.set(key, key.upper())
+
+        assert len(cache_handler.local) == 2
+        assert cache_handler.local.get('a') is None
+        assert cache_handler.local.get('c') == 'C'
+
+        time.sleep(0.06)
+        assert cache_handler.local.get('c') is None
+        assert cache_handler.get('c', None) == 'C'  # still in Redis
+
+    def test_invalidate_evicts_every_worker(self):
+        refreshed = []
+        workers = [self.cache_handler('invalidations') for i in range(3)]
+        workers[1].invalidation_hooks.append(refreshed.append)
+
+        workers[0].set('key', 'old')
+        for worker in workers:
+            assert worker.get('key', None) == 'old'
+
+        workers[2].invalidate('key')
+
+        assert [w.get('key', None) for w in workers] == [None] * 3
+        assert [w.stats['invalidations'] for w in workers] == [1] * 3
+        assert refreshed == ['key']
+
+    def test_no_redis(self):
+        cache_handler = CacheHandler(None)
+        cache_handler.set('key', 'value', 60)
+        assert cache_handler.get('key', None) == 'value'
+
+        cache_handler.invalidate('key')
+        assert cache_handler.get('key', None) is None
+        assert cache_handler.hit_ratios()['redis'] is None
+
+
+class TestSlidingWindows():
+    def setUp(self):
+        self.windows = MemoryWindows(100)
+
+    def test_counts_hits_before_this_one(self):
+        assert [self.windows.hit('a', t) for t in (0, 10, 20)] == [0, 1, 2]
+        assert self.windows.hit('b', 20) == 0
+
+    def test_old_hits_slide_out(self):
+        for t in (0, 50, 100):
+            self.windows.hit('a', t)
+
+        # like create_date >= NOW() - '1 day', the cutoff itself still counts
+        assert self.windows.hit('a', 100) == 3
+        assert self.windows.hit('a', 101) == 3
+        assert self.windows.hit('a', 500) == 0
+
+    def test_seed_and_prune(self):
+        self.windows.seed('a', 10, 1)
+        self.windows.seed('a', 20, 2)
+        self.windows.hit('b', 30)
+
+        assert self.windows.hit('a', 60) == 2
+
+        self.windows.prune(135)
+        assert len(self.windows) == 1
+        assert self.windows.hit('a', 135) == 1
+
+
+class TestRedisWindowSeeding():
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def test_one_worker_seeds(self):
+        first = RedisWindows(self.redis, 100)
+        second = RedisWindows(self.redis, 100)
+
+        assert first.needs_seed()
+        assert not second.needs_seed()
+
+        first.mark_seeded()
+        assert not second.needs_seed()
+        assert not RedisWindows(self.redis, 100).needs_seed()
+
+    def test_seeding_is_taken_over_if_it_never_finishes(self):
+        first = RedisWindows(self.redis, 100)
+        first.SEED_TIMEOUT = 0.05
+
+        assert first.needs_seed()
+        assert not RedisWindows(self.redis, 100).needs_seed()
+
+        time.sleep(0.1)
+        assert RedisWindows(self.redis, 100).needs_seed()
+
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, qry, args=()):
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+        self.conn.queries.append(qry)
+        self.conn.args.append(args)
+
+        if self.conn.on_execute:
+            self.conn.on_execute(qry)
+
+    def fetchone(self):
+        return self.conn.row
+
+    def fetchall(self):
+        # ids from the sequence, for SELECT nextval(...) FROM generate_series
+        first = self.conn.next_id
+        self.conn.next_id += self.conn.args[-1][0]
+        return [(i,) for i in range(first, self.conn.next_id)]
+
+    def mogrify(self, qry, args):
+        return '(%s)' % ', '.join('%s' % repr(arg) for arg in args)
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+    """a psycopg2 connection whose queries all return row"""
+
+    def __init__(self, row=(0, 0, 0)):
+        self.row = row
+        self.queries = []
+        self.args = []
+        self.next_id = 1
+        self.on_execute = None
+        self.commits = 0
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool():
+    def setUp(self):
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+    def test_bounded_across_greenlets(self):
+        pool = ConnectionPool(self.connect, 2)
+        active = []
+
+        def query():
+            with pool.connection() as conn:
+                active.append(conn)
+                assert len(active) <= 2
+                gevent.sleep(0.01)
+                active.remove(conn)
+
+        gevent.joinall([gevent.spawn(query) for i in range(6)])
+
+        assert len(self.connections) == 2
+        assert pool.stats['waits'] == 4
+        assert [c.commits for c in self.connections] == [3, 3]
+
+    def test_broken_connection_is_replaced(self):
+        pool = ConnectionPool(self.connect, 2)
+
+        with pool.connection() as conn:
+            conn.broken = True
+
+        try:
+            with pool.connection() as conn:
+                conn.cursor().execute("SELECT 1")
+        except psycopg2.OperationalError:
+            pass
+        else:
+            assert False, 'expected OperationalError'
+
+        with pool.connection() as conn:
+            assert conn is self.connections[1]
+
+        assert self.connections[0].closed
+        assert pool.stats['discarded'] == 1
+
+    def test_idle_connections_are_checked(self):
+        pool = ConnectionPool(self.connect, 2)
+        pool.CHECK_AFTER = 0
+
+        with pool.connection() as conn:
+            pass
+        conn.broken = True
+
+        with pool.connection() as conn:
+            assert conn is self.connections[1]
+
+
+class TestThrottle():
+    def throttle(self, row, override='x'):
+        conn = FakeConnection(row)
+        throttle = Throttle(write_behind=False)
+        throttle.pool = ConnectionPool(lambda: conn, 1)
+
+        tripped = throttle.throttle('default', '4150001111', '10.0.0.1',
+                                    override)
+
+        # one query for the counts, one to log the call
+        assert len(conn.queries) == 2
+        assert conn.commits == 1
+
+        return tripped
+
+    def test_counts_trip(self):
+        assert not self.throttle((1, 1, 0))
+        assert self.throttle((2, 0, 0))
+        assert self.throttle((0, 2, 0))
+        assert self.throttle((0, 0, 1))
+
+    def test_override(self):
+        os.environ['THROTTLE_OVERRIDE_KEY'] = 'letmein'
+
+        try:
+            assert not self.throttle((5, 5, 0), 'letmein')
+            assert self.throttle((0, 0, 1), 'letmein')
+        finally:
+            del os.environ['THROTTLE_OVERRIDE_KEY']
+
+
+class TestThrottleLog():
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.throttle = Throttle()
+        self.throttle.pool = ConnectionPool(lambda: self.conn, 2)
+        self.log = self.throttle.log = ThrottleLog(self.throttle.pool)
+        self.log.FLUSH_INTERVAL = 60
+
+    def call(self, ip_address='10.0.0.1'):
+        return self.throttle.throttle('default', '4150001111', ip_address,
+                                      'x')
+
+    def test_unflushed_rows_count(self):
+        assert [self.call('10.0.0.%d' % i) for i in range(3)] == \
+            [False, False, True]
+        assert len(self.log.pending) == 3
+        assert len(self.conn.queries) == 3     # no inserts yet
+
+        assert self.log.flush()
+        assert self.conn.args[-2] == (3,)       # ids taken for the batch
+        assert self.conn.queries[-1].count('(%s') == 0     # mogrified
+        assert self.conn.queries[-1].count('),(') == 2
+        assert self.log.pending == []
+        assert self.log.stats['flushed'] == 3
+
+    def test_batch_being_flushed(self):
+        self.call()
+        self.log.inflight, self.log.pending = self.log.pending, []
+        self.log.inflight_ids = [7]
+
+        # committed or not, the batch is left out of the table counts by id
+        # and counted from memory, on top of an older call in the table
+        self.conn.row = (1, 0, 0)
+        assert self.call()
+        assert self.conn.args[-1][2] == [7]
+
+        self.log.inflight, self.log.inflight_ids = [], []
+
+    def test_recounts_when_a_batch_lands_mid_query(self):
+        self.call()
+
+        # the first count sees the flushed row in the table, as well as in
+        # its copy of the pending rows
+        def flush_during_count(qry):
+            if self.conn.on_execute and 'FROM _ms_call_blacklist' in qry:
+                self.conn.on_execute = None
+                self.conn.row = (1, 0, 0)
+                self.log.flush()
+
+        self.conn.on_execute = flush_during_count
+        assert not self.call('10.0.0.2')
+        assert len([qry for qry in self.conn.queries
+                    if 'FROM _ms_call_blacklist' in qry]) == 3
+
+    def test_failed_flush_keeps_rows(self):
+        self.log.MAX_PENDING = 2
+        self.conn.broken = True
+
+        for i in range(3):
+            self.log.append(('default', '415-000-1111', 0, 0, 'x', 0, 0,
+                             time.time()), 'x')
+
+        assert not self.log.flush()
+        assert len(self.log.pending) == 2
+        assert self.log.stats['dropped'] == 1
+        assert self.log.stats['flush_errors'] == 1
+
+        self.conn.broken = False
+        self.log.close()
+        assert self.log.pending == []
+        assert self.log.stats['flushed'] == 2
+
+
+class LeaderboardStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    records the (path, body) of every successful POST in `posts`, answering
+    with the codes in `statuses` first
+    """
+
+    posts = []
+    keys = []
+    statuses = []
+    delay = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.delay)
+        status = LeaderboardStub.statuses.pop(0) \
+            if LeaderboardStub.statuses else 200
+
+        if status == 200:
+            LeaderboardStub.posts.append((self.path, body))
+            LeaderboardStub.keys.append(self.headers.get('Idempotency-Key'))
+
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLeaderboard():
+    def setUp(self):
+        LeaderboardStub.posts = []
+        LeaderboardStub.keys = []
+        LeaderboardStub.statuses = []
+        LeaderboardStub.delay = 0
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                LeaderboardStub)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def leaderboard(self, pool_size=2, queue_size=100, batch=False,
+                    spool_path=None):
+        batch_urls = {}
+
+        if batch:
+            batch_urls[self.url + '/log'] = self.url + '/log_batch'
+
+        leaderboard = FFTFLeaderboard(False, pool_size, 'key', queue_size,
+                                      batch_urls, spool_path)
+        leaderboard.LEADERBOARD_URL = self.url + '/log'
+        leaderboard.QUEUE_URL = self.url + '/log_phone_call'
+        leaderboard.BATCH_WAIT = 0.05
+        leaderboard.POLL_INTERVAL = 0.02
+        leaderboard.open_spool().BASE_BACKOFF = 0.01
+
+        return leaderboard
+
+    def wait_for(self, leaderboard, n):
+        with gevent.Timeout(5):
+            while leaderboard.stats['sent'] + leaderboard.stats['failed'] < n:
+                gevent.sleep(0.01)
+
+    def test_posts_through_one_session(self):
+        leaderboard = self.leaderboard()
+
+        for i in range(5):
+            leaderboard.post_to_leaderboard('fftf', 'call', str(i),
+                                            'example.com', 'abc')
+        self.wait_for(leaderboard, 5)
+
+        assert leaderboard.stats['sent'] == 5
+        assert sorted(path for path, body in LeaderboardStub.posts) == \
+            ['/log'] * 5
+        assert 'stat=call' in LeaderboardStub.posts[0][1]
+
+    def test_batches(self):
+        leaderboard = self.leaderboard(batch=True)
+
+        for i in range(5):
+            leaderboard.post_to_leaderboard('fftf', 'call', str(i),
+                                            'example.com', 'abc')
+        self.wait_for(leaderboard, 5)
+
+        assert leaderboard.stats['batches'] == 1
+        path, body = LeaderboardStub.posts[0]
+        assert path == '/log_batch'
+        assert [event['data'] for event in json.loads(body)] == \
+            ['0', '1', '2', '3', '4']
+
+    def test_drops_when_backed_up(self):
+        LeaderboardStub.delay = 0.05
+        leaderboard = self.leaderboard(pool_size=1, queue_size=2)
+
+        for i in range(10):
+            leaderboard.post_to_leaderboard('fftf', 'call', str(i),
+                                            'example.com', 'abc')
+
+        assert leaderboard.stats['dropped'] == 8
+        self.wait_for(leaderboard, 2)
+        assert len(LeaderboardStub.posts) == 2
+
+    def test_retries_with_backoff(self):
+        LeaderboardStub.statuses = [503, 500]
+        leaderboard = self.leaderboard()
+
+        leaderboard.post_to_leaderboard('fftf', 'call', '0', 'example.com',
+                                        'abc')
+        self.wait_for(leaderboard, 3)
+
+        assert leaderboard.stats['failed'] == 2
+        assert leaderboard.stats['sent'] == 1
+        assert len(LeaderboardStub.posts) == 1
+        assert leaderboard.metrics()['endpoints'][self.url + '/log'][
+            'depth'] == 0
+
+    def test_rejected_posts_are_not_retried(self):
+        LeaderboardStub.statuses = [400]
+        leaderboard = self.leaderboard()
+
+        leaderboard.post_to_leaderboard('fftf', 'call', '0', 'example.com',
+                                        'abc')
+
+        with gevent.Timeout(5):
+            while not leaderboard.stats['rejected']:
+                gevent.sleep(0.01)
+
+        gevent.sleep(0.1)
+        assert LeaderboardStub.posts == []
+        assert leaderboard.spool.depth(self.url + '/log') == 0
+
+    def test_call_sid_keys(self):
+        leaderboard = self.leaderboard()
+        request = type('Request', (), {'values': {'CallSid': 'CA123'}})
+
+        # Twilio retrying a webhook sends the same CallSid again
+        for i in range(3):
+            leaderboard.post_to_leaderboard(
+                'fftf', 'calls_complete', 'yay', 'example.com', 'abc',
+                leaderboard.idempotency_key(request, 'calls_complete'))
+        self.wait_for(leaderboard, 1)
+
+        assert leaderboard.stats['duplicates'] == 2
+        assert LeaderboardStub.keys == [
+            leaderboard.idempotency_key(request, 'calls_complete')]
+        assert leaderboard.idempotency_key(request, 'call', 0) != \
+            leaderboard.idempotency_key(request, 'call', 1)
+
+    def test_spool_is_created_by_the_first_event(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+
+        try:
+            leaderboard = FFTFLeaderboard(False, 2, 'key', spool_path=path)
+            leaderboard.LEADERBOARD_URL = self.url + '/log'
+            assert not os.path.exists(path)
+
+            leaderboard.post_to_leaderboard('fftf', 'call', '1',
+                                            'example.com', 'abc')
+            assert os.path.exists(path)
+            self.wait_for(leaderboard, 1)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_locked_spool_drops_the_event(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+
+        try:
+            leaderboard = self.leaderboard(spool_path=path)
+            leaderboard.spool.LOCKED_WAIT = 0.001
+
+            # another worker holds the write lock for longer than we wait
+            other = EventSpool(path)
+            other.conn.execute("BEGIN IMMEDIATE")
+
+            leaderboard.post_to_leaderboard('fftf', 'call', '1',
+                                            'example.com', 'abc')
+            assert leaderboard.stats['dropped'] == 1
+
+            # once it lets go events are spooled and sent again
+            other.conn.execute("COMMIT")
+            leaderboard.post_to_leaderboard('fftf', 'call', '2',
+                                            'example.com', 'abc')
+            self.wait_for(leaderboard, 1)
+            assert leaderboard.stats['sent'] == 1
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_spool_survives_restart(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+
+        try:
+            spool = EventSpool(path)
+
+            for i in range(3):
+                spool.append(self.url + '/log', {'data': str(i)})
+            spool.conn.close()
+
+            # a new leaderboard drains what the last one left behind
+            leaderboard = self.leaderboard(spool_path=path)
+            self.wait_for(leaderboard, 3)
+
+            assert [body for path_, body in LeaderboardStub.posts] == \
+                ['data=0', 'data=1', 'data=2']
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+class TestCallLog():
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine(
+            'sqlite:///' + os.path.join(self.dir, 'calls.db'))
+        db.Model.metadata.create_all(self.engine)
+
+        self.log = CallLog(self.engine, os.path.join(self.dir, 'calls.spool'))
+        self.log.flusher.kill()
+
+    def tearDown(self):
+        # not at exit, when the spool's directory is gone
+        del self.log.pending[:]
+
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def log_calls(self, n, campaign_id='default', zipcode='94110'):
+        params = {'repIds': ['P000197'] * n, 'user_zipcode': zipcode,
+                  'userPhone': '415-555-0100'}
+
+        for i in range(n):
+            request = type('Request', (), {'values': {
+                'call_index': str(i), 'CallSid': 'CA%d' % i,
+                'DialCallStatus': 'completed', 'DialCallDuration': '30'}})
+            self.log.log_call(params, {'id': campaign_id}, request)
+
+    def count(self):
+        return self.engine.execute(
+            Call.__table__.count()).scalar()
+
+    def app_context(self):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = str(self.engine.url)
+        db.init_app(app)
+
+        return app.app_context()
+
+    def counters(self):
+        table = CallCount.__table__
+        return dict(self.engine.execute(
+            table.select().with_only_columns(
+                [table.c.campaign_id, table.c.calls])).fetchall())
+
+    def test_batches(self):
+        self.log.FLUSH_ROWS = 2
+        self.log_calls(5)
+        assert self.count() == 0
+
+        while self.log.pending:
+            assert self.log.flush()
+
+        assert self.count() == 5
+        assert self.log.stats['batches'] == 3
+        row = self.engine.execute(Call.__table__.select()).first()
+        assert (row.campaign_id, row.areacode, row.duration) == \
+            ('default', '415', 30)
+
+    def test_spools_while_database_is_down(self):
+        Call.__table__.drop(self.engine)
+        self.log_calls(3)
+
+        assert not self.log.flush()
+        assert self.log.stats['spooled'] == 3
+        assert self.log.pending == []
+
+        Call.__table__.create(self.engine)
+        self.log_calls(1)
+
+        # the next batch that goes through brings the spooled ones along
+        assert self.log.flush()
+        assert self.count() == 4
+        assert self.log.stats['replayed'] == 3
+        assert not os.path.exists(self.log.spool_path)
+
+    def test_bad_row_does_not_hold_up_the_batch(self):
+        self.engine.execute("CREATE TRIGGER bad_rows BEFORE INSERT ON calls "
+                            "WHEN NEW.member_id = 'bad' "
+                            "BEGIN SELECT RAISE(ABORT, 'bad row'); END")
+        self.log_calls(2)
+        self.log.append(dict(self.log.pending[0], member_id='bad'))
+        self.log_calls(1)
+
+        assert self.log.flush()
+        assert self.count() == 3
+        assert self.log.stats['rejected'] == 1
+        assert not os.path.exists(self.log.spool_path)
+
+        with open(self.log.rejected_path) as f:
+            assert json.loads(f.readline())['member_id'] == 'bad'
+
+        # spooled while the database was down, it's set aside on replay
+        self.log.spool([call_row(Call('default', 'bad'))])
+        assert self.log.replay() == 0
+        assert self.log.stats['rejected'] == 2
+        assert not os.path.exists(self.log.spool_path)
+
+    def test_special_call_ids_fit_the_column(self):
+        member_id = 'S_' + json.dumps({'p': '+15555550100', 'n': 'Office'})
+        row = call_row(Call('default', member_id, zipcode='941101234'))
+
+        assert len(row['member_id']) == 10
+        assert row['member_id'].startswith('S_')
+        other = call_row(Call('default', member_id + ' '))
+        assert row['member_id'] != other['member_id']
+        assert row['zipcode'] == '94110'
+
+    def test_retries_deadlocked_batches(self):
+        deadlock = type('TransactionRollbackError', (Exception,),
+                        {'pgcode': '40P01'})()
+        calls = []
+
+        def insert_calls(conn, rows):
+            calls.append(rows)
+
+            if len(calls) == 1:
+                raise OperationalError('INSERT', {}, deadlock)
+
+            original(conn, rows)
+
+        original, models.insert_calls = models.insert_calls, insert_calls
+
+        try:
+            self.log_calls(2)
+            assert self.log.flush()
+        finally:
+            models.insert_calls = original
+
+        assert len(calls) == 2
+        assert self.count() == 2
+
+    def test_counters_are_updated_in_key_order(self):
+        rows = [{'campaign_id': campaign_id, 'member_id': member_id,
+                 'zipcode': '94110', 'timestamp': datetime(2016, 1, 1)}
+                for campaign_id in ('b', 'a') for member_id in ('Y', 'X')]
+        keys = [(table.name, sorted(key.items()))
+                for table, key, n in rollups(rows)]
+
+        assert keys == sorted(keys)
+
+    def test_new_call_without_call_index(self):
+        request = type('Request', (), {'values': {}})
+        call = new_call({'repIds': ['P000197'], 'user_zipcode': None,
+                         'userPhone': None}, {'id': 'default'}, request)
+
+        assert call.member_id == 'P000197'
+
+        call = new_call({'repIds': [], 'user_zipcode': None,
+                         'userPhone': None}, {'id': 'default'}, request)
+        assert call.member_id is None
+
+    def test_failed_flush_spools_everything_waiting(self):
+        self.log.FLUSH_ROWS = 2
+        Call.__table__.drop(self.engine)
+        self.log_calls(5)
+
+        assert not self.log.flush()
+        assert self.log.pending == []
+        assert self.log.stats['spooled'] == 5
+
+    def test_spools_past_max_pending(self):
+        # a flush hanging on the database doesn't let rows pile up
+        self.log.MAX_PENDING = 3
+        self.log_calls(5)
+
+        assert len(self.log.pending) == 3
+        assert self.log.stats['spooled'] == 2
+
+        with open(self.log.spool_path) as f:
+            assert [json.loads(line)['call_id'] for line in f] == \
+                ['CA0', 'CA1']
+
+    def test_close_spools_what_is_left(self):
+        Call.__table__.drop(self.engine)
+        self.log_calls(2)
+        self.log.close()
+
+        with open(self.log.spool_path) as f:
+            assert len(f.readlines()) == 2
+
+    def test_counts_calls_as_they_are_inserted(self):
+        self.log_calls(3)
+        self.log_calls(2, campaign_id='other')
+        self.log_calls(1, zipcode=None)
+        self.log.flush()
+        self.log_calls(1)
+        self.log.flush()
+
+        assert self.counters() == {'default': 4, 'other': 2}
+
+    def test_backfill_and_reconcile(self):
+        self.log_calls(3)
+        self.log.flush()
+        self.engine.execute(CallCount.__table__.delete())
+        self.log_calls(2, campaign_id='other')
+        self.log.flush()
+
+        assert reconcile_call_counts(self.engine) == {'default': (0, 3)}
+        assert reconcile_call_counts(self.engine, fix=True)
+        assert reconcile_call_counts(self.engine) == {}
+
+        self.engine.execute(CallCount.__table__.update().values(calls=7))
+        assert backfill_call_counts(self.engine) == {'default': 3, 'other': 2}
+        assert self.counters() == {'default': 3, 'other': 2}
+
+    def test_hourly_rollups(self):
+        now = datetime.now()
+        hour_ago = now - timedelta(hours=1, minutes=1)
+
+        for timestamp, zipcode, member_id in (
+                (now, '94110', 'P000197'),
+                (now, '94110', 'B000711'),
+                (hour_ago, '98004', 'P000197'),
+                (hour_ago, None, 'P000197')):
+            self.log.append({'campaign_id': 'default', 'timestamp': timestamp,
+                             'zipcode': zipcode, 'member_id': member_id,
+                             'status': 'completed'})
+        self.log.flush()
+
+        with self.app_context():
+            stats = aggregate_stats('default')
+            assert stats['calls'] == {
+                'zipcodes': {'94110': 2, '98004': 1},
+                'reps': {'P000197': 3, 'B000711': 1}}
+
+            # the last hour only reads the current hour's rollups
+            assert aggregate_stats('default', now)['calls']['reps'] == \
+                {'P000197': 1, 'B000711': 1}
+
+            # rebuilt from the calls table, the rollups come out the same
+            assert backfill_rollups(self.engine) == 5
+            assert aggregate_stats('default') == stats
+
+    def test_pages_newest_first(self):
+        start = datetime(2016, 1, 1)
+
+        # pairs of calls logged in the same microsecond, so the cursor
+        # has to tell them apart by id
+        for i in range(10):
+            self.log.append({'campaign_id': 'default', 'member_id': str(i),
+                             'timestamp': start + timedelta(seconds=i / 2),
+                             'zipcode': '94110'})
+        self.log.append({'campaign_id': 'other', 'member_id': 'x',
+                         'timestamp': start, 'zipcode': '94110'})
+        self.log.flush()
+
+        with self.app_context():
+            pages = [call_list('default', start, 3)]
+
+            while len(pages[-1]) == 3:
+                pages.append(call_list('default', start, 3,
+                                       call_cursor(pages[-1][-1])))
+
+            assert [[call.member_id for call in page] for page in pages] == \
+                [['9', '8', '7'], ['6', '5', '4'], ['3', '2', '1'], ['0']]
+            assert [call.member_id for call in call_list(
+                'default', start + timedelta(seconds=4), 5)] == ['9', '8']
+
+    def test_migrate_adds_missing_indexes(self):
+        for index in Call.__table__.indexes:
+            index.drop(self.engine)
+
+        assert migrate(self.engine) == ['ix_calls_campaign_id_timestamp']
+        assert migrate(self.engine) == []
+
+
+class TestLiveFeed():
+    def setUp(self):
+        self.feed = LiveFeed()
+
+    def test_fans_out_to_the_campaigns_viewers(self):
+        viewers = [self.feed.subscribe('default') for i in range(3)]
+        other = self.feed.subscribe('other')
+
+        self.feed.publish('default', {'number': '415-555-XXXX'})
+
+        assert [viewer.get_nowait() for viewer in viewers] == \
+            [{'number': '415-555-XXXX'}] * 3
+        assert other.empty()
+
+    def test_new_viewers_get_recent_calls(self):
+        for i in range(self.feed.RECENT + 5):
+            self.feed.publish('default', i)
+
+        viewer = self.feed.subscribe('default')
+        stream = self.feed.stream('default', viewer)
+
+        assert stream.next() == 'retry: 5000\n\n'
+        assert stream.next() == 'event: call\ndata: 5\n\n'
+        assert viewer.qsize() == self.feed.RECENT - 1
+
+        stream.close()
+        assert self.feed.clients == {}
+
+    def test_drops_slow_viewers(self):
+        self.feed.QUEUE_SIZE = 2
+        slow = self.feed.subscribe('default')
+        fast = self.feed.subscribe('default')
+        stream = self.feed.stream('default', slow)
+        stream.next()
+
+        for i in range(3):
+            self.feed.publish('default', i)
+            fast.get_nowait()
+
+        assert self.feed.stats['dropped_clients'] == 1
+        assert self.feed.clients == {'default': set([fast])}
+        assert list(stream) == []
+
+    def test_only_watched_campaigns_are_published(self):
+        assert not self.feed.watched('default')
+
+        viewer = self.feed.subscribe('default')
+        assert self.feed.watched('default')
+        assert not self.feed.watched('other')
+
+        # for a while after the last viewer leaves, so it can come back to
+        # the recent calls
+        self.feed.unsubscribe('default', viewer)
+        assert self.feed.watched('default')
+
+        self.feed.watched_until['default'] = time.time() - 1
+        assert not self.feed.watched('default')
+
+    def test_refuses_viewers_past_max_clients(self):
+        self.feed.max_clients = 2
+
+        assert self.feed.subscribe('default')
+        assert self.feed.subscribe('other')
+        assert self.feed.subscribe('default') is None
@@ -1,13 +1,22 @@
-import os, psycopg2, hashlib
+import os, psycopg2, hashlib, time
+
+import gevent
+
+from pg_pool import ConnectionPool, make_green
+from sliding_window import MemoryWindows, RedisWindows
+from write_behind import WriteBehind
 
 class Throttle():
 
-    conn = None
+    pool = None
+    log = None      # ThrottleLog buffering inserts, None to insert inline
+
+    def __init__(self, pool_size=10, write_behind=True):
 
-    def __init__(self):
+        self.pool = connection_pool(pool_size)
 
-        url = os.environ.get('HEROKU_POSTGRESQL_AMBER_URL')
-        self.conn = psycopg2.connect(url)
+        if write_behind:
+            self.log = ThrottleLog(self.pool)
 
     def throttle(self, campaign_id, from_phone_number, ip_address, override):
         """Records call info in the log"""
@@ -17,9 +26,6 @@ class Throttle():
 
         from_phone_number = format_phone_number(from_phone_number)
 
-        conn = self.conn
-        cur = conn.cursor()
-
         flag_number = 0
         flag_ip = 0
         blacklist = 0
@@ -27,65 +33,345 @@ class Throttle():
 
         hashed_ip_address = hashlib.sha256(ip_address).hexdigest()
 
-        qry = ("SELECT count(id) FROM _ms_call_throttle WHERE "
-               "create_date >= NOW() - '1 day'::INTERVAL "
-               " AND campaign_id=%s AND from_phone_number=%s")
-        cur.execute(qry, (campaign_id, from_phone_number))
-        recent_from_phone_number = cur.fetchone()
+        now = time.time()
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+
+            for attempt in range(RECOUNT_ATTEMPTS):
+                unflushed, inflight, inflight_ids, generation = \
+                    self.log.unflushed() if self.log else ([], [], [], None)
+
+                # the phone, IP and blacklist counts in a single round trip.
+                # Rows of the batch being flushed are left out whether or not
+                # they are committed yet, they are counted from memory below
+                qry = ("SELECT "
+                       "  (SELECT count(id) FROM _ms_call_throttle WHERE "
+                       "   create_date >= NOW() - '1 day'::INTERVAL "
+                       "   AND campaign_id=%s AND from_phone_number=%s "
+                       "   AND id <> ALL(%s)), "
+                       "  (SELECT count(id) FROM _ms_call_throttle WHERE "
+                       "   create_date >= NOW() - '1 day'::INTERVAL "
+                       "   AND campaign_id=%s "
+                       "   AND (ip_address=%s OR ip_address=%s) "
+                       "   AND id <> ALL(%s)), "
+                       "  (SELECT count(id) FROM _ms_call_blacklist "
+                       "   WHERE phone_number=%s)")
+                excluded = inflight_ids or [-1]
+                cur.execute(qry, (campaign_id, from_phone_number, excluded,
+                                  campaign_id, ip_address, hashed_ip_address,
+                                  excluded, from_phone_number))
+                recent_from_phone_number, recent_ip_address, is_blacklisted = \
+                    cur.fetchone()
+
+                # a batch given its ids while the query ran may already be in
+                # the counts, and in our copy of the unflushed rows too
+                if not self.log or self.log.generation == generation:
+                    break
+
+            # calls logged here but not in the table yet count too
+            for row, hashed_ip in unflushed + inflight:
+                if row[0] == campaign_id and row[7] >= now - WINDOW:
+                    if row[1] == from_phone_number:
+                        recent_from_phone_number += 1
+                    if hashed_ip == hashed_ip_address:
+                        recent_ip_address += 1
+
+            if recent_from_phone_number > 1:
+                flag_number = 1
+
+            if recent_ip_address > 1:
+                flag_ip = 1
+
+            if is_blacklisted > 0:
+                blacklist = 1
+
+            flag_number, flag_ip, is_whitelisted = apply_override(
+                flag_number, flag_ip, blacklist, override)
+
+            if flag_number == 0 and flag_ip == 0:
+                ip_address = hashed_ip_address
+
+            row = (campaign_id, from_phone_number, is_whitelisted, blacklist,
+                   ip_address, flag_number, flag_ip, now)
+
+            if self.log:
+                self.log.append(row, hashed_ip_address)
+            else:
+                cur.execute(INSERT_THROTTLE_ROWS + ROW_VALUES, row)
+
+            cur.close()
+
+        return report_trip(flag_number, flag_ip, blacklist, from_phone_number,
+                           recent_from_phone_number, ip_address,
+                           recent_ip_address)
+
+
+class WindowThrottle():
+    """
+    Throttle that keeps the last day of calls in sliding windows, per
+    (campaign, phone number) and per (campaign, hashed IP), and the
+    blacklist in a set, so deciding a call doesn't touch Postgres. Calls
+    are still logged to _ms_call_throttle for audit, from a background
+    greenlet. The windows and blacklist are seeded from Postgres on start.
+
+    The blacklist is reloaded every blacklist_refresh seconds, so a number
+    blacklisted in the table gets through until the next reload. Without
+    redis_conn each worker counts only the calls it answers, so a caller
+    spread over N workers gets N times the limit.
+    """
+
+    BLACKLIST_REFRESH = 60      # seconds between blacklist reloads
 
-        if recent_from_phone_number[0] > 1:
-            flag_number = 1
+    pool = None
+    windows = None
+    blacklist = None
+    log = None      # ThrottleLog writing every call for audit
 
-        qry = ("SELECT count(id) FROM _ms_call_throttle WHERE "
-               "create_date >= NOW() - '1 day'::INTERVAL "
-               " AND campaign_id=%s AND (ip_address=%s OR ip_address=%s)")
-        cur.execute(qry, (campaign_id, ip_address, hashed_ip_address))
-        recent_ip_address = cur.fetchone()
+    def __init__(self, redis_conn=None, pool_size=2, blacklist_refresh=None):
 
-        if recent_ip_address[0] > 1:
-            flag_ip = 1
+        self.pool = connection_pool(pool_size)
 
-        qry = "SELECT count(id) FROM _ms_call_blacklist WHERE phone_number=%s"
-        cur.execute(qry, (from_phone_number,))
-        is_blacklisted = cur.fetchone()
+        if blacklist_refresh:
+            self.BLACKLIST_REFRESH = blacklist_refresh
 
-        if is_blacklisted[0] > 0:
-            blacklist = 1
+        if redis_conn:
+            self.windows = RedisWindows(redis_conn, WINDOW)
+        else:
+            print "WARNING: window throttle without Redis, each worker " \
+                "counts only its own calls"
+            self.windows = MemoryWindows(WINDOW)
 
-        if override ==os.environ.get('THROTTLE_OVERRIDE_KEY') and not blacklist:
-            flag_ip = 0
-            flag_number = 0
-            is_whitelisted = 1
+        self.blacklist = set()
+        self.log = ThrottleLog(self.pool)
+
+        if self.windows.needs_seed():
+            self.seed_windows()
+            self.windows.mark_seeded()
+        self.load_blacklist()
+
+        gevent.spawn(self.refresh_blacklist)
+
+    def throttle(self, campaign_id, from_phone_number, ip_address, override):
+        """Records call info in the log"""
+
+        if from_phone_number == '' or len(from_phone_number) != 10:
+            print "THROTTLE TRIP! --- Bad from_phone_number!"
+
+        from_phone_number = format_phone_number(from_phone_number)
+
+        now = time.time()
+        hashed_ip_address = hashlib.sha256(ip_address).hexdigest()
+
+        # rows store the raw or the hashed address, windows always the hash
+        recent_from_phone_number = self.windows.hit(
+            phone_window_key(campaign_id, from_phone_number), now)
+        recent_ip_address = self.windows.hit(
+            ip_window_key(campaign_id, hashed_ip_address), now)
+
+        flag_number = 1 if recent_from_phone_number > 1 else 0
+        flag_ip = 1 if recent_ip_address > 1 else 0
+        blacklist = 1 if from_phone_number in self.blacklist else 0
+
+        flag_number, flag_ip, is_whitelisted = apply_override(
+            flag_number, flag_ip, blacklist, override)
 
         if flag_number == 0 and flag_ip == 0:
             ip_address = hashed_ip_address
 
-        cur.execute(("INSERT INTO _ms_call_throttle "
-                     "      (campaign_id, from_phone_number, is_whitelisted, "
-                     "       is_blacklisted, ip_address, flag_number, flag_ip, "
-                     "       create_date) "
-                     "VALUES "
-                     "      (%s, %s, %s, %s, %s, %s, %s, NOW())"),
-                    (campaign_id, from_phone_number, is_whitelisted, blacklist,
-                            ip_address, flag_number, flag_ip))
-
-        conn.commit()
-        cur.close()
-
-        if flag_number:
-            print "THROTTLE TRIP! --- from_phone_number %s / %s" % \
-                (from_phone_number, recent_from_phone_number[0])
-            return True
-        elif flag_ip:
-            print "THROTTLE TRIP! --- ip_address %s / %s" % \
-                (ip_address, recent_ip_address[0])
-            return True
-        elif blacklist:
-            print "THROTTLE TRIP! --- BLACKLISTED %s" % \
-                (from_phone_number,)
-            return True
-
-        return False
+        self.log.append((campaign_id, from_phone_number, is_whitelisted,
+                         blacklist, ip_address, flag_number, flag_ip, now),
+                        hashed_ip_address)
+
+        return report_trip(flag_number, flag_ip, blacklist, from_phone_number,
+                           recent_from_phone_number, ip_address,
+                           recent_ip_address)
+
+    def seed_windows(self):
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, campaign_id, from_phone_number, "
+                        "       ip_address, "
+                        "       EXTRACT(EPOCH FROM NOW() - create_date) "
+                        "FROM _ms_call_throttle WHERE "
+                        "create_date >= NOW() - '1 day'::INTERVAL "
+                        "ORDER BY create_date")
+            rows = cur.fetchall()
+            cur.close()
+
+        now = time.time()
+
+        for row_id, campaign_id, phone_number, ip_address, age in rows:
+            self.windows.seed(phone_window_key(campaign_id, phone_number),
+                              now - float(age), row_id)
+
+            if ip_address is None:
+                continue
+
+            if not is_hashed(ip_address):
+                ip_address = hashlib.sha256(ip_address).hexdigest()
+
+            self.windows.seed(ip_window_key(campaign_id, ip_address),
+                              now - float(age), row_id)
+
+    def load_blacklist(self):
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT phone_number FROM _ms_call_blacklist")
+            self.blacklist = set(row[0] for row in cur)
+            cur.close()
+
+    def refresh_blacklist(self):
+
+        while True:
+            gevent.sleep(self.BLACKLIST_REFRESH)
+
+            try:
+                self.load_blacklist()
+            except psycopg2.Error, err:
+                print "Blacklist reload failed: %r" % err
+
+
+class ThrottleLog(WriteBehind):
+    """
+    Write-behind buffer for _ms_call_throttle rows. While the database is
+    unavailable rows are kept for the next try, up to MAX_PENDING, then
+    the oldest dropped.
+
+    Until a batch is committed unflushed() hands its rows to Throttle so
+    they still count. Each batch takes its ids from the table's sequence
+    before it is inserted, so Throttle can leave exactly those rows out of
+    its counts whether or not the INSERT has landed. generation changes
+    whenever a batch gets its ids, which is the only step after which rows
+    can reach the table.
+    """
+
+    FLUSH_INTERVAL = 0.25   # seconds
+
+    pool = None
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.inflight_ids = []  # ids of the batch being written, once taken
+        self.generation = 0
+
+        WriteBehind.__init__(self)
+
+    def append(self, row, hashed_ip_address):
+        WriteBehind.append(self, (row, hashed_ip_address))
+
+    def unflushed(self):
+        """(pending rows, rows being flushed, their ids, generation)"""
+        return (list(self.pending), list(self.inflight),
+                list(self.inflight_ids), self.generation)
+
+    def write(self, rows):
+
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(ALLOCATE_THROTTLE_IDS, (len(rows),))
+                ids = [row[0] for row in cur.fetchall()]
+
+                # from here on the rows may be in the table
+                self.inflight_ids = ids
+                self.generation += 1
+
+                values = ','.join(
+                    cur.mogrify(ID_ROW_VALUES, (row_id,) + row)
+                    for row_id, (row, hashed_ip) in zip(ids, rows))
+                cur.execute(INSERT_THROTTLE_ROWS_WITH_IDS + values)
+                cur.close()
+        except psycopg2.Error, err:
+            print "Throttle log flush of %d rows failed: %r" % (
+                len(rows), err)
+
+            # retried first next time, they get new ids then
+            return 0, rows
+        finally:
+            self.inflight_ids = []
+
+        return len(rows), []
+
+
+WINDOW = 60 * 60 * 24   # the '1 day' of the count queries
+
+INSERT_THROTTLE_ROWS = ("INSERT INTO _ms_call_throttle "
+                        "      (campaign_id, from_phone_number, "
+                        "       is_whitelisted, is_blacklisted, ip_address, "
+                        "       flag_number, flag_ip, create_date) "
+                        "VALUES ")
+ROW_VALUES = "(%s, %s, %s, %s, %s, %s, %s, to_timestamp(%s))"
+
+# ThrottleLog batches insert ids taken from the sequence beforehand
+ALLOCATE_THROTTLE_IDS = ("SELECT nextval(pg_get_serial_sequence("
+                         "'_ms_call_throttle', 'id')) "
+                         "FROM generate_series(1, %s)")
+INSERT_THROTTLE_ROWS_WITH_IDS = ("INSERT INTO _ms_call_throttle "
+                                 "      (id, campaign_id, from_phone_number, "
+                                 "       is_whitelisted, is_blacklisted, "
+                                 "       ip_address, flag_number, flag_ip, "
+                                 "       create_date) "
+                                 "VALUES ")
+ID_ROW_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s))"
+
+# times Throttle recounts when a batch was given ids while it counted
+RECOUNT_ATTEMPTS = 3
+
+
+def connection_pool(pool_size):
+    """a green pool of connections to the throttle database"""
+
+    url = os.environ.get('HEROKU_POSTGRESQL_AMBER_URL')
+    make_green()
+
+    def connect():
+        conn = psycopg2.connect(url)
+        # every statement stands alone, so skip the BEGIN/COMMIT round trips
+        conn.autocommit = True
+        return conn
+
+    return ConnectionPool(connect, pool_size)
+
+
+def apply_override(flag_number, flag_ip, blacklist, override):
+    """the override key clears the flags, unless the number is blacklisted"""
+
+    if override ==os.environ.get('THROTTLE_OVERRIDE_KEY') and not blacklist:
+        return 0, 0, 1
+
+    return flag_number, flag_ip, 0
+
+
+def report_trip(flag_number, flag_ip, blacklist, from_phone_number,
+                recent_from_phone_number, ip_address, recent_ip_address):
+
+    if flag_number:
+        print "THROTTLE TRIP! --- from_phone_number %s / %s" % \
+            (from_phone_number, recent_from_phone_number)
+        return True
+    elif flag_ip:
+        print "THROTTLE TRIP! --- ip_address %s / %s" % \
+            (ip_address, recent_ip_address)
+        return True
+    elif blacklist:
+        print "THROTTLE TRIP! --- BLACKLISTED %s" % \
+            (from_phone_number,)
+        return True
+
+    return False
+
+def phone_window_key(campaign_id, from_phone_number):
+    return 'throttle:phone:%s:%s' % (campaign_id, from_phone_number)
+
+def ip_window_key(campaign_id, hashed_ip_address):
+    return 'throttle:ip:%s:%s' % (campaign_id, hashed_ip_address)
+
+def is_hashed(ip_address):
+    return len(ip_address) == 64 and all(c in '0123456789abcdef'
+                                         for c in ip_address)
 
 def format_phone_number(phone_number):
     return phone_number[:3] + "-" + phone_number[3:6] + "-" + phone_number[6:10]
@@ -0,0 +1,48 @@
+class TwimlCache():
+    """
+    Pre-serialized TwiML for responses that only depend on the campaign.
+
+    A response is built once per campaign with a placeholder in place of its
+    action URL and serialized. Later requests splice their escaped action URL
+    into the cached string instead of building and serializing a new
+    twilio.twiml.Response. Entries are tied to the campaign dict they were
+    built from, so reloading campaigns (a new merged dict) rebuilds them.
+    """
+
+    ACTION = 'TWIML-CACHE-ACTION-URL'
+
+    fragments = None
+
+    def __init__(self):
+        self.fragments = {}
+
+    def escape(self, action):
+        # the same escaping ElementTree applies to attribute values
+        action = action.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;').replace('"', '&quot;').replace('\n', '&#10;')
+
+        if isinstance(action, unicode):
+            action = action.encode('ascii', 'xmlcharrefreplace')
+
+        return action
+
+    def render(self, name, campaign, build, action=None):
+        """
+        Render the cached response called name for campaign. On a miss,
+        build(campaign, action) must return the twilio.twiml.Response, using
+        the action it is given wherever the per-request URL goes.
+        """
+        key = (name, campaign['id'])
+        entry = self.fragments.get(key)
+
+        if entry is None or entry[0] is not campaign:
+            parts = str(build(campaign, self.ACTION)).split(self.ACTION)
+            entry = (campaign, parts)
+            self.fragments[key] = entry
+
+        parts = entry[1]
+
+        if len(parts) == 1:
+            return parts[0]
+
+        return self.escape(action).join(parts)
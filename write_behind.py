@@ -0,0 +1,135 @@
+"""
+Write-behind buffering shared by the call log and the throttle log, so
+requests only append a row and a background greenlet does the writing.
+"""
+import atexit
+
+import gevent
+
+from gevent.event import Event
+
+
+class WriteBehind():
+    """
+    Rows appended are written by write() in batches of up to FLUSH_ROWS, at
+    least every FLUSH_INTERVAL seconds, and on shutdown. Once MAX_PENDING
+    rows wait the oldest go to spool(). Rows a failed write() gives back
+    are retried first next time, or with SPOOL_FAILED spooled along with
+    everything waiting, so nothing piles up in memory while the database
+    is down. spool() drops rows unless a subclass keeps them somewhere.
+    """
+
+    FLUSH_ROWS = 100
+    FLUSH_INTERVAL = 1      # seconds
+    MAX_PENDING = 10000
+    FLUSH_TIMEOUT = 10      # seconds close() waits for a running flush
+    SPOOL_FAILED = False
+
+    def __init__(self):
+        self.pending = []       # rows not sent yet
+        self.inflight = []      # the batch being written
+        self.wakeup = Event()
+        self.stats = {
+            'flushed': 0,
+            'batches': 0,
+            'flush_errors': 0,
+            'dropped': 0
+        }
+
+        self.flusher = gevent.spawn(self.run)
+        atexit.register(self.close)
+
+    def append(self, row):
+
+        self.pending.append(row)
+        self.trim()
+
+        if len(self.pending) >= self.FLUSH_ROWS:
+            self.wakeup.set()
+
+    def trim(self):
+        """spool the oldest rows past MAX_PENDING"""
+
+        overflow = len(self.pending) - self.MAX_PENDING
+
+        if overflow > 0:
+            rows = self.pending[:overflow]
+            del self.pending[:overflow]
+            self.spool(rows)
+
+    def run(self):
+
+        while True:
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+
+            while len(self.pending) >= self.FLUSH_ROWS:
+                if not self.flush():
+                    break
+            else:
+                self.flush()
+
+    def flush(self):
+        """write one batch, returns False if the database refused it"""
+
+        if not self.pending or self.inflight:
+            return True
+
+        self.inflight = self.pending[:self.FLUSH_ROWS]
+        del self.pending[:self.FLUSH_ROWS]
+
+        try:
+            written, unwritten = self.write(self.inflight)
+        finally:
+            self.inflight = []
+
+        self.stats['flushed'] += written
+
+        if unwritten:
+            self.stats['flush_errors'] += 1
+
+            if self.SPOOL_FAILED:
+                rows = unwritten + self.pending
+                del self.pending[:]
+                self.spool(rows)
+            else:
+                self.pending[0:0] = unwritten
+                self.trim()
+
+            return False
+
+        self.stats['batches'] += 1
+        self.written()
+        return True
+
+    def write(self, rows):
+        """
+        write a batch, returns how many rows went in and the ones that
+        didn't because the database is unavailable
+        """
+        raise NotImplementedError
+
+    def written(self):
+        """called after every batch that went in"""
+
+    def spool(self, rows):
+
+        self.stats['dropped'] += len(rows)
+
+    def close(self):
+        """flush everything, spooling what the database won't take"""
+
+        # let a flush in progress finish, then stop the flusher
+        with gevent.Timeout(self.FLUSH_TIMEOUT, False):
+            while self.inflight:
+                gevent.sleep(0.05)
+
+        self.flusher.kill()
+
+        while self.pending:
+            if self.inflight or not self.flush():
+                print "%s spooling %d rows on shutdown" % (
+                    self.__class__.__name__, len(self.pending))
+                rows = self.pending[:]
+                del self.pending[:]
+                self.spool(rows)